@@ -90,6 +90,23 @@ CREATE TABLE IF NOT EXISTS rostros (
     creado_en TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- Centroide + medoides cifrados por usuario (primera etapa del reconocimiento)
+CREATE TABLE IF NOT EXISTS rostros_agregados (
+    usuario_id INTEGER PRIMARY KEY REFERENCES usuarios(id) ON DELETE CASCADE,
+    vectores BYTEA NOT NULL,
+    num_rostros INTEGER NOT NULL,
+    num_medoides INTEGER NOT NULL,
+    modelo_id INTEGER REFERENCES modelos_faciales(id),
+    actualizado_en TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- Modelo cuyos rostros forman la galería (una sola fila; ver reembed_gallery.py)
+CREATE TABLE IF NOT EXISTS galeria_modelo (
+    id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+    modelo_id INTEGER NOT NULL REFERENCES modelos_faciales(id),
+    actualizado_en TIMESTAMPTZ DEFAULT NOW()
+);
+
 CREATE TABLE IF NOT EXISTS zonas (
     id SERIAL PRIMARY KEY,
     uuid UUID DEFAULT gen_random_uuid(),
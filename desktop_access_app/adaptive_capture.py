@@ -0,0 +1,101 @@
+"""
+Control adaptativo de captura del punto de control
+
+Antes la cámara USB quedaba fija en 1920x1080 a 30 fps y el pipeline
+completo (captura, detección y render) corría al máximo aunque no hubiera
+nadie frente al kiosco. `AdaptiveRateController` alterna entre dos perfiles
+según lo que ve el detector:
+
+- reposo: captura reducida (o, en cámaras IP, menos frames decodificados),
+  detección más espaciada y filtrada por movimiento, render más lento
+- activo: la resolución y los fps completos, para que el frame que se envía
+  a verificar tenga la misma calidad que antes
+
+Pasa a activo con el primer rostro y vuelve a reposo tras `idle_after_seconds`
+sin rostros (histéresis: una detección que parpadea no reconfigura la cámara
+en cada frame). `CpuMeter` mide el uso de CPU del proceso para la barra de
+estado, sin depender de psutil.
+"""
+
+import os
+import time
+from typing import Optional
+
+MODE_IDLE = "reposo"
+MODE_ACTIVE = "activo"
+
+
+class CaptureProfile:
+    """
+    Parámetros de un modo: resolución y fps de captura (`capture_fps` 0 = sin
+    límite), frecuencia de detección, intervalo de render y si la detección
+    se salta mientras la escena no cambia (`motion_gate`)
+    """
+
+    def __init__(self, width: int, height: int, capture_fps: float, detection_hz: float,
+                 render_interval_ms: int, motion_gate: bool = False):
+        self.width = width
+        self.height = height
+        self.capture_fps = capture_fps
+        self.detection_hz = detection_hz
+        self.render_interval_ms = render_interval_ms
+        self.motion_gate = motion_gate
+
+
+class AdaptiveRateController:
+    """Modo de captura según la presencia de rostros (llamar desde el render)"""
+
+    def __init__(self, idle: CaptureProfile, active: CaptureProfile, idle_after_seconds: float = 5.0):
+        self.profiles = {MODE_IDLE: idle, MODE_ACTIVE: active}
+        self.idle_after_seconds = idle_after_seconds
+        self.mode = MODE_ACTIVE
+        self.last_face_time = 0.0
+        self.switches = 0
+
+    @property
+    def profile(self) -> CaptureProfile:
+        return self.profiles[self.mode]
+
+    @property
+    def active(self) -> bool:
+        return self.mode == MODE_ACTIVE
+
+    def reset(self, now: Optional[float] = None):
+        """Arranque de cámara: se empieza en activo y se baja si no hay nadie"""
+        self.mode = MODE_ACTIVE
+        self.last_face_time = time.monotonic() if now is None else now
+
+    def update(self, faces_present: bool, now: Optional[float] = None) -> Optional[CaptureProfile]:
+        """Retorna el perfil nuevo si cambió el modo; None si sigue igual"""
+        now = time.monotonic() if now is None else now
+        if faces_present:
+            self.last_face_time = now
+            target = MODE_ACTIVE
+        elif now - self.last_face_time >= self.idle_after_seconds:
+            target = MODE_IDLE
+        else:
+            target = self.mode
+        if target == self.mode:
+            return None
+        self.mode = target
+        self.switches += 1
+        return self.profile
+
+
+class CpuMeter:
+    """Uso de CPU del proceso (% de la máquina completa) entre lecturas"""
+
+    def __init__(self):
+        self.cpus = os.cpu_count() or 1
+        self.percent = 0.0
+        self._last_cpu = time.process_time()
+        self._last_wall = time.monotonic()
+
+    def sample(self) -> float:
+        cpu = time.process_time()
+        wall = time.monotonic()
+        elapsed = wall - self._last_wall
+        if elapsed > 0:
+            self.percent = 100.0 * (cpu - self._last_cpu) / (elapsed * self.cpus)
+        self._last_cpu, self._last_wall = cpu, wall
+        return self.percent
@@ -0,0 +1,120 @@
+"""
+Verificación automática por presencia estable
+
+El detector local del pipeline de video ya encuentra rostros varias veces por
+segundo; `PresenceTrigger` decide con esos resultados cuándo vale la pena
+enviar un frame a /recognize-face:
+
+- el rostro más grande ocupa al menos `min_face_ratio` del ancho del frame
+- su caja se mantiene estable (desplazamiento y cambio de tamaño acotados)
+  durante `stable_frames` detecciones seguidas
+- el recorte del rostro es nítido (varianza del Laplaciano)
+
+Se envía una sola verificación por episodio de presencia: el episodio
+termina cuando no se ve ningún rostro durante `absence_seconds`. Además hay un
+`cooldown_seconds` mínimo entre envíos automáticos, para que un detector que
+parpadea no abra episodios nuevos en cada frame.
+"""
+
+import time
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+Box = Tuple[int, int, int, int]
+
+
+def face_sharpness(frame: np.ndarray, box: Box) -> float:
+    """Varianza del Laplaciano del recorte del rostro (mayor = más nítido)"""
+    x, y, w, h = box
+    roi = frame[max(y, 0):y + h, max(x, 0):x + w]
+    if roi.size == 0:
+        return 0.0
+    gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY) if roi.ndim == 3 else roi
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+class PresenceTrigger:
+    """Estado de la verificación automática de un punto de control"""
+
+    def __init__(self, min_face_ratio: float = 0.12, min_sharpness: float = 60.0, stable_frames: int = 4,
+                 max_shift: float = 0.15, cooldown_seconds: float = 5.0, absence_seconds: float = 1.5):
+        self.min_face_ratio = min_face_ratio
+        self.min_sharpness = min_sharpness
+        self.stable_frames = stable_frames
+        self.max_shift = max_shift
+        self.cooldown_seconds = cooldown_seconds
+        self.absence_seconds = absence_seconds
+        self.reset()
+
+    def reset(self):
+        self.stable_count = 0
+        self.last_box: Optional[Box] = None
+        self.episode_active = False
+        self.episode_submitted = False
+        self.last_face_time = 0.0
+        self.last_submit_time = float('-inf')
+        self.status = "esperando rostro"
+
+    def _is_stable(self, box: Box) -> bool:
+        if self.last_box is None:
+            return False
+        x, y, w, h = box
+        lx, ly, lw, lh = self.last_box
+        shift = np.hypot((x + w / 2) - (lx + lw / 2), (y + h / 2) - (ly + lh / 2)) / max(lw, 1)
+        return shift <= self.max_shift and abs(w - lw) <= self.max_shift * lw
+
+    def update(self, faces: List[Box], frame: np.ndarray, now: Optional[float] = None) -> Optional[Box]:
+        """
+        Procesa un resultado nuevo del detector. Retorna la caja del rostro si
+        hay que enviar `frame` a verificar ahora; el llamador confirma el
+        envío con `mark_submitted`
+        """
+        now = time.monotonic() if now is None else now
+
+        if not faces:
+            self.stable_count = 0
+            self.last_box = None
+            if self.episode_active and now - self.last_face_time > self.absence_seconds:
+                self.episode_active = False
+                self.episode_submitted = False
+            self.status = "esperando rostro"
+            return None
+
+        # Cualquier rostro mantiene vivo el episodio, aunque esté lejos
+        self.last_face_time = now
+        self.episode_active = True
+        if self.episode_submitted:
+            self.status = "verificado"
+            return None
+
+        box = max(faces, key=lambda f: f[2] * f[3])
+        if box[2] < self.min_face_ratio * frame.shape[1]:
+            self.stable_count = 0
+            self.last_box = box
+            self.status = "acérquese"
+            return None
+
+        self.stable_count = self.stable_count + 1 if self._is_stable(box) else 1
+        self.last_box = box
+        if self.stable_count < self.stable_frames:
+            self.status = f"estabilizando {self.stable_count}/{self.stable_frames}"
+            return None
+
+        # El Laplaciano solo se calcula cuando el resto de condiciones se cumple
+        if face_sharpness(frame, box) < self.min_sharpness:
+            self.status = "imagen borrosa"
+            return None
+
+        if now - self.last_submit_time < self.cooldown_seconds:
+            self.status = "en espera"
+            return None
+
+        return box
+
+    def mark_submitted(self, now: Optional[float] = None):
+        self.last_submit_time = time.monotonic() if now is None else now
+        self.episode_submitted = True
+        self.stable_count = 0
+        self.status = "verificando"
@@ -0,0 +1,251 @@
+"""
+Caché local de la configuración de cámaras de los puntos de control
+
+Antes cada arranque de cámara esperaba un GET a
+/api/puntos-control/{id}/camera (2 s de timeout) y la lista de puntos se
+pedía de nuevo. Ahora:
+
+- `CameraConfigCache` guarda en disco la lista de puntos y la configuración
+  de cámara de cada punto con su ETag. El arranque usa la copia local al
+  instante y la revalida en segundo plano con If-None-Match (304 = sin cambios).
+- `CameraConfigEvents` escucha /events/camaras (Server-Sent Events del
+  servicio de reconocimiento, alimentado por un trigger en puntos_control)
+  y revalida el punto que cambió, así un cambio hecho en el dashboard llega
+  al kiosco en menos de un segundo. Al (re)conectar se revalida todo, porque
+  pudieron perderse avisos.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class CameraConfigCache:
+    """
+    Configuración por punto y lista de puntos, con ETag y persistida en
+    `cache_path`. `on_change(point_id, config)` se llama (desde el hilo que
+    revalida) cuando cambia una configuración que ya estaba en caché;
+    `point_id` es None cuando cambia la lista de puntos
+    """
+
+    def __init__(self, session: requests.Session, dashboard_url: str, cache_path: str = "camera_config_cache.json",
+                 on_change: Optional[Callable[[Optional[int], Any], None]] = None):
+        self.session = session
+        self.dashboard_url = dashboard_url
+        self.cache_path = cache_path
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._cameras: Dict[str, Dict[str, Any]] = {}
+        self._points: Dict[str, Any] = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._cameras = data.get("camaras", {})
+            self._points = data.get("puntos", {})
+            logger.info(f"📂 Caché de cámaras cargada: {len(self._cameras)} puntos")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Caché de cámaras inválida, se ignora: {e}")
+
+    def _save(self):
+        with self._lock:
+            data = {"camaras": self._cameras, "puntos": self._points}
+        tmp_path = f"{self.cache_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.warning(f"⚠️ No se pudo guardar la caché de cámaras: {e}")
+
+    def _conditional_get(self, url: str, entry: Optional[Dict[str, Any]], timeout: float) -> Optional[Dict[str, Any]]:
+        """Nueva entrada {etag, data, verificado} si cambió; None si sigue igual (304)"""
+        headers = {"If-None-Match": entry["etag"]} if entry and entry.get("etag") else {}
+        response = self.session.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304:
+            entry["verificado"] = time.time()
+            return None
+        response.raise_for_status()
+        body = response.json()
+        if not body.get("success"):
+            raise RuntimeError(body.get("error", f"Respuesta inválida de {url}"))
+        return {"etag": response.headers.get("ETag"), "data": body.get("data"), "verificado": time.time()}
+
+    # Configuración de cámara de un punto
+
+    def get(self, point_id: int) -> Optional[Dict[str, Any]]:
+        """Configuración en caché (sin red); None si nunca se obtuvo"""
+        with self._lock:
+            entry = self._cameras.get(str(point_id))
+        return entry["data"] if entry else None
+
+    def revalidate(self, point_id: int, timeout: float = 2.0) -> Optional[Dict[str, Any]]:
+        """Revalida contra el dashboard y retorna la configuración vigente"""
+        key = str(point_id)
+        with self._lock:
+            entry = self._cameras.get(key)
+        url = f"{self.dashboard_url}/api/puntos-control/{point_id}/camera"
+        try:
+            fresh = self._conditional_get(url, entry, timeout)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                # Punto eliminado
+                with self._lock:
+                    removed = self._cameras.pop(key, None)
+                if removed:
+                    self._save()
+                    self._notify(point_id, None)
+                return None
+            raise
+        if fresh is None:
+            return entry["data"]
+        with self._lock:
+            self._cameras[key] = fresh
+        self._save()
+        if entry is not None and entry.get("data") != fresh["data"]:
+            logger.info(f"🔄 Configuración de cámara del punto {point_id} actualizada")
+            self._notify(point_id, fresh["data"])
+        return fresh["data"]
+
+    def cached_point_ids(self) -> List[int]:
+        with self._lock:
+            return [int(key) for key in self._cameras]
+
+    # Lista de puntos
+
+    def get_points(self) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            return self._points.get("data")
+
+    def revalidate_points(self, timeout: float = 5.0) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            entry = dict(self._points) if self._points else None
+        # Vista sin contadores de accesos: el ETag solo cambia con los puntos
+        fresh = self._conditional_get(f"{self.dashboard_url}/api/puntos-control?vista=kiosco", entry, timeout)
+        if fresh is None:
+            return entry["data"]
+        with self._lock:
+            self._points = fresh
+        self._save()
+        if entry is not None and self._point_names(entry.get("data")) != self._point_names(fresh["data"]):
+            self._notify(None, fresh["data"])
+        return fresh["data"]
+
+    @staticmethod
+    def _point_names(points) -> List[tuple]:
+        # El ETag cambia también con la cámara de un punto; al selector solo
+        # le importan id, nombre y estado
+        return [(p.get("id"), p.get("nombre"), p.get("activo")) for p in points or []]
+
+    def revalidate_all(self):
+        """Revalida la lista y todos los puntos en caché (tras perder avisos)"""
+        try:
+            self.revalidate_points()
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo revalidar la lista de puntos: {e}")
+        for point_id in self.cached_point_ids():
+            try:
+                self.revalidate(point_id)
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo revalidar el punto {point_id}: {e}")
+
+    def _notify(self, point_id: Optional[int], data):
+        if self.on_change is not None:
+            try:
+                self.on_change(point_id, data)
+            except Exception as e:
+                logger.error(f"Error notificando cambio de cámara: {e}")
+
+
+class CameraConfigEvents(threading.Thread):
+    """
+    Cliente SSE de /events/camaras: revalida en `cache` el punto de cada
+    aviso. Reconecta con espera exponencial (hasta `max_backoff`), también
+    si el servicio tiene los avisos deshabilitados (503)
+    """
+
+    def __init__(self, api_base_url: str, cache: CameraConfigCache, max_backoff: float = 30.0):
+        super().__init__(name="eventos-camaras", daemon=True)
+        self.url = f"{api_base_url}/events/camaras"
+        self.cache = cache
+        self.max_backoff = max_backoff
+        self.connected = False
+        # Session propia: la conexión queda abierta mientras dure el stream
+        self.session = requests.Session()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        backoff = 1.0
+        while not self._stop_event.is_set():
+            try:
+                # Timeout de lectura mayor que el keepalive del servicio
+                with self.session.get(self.url, stream=True, timeout=(5, 60)) as response:
+                    if response.status_code != 200:
+                        raise RuntimeError(f"HTTP {response.status_code}")
+                    self.connected = True
+                    backoff = 1.0
+                    self._consume(response)
+            except Exception as e:
+                if not self._stop_event.is_set():
+                    logger.warning(f"⚠️ Avisos de cámaras no disponibles ({e}), reintento en {backoff:.0f} s")
+            self.connected = False
+            self._stop_event.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _consume(self, response: requests.Response):
+        event_type, data = None, ""
+        for line in response.iter_lines(decode_unicode=True):
+            if self._stop_event.is_set():
+                return
+            if line is None:
+                continue
+            if line.startswith(":"):
+                continue
+            if line.startswith("event:"):
+                event_type = line[6:].strip()
+            elif line.startswith("data:"):
+                data += line[5:].strip()
+            elif line == "":
+                self._handle(event_type, data)
+                event_type, data = None, ""
+
+    def _handle(self, event_type: Optional[str], data: str):
+        if event_type == "listo":
+            logger.info("🔔 Conectado a avisos de cámaras")
+            # Pudieron perderse avisos mientras no había conexión
+            self.cache.revalidate_all()
+            return
+        if event_type != "camara":
+            return
+        try:
+            event = json.loads(data)
+        except ValueError:
+            return
+        if event.get("op") == "RESYNC":
+            self.cache.revalidate_all()
+            return
+        point_id = event.get("id")
+        if point_id is None:
+            return
+        try:
+            self.cache.revalidate_points()
+            # Los puntos que este kiosco nunca usó se obtienen al seleccionarlos
+            if int(point_id) in self.cache.cached_point_ids():
+                self.cache.revalidate(int(point_id))
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo revalidar el punto {point_id}: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+        self.session.close()
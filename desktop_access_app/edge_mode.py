@@ -0,0 +1,488 @@
+"""
+Modo sin conexión del kiosco
+
+Si el servicio de reconocimiento o PostgreSQL no responden, el kiosco decide
+solo con una copia local de lo que necesita su punto de control:
+
+- `EdgeEngine` descarga periódicamente /edge/puntos/{id}/paquete: embeddings
+  de los usuarios con reglas en la zona del punto, esas reglas, los nombres y
+  el umbral de confianza. El paquete llega cifrado con EDGE_SYNC_KEY y se
+  guarda en disco tal cual; solo se descifra en memoria. Se revalida con
+  If-None-Match (304 = sin cambios).
+- La decisión local genera el embedding con el mismo modelo de DeepFace que
+  sirve la galería, compara por coseno y aplica las reglas de zona y horario
+  igual que validate_access_rules del servicio.
+- Cada decisión se encola cifrada en disco (`DecisionQueue`) y se reenvía en
+  lotes a /edge/decisiones cuando vuelve la conexión; el servicio la registra
+  en accesos/alertas con su hora original.
+
+Limitaciones: sin conexión no corren los modelos de prueba de vida del
+servicio, solo la heurística básica (nitidez, bordes y contraste, como
+detect_liveness); si no la supera la decisión es DENEGADO. Un usuario sin
+reglas en la zona no está en el paquete, por lo que se registra como
+desconocido y no como zona restringida.
+
+Modos (`mode`): "off" (por defecto en main.py) nunca decide en el kiosco;
+"fallback" decide localmente solo si no se puede conectar con el servicio;
+"local" decide siempre en el kiosco y el servicio solo recibe el registro.
+"""
+
+import base64
+import io
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, time as dt_time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import requests
+from cryptography.fernet import Fernet, InvalidToken
+
+logger = logging.getLogger(__name__)
+
+Box = Tuple[int, int, int, int]
+
+EDGE_MODES = ("off", "fallback", "local")
+
+# Mismos filtros de calidad que recognize_detected_faces en el servicio
+MIN_FACE_SIZE = 120
+MIN_FACE_SHARPNESS = 20.0
+
+# Heurística de prueba de vida del servicio (detect_liveness)
+LIVENESS_MIN_SHARPNESS = 50.0
+LIVENESS_MIN_EDGE_DENSITY = 0.05
+LIVENESS_MIN_CONTRAST = 20.0
+
+
+def heuristic_liveness(roi: np.ndarray) -> bool:
+    """Misma heurística que detect_liveness del servicio: nitidez, bordes y contraste"""
+    gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+    sharpness = cv2.Laplacian(gray, cv2.CV_64F).var()
+    edges = cv2.Canny(gray, 50, 150)
+    edge_density = np.sum(edges > 0) / edges.size
+    return bool(sharpness > LIVENESS_MIN_SHARPNESS and edge_density > LIVENESS_MIN_EDGE_DENSITY
+                and gray.std() > LIVENESS_MIN_CONTRAST)
+
+
+def cosine_to_confidence(cosines) -> np.ndarray:
+    """Curva coseno -> confianza del servicio (embedding_storage.cosine_to_confidence)"""
+    c = np.asarray(cosines, dtype=np.float64)
+    confidence = np.select(
+        [c >= 0.70, c >= 0.60, c >= 0.50, c >= 0.40],
+        [0.85 + (c - 0.70) * 0.5, 0.70 + (c - 0.60) * 1.5, 0.50 + (c - 0.50) * 2.0, 0.30 + (c - 0.40) * 2.0],
+        default=np.maximum(0.0, c * 0.75),
+    )
+    return np.clip(confidence, 0.0, 1.0)
+
+
+class EdgeBundle:
+    """Paquete descifrado de un punto: galería reducida, reglas y umbral"""
+
+    def __init__(self, header: Dict[str, Any], ids: np.ndarray, user_ids: np.ndarray, embeddings: np.ndarray):
+        self.header = header
+        self.ids = ids
+        self.user_ids = user_ids
+        self.embeddings = embeddings
+        self.rules: Dict[int, List[Dict[str, Any]]] = {}
+        for rule in header.get("reglas", []):
+            self.rules.setdefault(int(rule["usuario_id"]), []).append({
+                "dia_semana": rule["dia_semana"],
+                "hora_inicio": dt_time.fromisoformat(rule["hora_inicio"]),
+                "hora_fin": dt_time.fromisoformat(rule["hora_fin"]),
+            })
+
+    @classmethod
+    def from_token(cls, cipher: Fernet, token: bytes) -> "EdgeBundle":
+        data = np.load(io.BytesIO(cipher.decrypt(token)), allow_pickle=False)
+        header = json.loads(data["cabecera"].tobytes())
+        return cls(header, data["ids"], data["usuarios"], data["embeddings"])
+
+    @property
+    def version(self) -> str:
+        return self.header["version"]
+
+    @property
+    def point_id(self) -> int:
+        return int(self.header["punto"]["id"])
+
+    @property
+    def point_name(self) -> str:
+        return self.header["punto"]["nombre"]
+
+    @property
+    def model(self) -> str:
+        return self.header["modelo"]
+
+    @property
+    def threshold(self) -> float:
+        return float(self.header["umbral_confianza"])
+
+    def user_name(self, user_id: Optional[int]) -> Optional[str]:
+        return self.header.get("nombres", {}).get(str(user_id)) if user_id is not None else None
+
+    def match(self, embedding: np.ndarray) -> Tuple[Optional[int], float]:
+        """(usuario, confianza): usuario None si ninguno alcanza el umbral"""
+        if len(self.embeddings) == 0:
+            return None, 0.0
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) + 1e-8)
+        confidences = cosine_to_confidence(self.embeddings @ query)
+        best = int(np.argmax(confidences))
+        confidence = float(confidences[best])
+        if confidence < self.threshold:
+            return None, confidence
+        return int(self.user_ids[best]), confidence
+
+    def check_rules(self, user_id: int, now: Optional[datetime] = None) -> Tuple[bool, str, int]:
+        """(tiene_permiso, mensaje, tipo_alerta) como validate_access_rules"""
+        now = now or datetime.now()
+        dia_semana_pg = (now.weekday() + 1) % 7  # 0=Domingo
+        rules = [rule for rule in self.rules.get(user_id, [])
+                 if rule["dia_semana"] is None or rule["dia_semana"] == dia_semana_pg]
+        if not rules:
+            return False, f"Usuario no autorizado para acceder a {self.point_name}", 6
+        current = now.time()
+        if any(rule["hora_inicio"] <= current <= rule["hora_fin"] for rule in rules):
+            return True, "", 0
+        inicio, fin = rules[0]["hora_inicio"].strftime('%H:%M'), rules[0]["hora_fin"].strftime('%H:%M')
+        return False, f"Acceso fuera de horario permitido ({inicio} - {fin})", 5
+
+
+class LocalEmbedder:
+    """DeepFace cargado en el primer uso (dependencia opcional del kiosco)"""
+
+    def __init__(self):
+        self._deepface = None
+        self.error: Optional[str] = None
+
+    @property
+    def available(self) -> bool:
+        if self._deepface is None and self.error is None:
+            try:
+                from deepface import DeepFace
+                self._deepface = DeepFace
+            except ImportError as e:
+                self.error = str(e)
+                logger.warning(f"⚠️ DeepFace no instalado, modo sin conexión deshabilitado: {e}")
+        return self._deepface is not None
+
+    def warmup(self, model_name: str):
+        """Carga los pesos antes de la primera decisión local"""
+        if self.available:
+            self._deepface.build_model(model_name)
+
+    def embed(self, face_roi: np.ndarray, model_name: str) -> np.ndarray:
+        result = self._deepface.represent(face_roi, model_name=model_name, enforce_detection=False)
+        if not result or result[0].get("embedding") is None:
+            raise RuntimeError("DeepFace no retornó embedding")
+        return np.asarray(result[0]["embedding"], dtype=np.float32)
+
+
+class DecisionQueue:
+    """
+    Decisiones pendientes de registrar, una por línea y cifradas (incluyen
+    la foto de evidencia). Se reescribe de forma atómica al confirmar envíos
+    """
+
+    def __init__(self, path: str, cipher: Fernet):
+        self.path = path
+        self.cipher = cipher
+        self._lock = threading.Lock()
+        self._entries: List[Dict[str, Any]] = self._load()
+
+    def _load(self) -> List[Dict[str, Any]]:
+        entries = []
+        try:
+            with open(self.path, "rb") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entries.append(json.loads(self.cipher.decrypt(line)))
+                    except (InvalidToken, ValueError):
+                        logger.error("❌ Decisión pendiente ilegible (¿cambió EDGE_SYNC_KEY?), se descarta")
+        except FileNotFoundError:
+            pass
+        if entries:
+            logger.info(f"📂 {len(entries)} decisiones sin conexión pendientes de registrar")
+        return entries
+
+    def _write(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            for entry in self._entries:
+                f.write(self.cipher.encrypt(json.dumps(entry).encode()) + b"\n")
+        os.replace(tmp_path, self.path)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def put(self, entry: Dict[str, Any]):
+        with self._lock:
+            self._entries.append(entry)
+            # Solo se agrega una línea: no hace falta reescribir el archivo
+            with open(self.path, "ab") as f:
+                f.write(self.cipher.encrypt(json.dumps(entry).encode()) + b"\n")
+
+    def pending(self, limit: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._entries[:limit])
+
+    def remove(self, local_ids):
+        local_ids = set(local_ids)
+        with self._lock:
+            self._entries = [entry for entry in self._entries if entry["id_local"] not in local_ids]
+            self._write()
+
+
+class EdgeEngine(threading.Thread):
+    """
+    Sincroniza el paquete del punto, reenvía la cola de decisiones y decide
+    localmente (`decide`, llamado desde el hilo de verificación).
+    `on_status()` se llama tras cada ciclo para refrescar la interfaz
+    """
+
+    def __init__(self, api_base_url: str, sync_key: str, point_id: int, mode: str = "fallback",
+                 session: Optional[requests.Session] = None, cache_dir: str = ".", sync_seconds: float = 300.0,
+                 replay_seconds: float = 10.0, max_bundle_age_hours: float = 24.0, batch_size: int = 20,
+                 context_width: int = 480, on_status: Optional[Callable[[], None]] = None):
+        super().__init__(name="modo-sin-conexion", daemon=True)
+        if mode not in EDGE_MODES:
+            raise ValueError(f"Modo sin conexión inválido: {mode}")
+        self.api_base_url = api_base_url
+        self.cipher = Fernet(sync_key.encode())
+        self.point_id = point_id
+        self.mode = mode
+        self.session = session or requests.Session()
+        self.cache_dir = cache_dir
+        self.sync_seconds = sync_seconds
+        self.replay_seconds = replay_seconds
+        self.max_bundle_age = max_bundle_age_hours * 3600
+        self.batch_size = batch_size
+        self.context_width = context_width
+        self.on_status = on_status
+        self.embedder = LocalEmbedder()
+        self.queue = DecisionQueue(os.path.join(cache_dir, "edge_decisiones.queue"), self.cipher)
+        self.bundle: Optional[EdgeBundle] = None
+        self.etag: Optional[str] = None
+        self.verified_at = 0.0
+        self.online = False
+        self.local_decisions = 0
+        self._next_sync = 0.0
+        self._warm_model: Optional[str] = None
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._load_bundle()
+
+    # Paquete del punto
+
+    def _bundle_path(self, point_id: int) -> str:
+        return os.path.join(self.cache_dir, f"edge_paquete_{point_id}.json")
+
+    def _load_bundle(self):
+        """Paquete guardado del punto actual (cifrado en disco)"""
+        self.bundle, self.etag, self.verified_at = None, None, 0.0
+        try:
+            with open(self._bundle_path(self.point_id), "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            self.bundle = EdgeBundle.from_token(self.cipher, stored["token"].encode())
+            self.etag = stored.get("etag")
+            self.verified_at = stored.get("verificado", 0.0)
+            logger.info(f"📂 Paquete sin conexión del punto {self.point_id}: {len(self.bundle.ids)} rostros")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, InvalidToken) as e:
+            logger.warning(f"⚠️ Paquete sin conexión inválido, se descarga de nuevo: {e}")
+
+    def _save_bundle(self, token: bytes):
+        path = self._bundle_path(self.point_id)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"etag": self.etag, "token": token.decode(), "verificado": self.verified_at}, f)
+        os.replace(tmp_path, path)
+
+    def set_point(self, point_id: int):
+        """Cambio de punto de control: otro paquete (otra zona)"""
+        if point_id == self.point_id:
+            return
+        self.point_id = point_id
+        self._load_bundle()
+        self._next_sync = 0.0
+        self._wake.set()
+
+    def sync_bundle(self):
+        point_id = self.point_id
+        headers = {"If-None-Match": self.etag} if self.etag and self.bundle else {}
+        response = self.session.get(f"{self.api_base_url}/edge/puntos/{point_id}/paquete", headers=headers, timeout=10)
+        if point_id != self.point_id:
+            return
+        if response.status_code == 304:
+            self.verified_at = time.time()
+            return
+        response.raise_for_status()
+        bundle = EdgeBundle.from_token(self.cipher, response.content)
+        self.bundle, self.etag, self.verified_at = bundle, response.headers.get("ETag"), time.time()
+        self._save_bundle(response.content)
+        logger.info(f"📦 Paquete sin conexión actualizado: {len(bundle.ids)} rostros, "
+                    f"{len(bundle.rules)} usuarios con reglas (versión {bundle.version[:8]})")
+
+    @property
+    def bundle_age(self) -> float:
+        return time.time() - self.verified_at if self.verified_at else float("inf")
+
+    # Cola de decisiones
+
+    def replay(self) -> int:
+        """Envía la cola en lotes; retorna cuántas decisiones se confirmaron"""
+        sent = 0
+        while not self._stop_event.is_set():
+            batch = self.queue.pending(self.batch_size)
+            if not batch:
+                break
+            token = self.cipher.encrypt(json.dumps({"decisiones": batch}).encode())
+            response = self.session.post(f"{self.api_base_url}/edge/decisiones", data=token,
+                                         headers={"Content-Type": "application/octet-stream"}, timeout=30)
+            response.raise_for_status()
+            body = response.json()
+            for rejected in body.get("rechazadas", []):
+                logger.error(f"❌ Decisión {rejected.get('id_local')} rechazada por el servicio: {rejected.get('error')}")
+            done = list(body.get("aceptadas", [])) + [r.get("id_local") for r in body.get("rechazadas", [])]
+            if not done:
+                break
+            self.queue.remove(done)
+            sent += len(done)
+        if sent:
+            logger.info(f"📤 {sent} decisiones sin conexión registradas en el servicio")
+        return sent
+
+    def report_online(self, online: bool):
+        """Lo informa el hilo de verificación según responda el servicio"""
+        if online and not self.online:
+            self._wake.set()
+        self.online = online
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                if time.monotonic() >= self._next_sync:
+                    self.sync_bundle()
+                    self._next_sync = time.monotonic() + self.sync_seconds
+                self.replay()
+                self.online = True
+            except requests.HTTPError as e:
+                # El servicio responde pero no puede (p. ej. sin base de datos)
+                self.online = False
+                logger.warning(f"⚠️ Sincronización sin conexión fallida: {e}")
+            except (requests.ConnectionError, requests.Timeout):
+                self.online = False
+            except (InvalidToken, ValueError) as e:
+                logger.error(f"❌ Paquete sin conexión inválido (¿EDGE_SYNC_KEY distinta del servicio?): {e}")
+
+            if self.bundle is not None and self._warm_model != self.bundle.model:
+                try:
+                    self.embedder.warmup(self.bundle.model)
+                    self._warm_model = self.bundle.model
+                except Exception as e:
+                    logger.warning(f"⚠️ No se pudo precargar {self.bundle.model}: {e}")
+
+            if self.on_status is not None:
+                self.on_status()
+            # Con pendientes o sin servicio se reintenta seguido; si no, hasta la próxima sincronización
+            if len(self.queue) or not self.online:
+                wait = self.replay_seconds
+            else:
+                wait = max(self._next_sync - time.monotonic(), 1.0)
+            self._wake.wait(wait)
+            self._wake.clear()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+
+    def status_text(self) -> str:
+        pending = len(self.queue)
+        if self.bundle is None:
+            return "📴 Sin conexión: SIN COPIA LOCAL"
+        state = "EN LÍNEA" if self.online else "SIN SERVICIO"
+        text = f"📴 Copia local: {len(self.bundle.rules)} usuarios · {state}"
+        return f"{text} · {pending} pendientes" if pending else text
+
+    # Decisión local
+
+    def _context_jpeg(self, frame: np.ndarray) -> str:
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.context_width / width)
+        if scale < 1.0:
+            frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        _, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
+        return base64.b64encode(jpeg).decode('utf-8')
+
+    def decide(self, frame: np.ndarray, box: Optional[Box], point_id: int,
+               local_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Decisión local con el mismo formato que /recognize-face más
+        'offline': True. Las decisiones se encolan para registrarlas;
+        `local_id` es el id_solicitud del envío en línea que falló (el
+        servicio no registra dos veces el mismo id)
+        """
+        bundle = self.bundle
+        if bundle is None or bundle.point_id != point_id:
+            return {"decision": "ERROR", "error": "Servicio no disponible y sin copia local para este punto"}
+        if self.bundle_age > self.max_bundle_age:
+            return {"decision": "ERROR", "error": "Servicio no disponible y la copia local está vencida"}
+        if not self.embedder.available:
+            return {"decision": "ERROR", "error": f"Servicio no disponible y DeepFace no está instalado ({self.embedder.error})"}
+
+        base = {"offline": True, "liveness_ok": None, "faces": []}
+        if box is None:
+            return {**base, "success": False, "decision": "DENEGADO", "confidence": 0.0,
+                    "message": "No se detectó ningún rostro válido para procesar"}
+        x, y, w, h = (int(v) for v in box)
+        roi = frame[max(y, 0):y + h, max(x, 0):x + w]
+        if w < MIN_FACE_SIZE or h < MIN_FACE_SIZE or roi.size == 0 or \
+                cv2.Laplacian(cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY), cv2.CV_64F).var() < MIN_FACE_SHARPNESS:
+            return {**base, "success": False, "decision": "DENEGADO", "confidence": 0.0,
+                    "message": "No se detectó ningún rostro válido para procesar"}
+
+        user_id, confidence = bundle.match(self.embedder.embed(roi, bundle.model))
+        liveness_ok = heuristic_liveness(roi)
+        base["liveness_ok"] = liveness_ok
+        if user_id is None:
+            success, alert_type = False, 3
+            message = f"Persona no registrada intentó acceder (confianza: {confidence:.1%})"
+        elif not liveness_ok:
+            # Sin los modelos del servicio solo se permite si pasa la heurística
+            success, alert_type = False, 2
+            message = f"Falla en detección de vida - Posible foto/video (Usuario: {user_id})"
+        else:
+            success, rule_message, alert_type = bundle.check_rules(user_id)
+            message = rule_message or f"Usuario {user_id} autorizado (confianza: {confidence:.1%})"
+
+        decision = "PERMITIDO" if success else "DENEGADO"
+        self.queue.put({
+            "id_local": local_id or str(uuid.uuid4()),
+            "punto_control_id": point_id,
+            "usuario_id": user_id,
+            "decision": decision,
+            "confianza": confidence,
+            "liveness_ok": liveness_ok,
+            "tipo_alerta_id": alert_type,
+            "detalle": message,
+            "decidido_en": datetime.now().astimezone().isoformat(),
+            "imagen_base64": self._context_jpeg(frame),
+        })
+        self.local_decisions += 1
+        self._wake.set()
+        logger.info(f"📴 Decisión local: {decision} - usuario {user_id} ({confidence:.3f})")
+
+        return {**base, "success": success, "decision": decision, "confidence": confidence,
+                "user_id": user_id if success else None, "user_name": bundle.user_name(user_id),
+                "message": ("✅ " if success else "❌ ") + message,
+                "faces": [{"left": x, "top": y, "right": x + w, "bottom": y + h}]}
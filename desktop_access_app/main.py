@@ -15,9 +15,9 @@ Mejoras visuales:
 import tkinter as tk
 from tkinter import ttk, messagebox
 import cv2
-import requests
-import base64
 import logging
+import os
+import queue
 import threading
 import time
 import json
@@ -26,6 +26,14 @@ from typing import Optional
 import numpy as np
 from PIL import Image, ImageTk
 
+from video_pipeline import CaptureThread, FaceDetectionThread, LatestFrameBuffer, scale_boxes
+from stream_ingest import StreamCapture, open_stream, substream_url
+from camera_config import CameraConfigCache, CameraConfigEvents
+from verification_client import VerificationWorker
+from auto_verify import PresenceTrigger
+from edge_mode import EdgeEngine
+from adaptive_capture import AdaptiveRateController, CaptureProfile, CpuMeter
+
 # Configurar logging con UTF-8
 logging.basicConfig(
     level=logging.INFO,
@@ -52,6 +60,40 @@ COLORS = {
     'border': '#475569',          # Gris oscuro
 }
 
+# Video: el render corre en el hilo principal con after(), la detección a menor ritmo
+DISPLAY_WIDTH = 800           # Ancho del video en pantalla
+RENDER_INTERVAL_MS = 33       # ~30 fps de pantalla
+DETECTION_RATE_HZ = 8         # Detecciones Haar por segundo
+DETECTION_WIDTH = 640         # Ancho de la copia reducida que analiza el detector
+DISPLAY_INTERPOLATION = cv2.INTER_LINEAR  # Vista previa: barata, la calidad solo importa en el frame a verificar
+UI_POLL_INTERVAL_MS = 50      # Resultados de hilos de fondo hacia Tk
+FACE_CROP_UPLOAD = True       # Enviar recorte del rostro + miniatura en lugar del frame completo
+
+# Captura adaptativa (ver adaptive_capture.py): reposo sin rostros, activo con rostro
+ADAPTIVE_CAPTURE = True
+IDLE_AFTER_SECONDS = 5.0      # Sin rostros este tiempo = modo reposo
+ACTIVE_PROFILE = CaptureProfile(1920, 1080, 30, DETECTION_RATE_HZ, RENDER_INTERVAL_MS)
+IDLE_PROFILE = CaptureProfile(640, 480, 10, 3, 100, motion_gate=True)
+
+# Cámaras IP (ver stream_ingest.py)
+STREAM_BACKEND = "ffmpeg"     # ffmpeg | gstreamer | auto
+STREAM_BUFFER_SIZE = 1        # Frames en el buffer del backend
+USE_SUBSTREAM = True          # Detección sobre el sub-stream si la URL lo permite
+
+# Verificación automática: un envío por episodio de presencia
+AUTO_VERIFY_MIN_FACE_RATIO = 0.12   # Ancho mínimo del rostro respecto al frame
+AUTO_VERIFY_MIN_SHARPNESS = 60.0    # Varianza del Laplaciano del recorte
+AUTO_VERIFY_STABLE_FRAMES = 4       # Detecciones seguidas con la caja estable
+AUTO_VERIFY_COOLDOWN_SECONDS = 5.0  # Mínimo entre envíos automáticos
+AUTO_VERIFY_ABSENCE_SECONDS = 1.5   # Sin rostro este tiempo = fin del episodio
+AUTO_RESULT_OVERLAY_SECONDS = 3.0   # Tiempo que se muestra el resultado sobre el video
+
+# Modo sin conexión (ver edge_mode.py)
+EDGE_MODE = "off"                   # off | fallback | local (decisión local opcional)
+EDGE_SYNC_KEY = os.getenv("EDGE_SYNC_KEY", "")  # Misma clave que el servicio
+EDGE_SYNC_SECONDS = 300.0           # Revalidación del paquete del punto
+EDGE_MAX_BUNDLE_AGE_HOURS = 24.0    # Sin revalidar más tiempo, no se decide localmente
+
 class AccessControlAppMejorada:
     def __init__(self, root):
         self.root = root
@@ -78,32 +120,122 @@ class AccessControlAppMejorada:
         
         # API Configuration
         self.api_base_url = "http://localhost:8000"
+        self.dashboard_url = "http://localhost:3000"
+        
+        # Tk solo se toca desde el hilo principal: los hilos de fondo encolan
+        # funciones que process_ui_calls ejecuta
+        self.ui_calls = queue.Queue()
+        
+        # Modo sin conexión: copia local cifrada del punto y cola de decisiones
+        self.edge = None
+        if EDGE_MODE != "off":
+            try:
+                self.edge = EdgeEngine(
+                    self.api_base_url,
+                    EDGE_SYNC_KEY,
+                    self.selected_point,
+                    EDGE_MODE,
+                    sync_seconds=EDGE_SYNC_SECONDS,
+                    max_bundle_age_hours=EDGE_MAX_BUNDLE_AGE_HOURS,
+                    on_status=lambda: self.run_on_ui(self.update_edge_status)
+                )
+            except ValueError as e:
+                logger.warning(f"⚠️ Modo sin conexión deshabilitado (EDGE_SYNC_KEY ausente o inválida): {e}")
+        
+        self.verifier = VerificationWorker(
+            self.api_base_url,
+            self.dashboard_url,
+            dispatch=self.run_on_ui,
+            on_result=self.show_verification_result,
+            crop_upload=FACE_CROP_UPLOAD,
+            edge=self.edge
+        )
+        self.verifier.start()
+        
+        # Configuración de cámaras en caché local, revalidada por ETag y por
+        # los avisos de /events/camaras
+        self.camera_configs = CameraConfigCache(
+            self.verifier.session,
+            self.dashboard_url,
+            on_change=lambda point_id, data: self.run_on_ui(lambda: self.apply_camera_config_change(point_id, data))
+        )
+        self.camera_events = CameraConfigEvents(self.api_base_url, self.camera_configs)
+        self.camera_events.start()
         
         # Configurar interfaz
         self.setup_ui()
         
         # Cargar puntos de control
         self.load_available_points()
+        if self.edge is not None:
+            self.edge.start()
         
         # Variables de control
-        self.video_thread = None
+        self.frame_buffer = None
+        self.capture_thread = None
+        self.detection_thread = None
+        self.detect_buffer = None
+        self.substream_thread = None
+        self.render_job = None
+        self.rendered_sequence = 0
+        self.photo = None
+        self.camera_type = None
+        self.last_stats_update = 0.0
+        self.render_interval_ms = RENDER_INTERVAL_MS
         self.running = True
         
+        # Captura adaptativa y uso de CPU para la barra de estado
+        self.rate_controller = AdaptiveRateController(IDLE_PROFILE, ACTIVE_PROFILE, IDLE_AFTER_SECONDS)
+        self.cpu_meter = CpuMeter()
+        
+        # Verificación automática
+        self.presence_trigger = PresenceTrigger(
+            min_face_ratio=AUTO_VERIFY_MIN_FACE_RATIO,
+            min_sharpness=AUTO_VERIFY_MIN_SHARPNESS,
+            stable_frames=AUTO_VERIFY_STABLE_FRAMES,
+            cooldown_seconds=AUTO_VERIFY_COOLDOWN_SECONDS,
+            absence_seconds=AUTO_VERIFY_ABSENCE_SECONDS
+        )
+        self.trigger_sequence = 0
+        self.pending_auto = False
+        self.auto_overlay = None
+        
         # Configurar cierre
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.root.after(UI_POLL_INTERVAL_MS, self.process_ui_calls)
+    
+    def run_on_ui(self, fn):
+        """Encolar una función para el hilo de la interfaz (seguro desde cualquier hilo)"""
+        self.ui_calls.put(fn)
+    
+    def process_ui_calls(self):
+        """Ejecutar en el hilo principal lo que encolaron los hilos de fondo"""
+        while True:
+            try:
+                fn = self.ui_calls.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                fn()
+            except Exception as e:
+                logger.error(f"Error actualizando la interfaz: {e}")
+        if self.running:
+            self.root.after(UI_POLL_INTERVAL_MS, self.process_ui_calls)
         
     def load_available_points(self):
-        """Cargar puntos de control disponibles"""
+        """Cargar puntos de control disponibles (caché local, revalidada en segundo plano)"""
+        points = self.camera_configs.get_points()
+        if points:
+            self.set_available_points(points)
+            logging.info(f"⚡ Puntos cargados desde caché: {len(points)}")
+            threading.Thread(target=self.refresh_available_points, daemon=True).start()
+            return
+        
         try:
-            response = requests.get("http://localhost:3000/api/puntos-control", timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('success') and data.get('data'):
-                    self.available_points = data['data']
-                    if self.available_points:
-                        self.selected_point = self.available_points[0]['id']
-                        self.update_point_combo()
-                        logging.info(f"✅ Puntos cargados: {len(self.available_points)}")
+            points = self.camera_configs.revalidate_points(timeout=5)
+            if points:
+                self.set_available_points(points)
+                logging.info(f"✅ Puntos cargados: {len(points)}")
         except Exception as e:
             logging.error(f"Error cargando puntos: {e}")
             self.available_points = [
@@ -113,13 +245,49 @@ class AccessControlAppMejorada:
             ]
             self.selected_point = 1
     
+    def refresh_available_points(self):
+        """Revalidar la lista de puntos (hilo de fondo; los cambios llegan por on_change)"""
+        try:
+            self.camera_configs.revalidate_points()
+        except Exception as e:
+            logging.warning(f"No se pudo revalidar la lista de puntos: {e}")
+    
+    def set_available_points(self, points):
+        """Actualizar la lista de puntos conservando el seleccionado si sigue existiendo"""
+        self.available_points = points
+        if not any(p['id'] == self.selected_point for p in points):
+            self.selected_point = points[0]['id']
+            if self.edge is not None:
+                self.edge.set_point(self.selected_point)
+        self.update_point_combo()
+    
+    def apply_camera_config_change(self, point_id, data):
+        """Aplicar un cambio de configuración llegado del dashboard (hilo principal)"""
+        if point_id is None:
+            if data:
+                self.set_available_points(data)
+                logging.info(f"🔄 Lista de puntos actualizada: {len(data)}")
+            return
+        if point_id == self.selected_point and self.is_camera_active:
+            logger.info(f"🔄 Cambió la cámara del punto {point_id}, reiniciando captura")
+            self.stop_camera()
+            self.start_camera()
+    
+    def revalidate_camera_config(self, point_id):
+        """Revalidar la configuración de un punto (hilo de fondo)"""
+        try:
+            self.camera_configs.revalidate(point_id)
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo revalidar la configuración del punto {point_id}: {e}")
+    
     def update_point_combo(self):
         """Actualizar combo de puntos"""
         if hasattr(self, 'point_combo'):
             values = [f"{p['id']} - {p['nombre']}" for p in self.available_points]
             self.point_combo['values'] = values
             if values:
-                self.point_combo.current(0)
+                ids = [p['id'] for p in self.available_points]
+                self.point_combo.current(ids.index(self.selected_point) if self.selected_point in ids else 0)
     
     def setup_ui(self):
         """Configurar interfaz mejorada"""
@@ -270,6 +438,22 @@ class AccessControlAppMejorada:
         )
         self.verify_btn.pack(side='left', padx=5)
         
+        self.auto_verify_var = tk.BooleanVar(value=False)
+        self.auto_verify_check = tk.Checkbutton(
+            button_frame,
+            text="🤖 AUTO",
+            variable=self.auto_verify_var,
+            command=self.on_auto_verify_changed,
+            font=('Segoe UI', 10, 'bold'),
+            fg=COLORS['text_primary'],
+            bg=COLORS['bg_secondary'],
+            selectcolor=COLORS['bg_tertiary'],
+            activebackground=COLORS['bg_secondary'],
+            activeforeground=COLORS['text_primary'],
+            cursor='hand2'
+        )
+        self.auto_verify_check.pack(side='left', padx=5)
+        
         # Frame de video
         video_frame = tk.Frame(parent, bg='black', relief='flat', bd=0)
         video_frame.pack(fill='both', expand=True, padx=20, pady=(0, 20))
@@ -380,6 +564,18 @@ class AccessControlAppMejorada:
         )
         self.db_status.pack(fill='x', pady=4)
         
+        if self.edge is not None:
+            self.edge_status = tk.Label(
+                status_frame,
+                text="📴 Copia local: VERIFICANDO...",
+                font=('Segoe UI', 9),
+                fg=COLORS['accent_yellow'],
+                bg=COLORS['bg_secondary'],
+                anchor='w',
+                justify='left'
+            )
+            self.edge_status.pack(fill='x', pady=4)
+        
         # Verificar servicios
         self.check_services_status()
     
@@ -391,27 +587,42 @@ class AccessControlAppMejorada:
             logging.info(f"Punto cambiado a: {self.selected_point}")
         except:
             pass
+        if self.edge is not None:
+            self.edge.set_point(self.selected_point)
+    
+    def update_edge_status(self):
+        """Estado de la copia local y de la cola de decisiones (hilo principal)"""
+        if self.edge.bundle is None or self.edge.embedder.error:
+            color = COLORS['accent_red']
+        elif self.edge.online:
+            color = COLORS['accent_green']
+        else:
+            color = COLORS['accent_yellow']
+        self.edge_status.config(text=self.edge.status_text(), fg=color)
     
     def check_services_status(self):
         """Verificar estado de servicios"""
+        def set_status(label, text, color):
+            self.run_on_ui(lambda: label.config(text=text, fg=color))
+        
         def check():
             try:
-                response = requests.get(f"{self.api_base_url}/health", timeout=5)
+                response = self.verifier.session.get(f"{self.api_base_url}/health", timeout=5)
                 if response.status_code == 200:
-                    self.api_status.config(text="🤖 API: CONECTADA", fg=COLORS['accent_green'])
+                    set_status(self.api_status, "🤖 API: CONECTADA", COLORS['accent_green'])
                 else:
-                    self.api_status.config(text="🤖 API: ERROR", fg=COLORS['accent_red'])
+                    set_status(self.api_status, "🤖 API: ERROR", COLORS['accent_red'])
             except:
-                self.api_status.config(text="🤖 API: DESCONECTADA", fg=COLORS['accent_red'])
+                set_status(self.api_status, "🤖 API: DESCONECTADA", COLORS['accent_red'])
             
             try:
-                response = requests.get("http://localhost:3000/api/health", timeout=5)
+                response = self.verifier.session.get(f"{self.dashboard_url}/api/health", timeout=5)
                 if response.status_code == 200:
-                    self.db_status.config(text="💾 Base de Datos: CONECTADA", fg=COLORS['accent_green'])
+                    set_status(self.db_status, "💾 Base de Datos: CONECTADA", COLORS['accent_green'])
                 else:
-                    self.db_status.config(text="💾 Base de Datos: ERROR", fg=COLORS['accent_red'])
+                    set_status(self.db_status, "💾 Base de Datos: ERROR", COLORS['accent_red'])
             except:
-                self.db_status.config(text="💾 Base de Datos: DESCONECTADA", fg=COLORS['accent_red'])
+                set_status(self.db_status, "💾 Base de Datos: DESCONECTADA", COLORS['accent_red'])
         
         threading.Thread(target=check, daemon=True).start()
     
@@ -421,25 +632,25 @@ class AccessControlAppMejorada:
             camera_source = None
             camera_type = "USB"
             
-            # Obtener configuración de cámara
+            # Obtener configuración de cámara: la copia en caché arranca al
+            # instante y se revalida en segundo plano (si cambió, se reinicia)
             try:
-                logger.info(f"🔍 Obteniendo configuración para punto {self.selected_point}...")
-                response = requests.get(
-                    f"http://localhost:3000/api/puntos-control/{self.selected_point}/camera",
-                    timeout=2
-                )
+                config = self.camera_configs.get(self.selected_point)
+                if config is not None:
+                    logger.info(f"⚡ Configuración en caché para punto {self.selected_point}")
+                    threading.Thread(target=self.revalidate_camera_config, args=(self.selected_point,), daemon=True).start()
+                else:
+                    logger.info(f"🔍 Obteniendo configuración para punto {self.selected_point}...")
+                    config = self.camera_configs.revalidate(self.selected_point, timeout=2)
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    if data.get('success') and data.get('data'):
-                        config = data['data']
-                        camera_url = config.get('cameraUrl')
-                        stream_type = config.get('streamType', 'USB')
-                        
-                        if camera_url:
-                            camera_source = camera_url
-                            camera_type = stream_type
-                            logger.info(f"✅ Configuración: {stream_type} - {camera_url}")
+                if config:
+                    camera_url = config.get('cameraUrl')
+                    stream_type = config.get('streamType') or 'USB'
+                    
+                    if camera_url:
+                        camera_source = camera_url
+                        camera_type = stream_type
+                        logger.info(f"✅ Configuración: {stream_type} - {camera_url}")
             except Exception as e:
                 logger.warning(f"⚠️ No se pudo obtener config: {e}. Usando USB")
             
@@ -450,8 +661,9 @@ class AccessControlAppMejorada:
             
             logger.info(f"📹 Conectando a: {camera_type}")
             
-            if isinstance(camera_source, str) and not camera_source.isdigit():
-                self.camera = cv2.VideoCapture(camera_source)
+            is_stream = isinstance(camera_source, str) and not camera_source.isdigit()
+            if is_stream:
+                self.camera = open_stream(camera_source, STREAM_BACKEND, STREAM_BUFFER_SIZE)
             else:
                 self.camera = cv2.VideoCapture(int(camera_source))
             
@@ -460,6 +672,7 @@ class AccessControlAppMejorada:
                 
                 if camera_type != "USB":
                     logger.info("🔄 Intentando fallback a USB...")
+                    is_stream = False
                     self.camera = cv2.VideoCapture(0)
                     if not self.camera.isOpened():
                         messagebox.showerror("Error", "No se pudo acceder a ninguna cámara")
@@ -472,15 +685,16 @@ class AccessControlAppMejorada:
             logger.info(f"✅ Cámara {camera_type} conectada")
             
             if camera_type in ["USB", "USB (Fallback)"]:
-                self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
-                self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
-                self.camera.set(cv2.CAP_PROP_FPS, 30)
+                self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, ACTIVE_PROFILE.width)
+                self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, ACTIVE_PROFILE.height)
+                self.camera.set(cv2.CAP_PROP_FPS, ACTIVE_PROFILE.capture_fps)
             
             actual_width = int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH))
             actual_height = int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
             logger.info(f"🎥 Resolución: {actual_width}x{actual_height}")
             
             self.is_camera_active = True
+            self.camera_type = camera_type
             
             self.start_btn.config(state='disabled')
             self.stop_btn.config(state='normal')
@@ -488,8 +702,47 @@ class AccessControlAppMejorada:
             self.status_label.config(text=f"🟢 Activo - {camera_type}", fg=COLORS['accent_green'])
             self.camera_status.config(text=f"📷 Cámara: {camera_type} CONECTADA", fg=COLORS['accent_green'])
             
-            self.video_thread = threading.Thread(target=self.update_video, daemon=True)
-            self.video_thread.start()
+            # Captura y detección en sus hilos; el render lo programa Tk
+            self.frame_buffer = LatestFrameBuffer()
+            if is_stream:
+                # El hilo de ingesta es dueño de la captura y reconecta solo
+                self.capture_thread = StreamCapture(camera_source, self.frame_buffer, STREAM_BACKEND,
+                                                    STREAM_BUFFER_SIZE, capture=self.camera)
+                self.camera = None
+            else:
+                self.capture_thread = CaptureThread(self.camera, self.frame_buffer)
+            
+            sub_url = substream_url(camera_source) if is_stream and USE_SUBSTREAM else None
+            sub_capture = None
+            if sub_url:
+                # La URL del sub-stream se deriva por fabricante y puede no existir:
+                # si no abre a la primera, la detección va sobre el stream principal
+                sub_capture = open_stream(sub_url, STREAM_BACKEND, STREAM_BUFFER_SIZE)
+                if not sub_capture.isOpened():
+                    logger.warning("⚠️ No se pudo abrir el sub-stream, detección sobre el stream principal")
+                    sub_capture.release()
+                    sub_capture = None
+            if sub_capture is not None:
+                # Detección sobre el sub-stream; solo se decodifica al ritmo del detector
+                self.detect_buffer = LatestFrameBuffer()
+                self.substream_thread = StreamCapture(sub_url, self.detect_buffer, STREAM_BACKEND, STREAM_BUFFER_SIZE,
+                                                      decode_fps=DETECTION_RATE_HZ, capture=sub_capture,
+                                                      name="captura-substream")
+                self.detection_thread = FaceDetectionThread(self.detect_buffer, DETECTION_RATE_HZ, DETECTION_WIDTH,
+                                                            frame_buffer=self.frame_buffer)
+                self.substream_thread.start()
+                logger.info("📉 Detección sobre el sub-stream")
+            else:
+                self.detection_thread = FaceDetectionThread(self.frame_buffer, DETECTION_RATE_HZ, DETECTION_WIDTH)
+            self.capture_thread.start()
+            self.detection_thread.start()
+            self.rendered_sequence = 0
+            self.trigger_sequence = 0
+            self.presence_trigger.reset()
+            # Arranca en activo; sin rostros baja a reposo tras IDLE_AFTER_SECONDS
+            self.rate_controller.reset()
+            self.render_interval_ms = ACTIVE_PROFILE.render_interval_ms
+            self.render_job = self.root.after(self.render_interval_ms, self.render_frame)
             
             logging.info(f"Cámara {camera_type} iniciada correctamente")
             
@@ -497,13 +750,33 @@ class AccessControlAppMejorada:
             messagebox.showerror("Error", f"Error al iniciar cámara: {str(e)}")
             logging.error(f"Error: {e}")
     
-    def stop_camera(self):
-        """Detener cámara"""
-        self.is_camera_active = False
+    def release_video_pipeline(self):
+        """Detiene render, detección y captura antes de liberar la cámara"""
+        if self.render_job is not None:
+            self.root.after_cancel(self.render_job)
+            self.render_job = None
+        for worker in (self.detection_thread, self.substream_thread, self.capture_thread):
+            if worker is not None:
+                worker.stop()
+        for buffer in (self.frame_buffer, self.detect_buffer):
+            if buffer is not None:
+                buffer.close()
+        self.detection_thread = None
+        self.substream_thread = None
+        self.capture_thread = None
+        self.frame_buffer = None
+        self.detect_buffer = None
+        self.photo = None
+        self.current_frame = None
         
         if self.camera:
             self.camera.release()
             self.camera = None
+    
+    def stop_camera(self):
+        """Detener cámara"""
+        self.is_camera_active = False
+        self.release_video_pipeline()
         
         self.start_btn.config(state='normal')
         self.stop_btn.config(state='disabled')
@@ -518,134 +791,228 @@ class AccessControlAppMejorada:
         
         logging.info("Cámara detenida")
     
-    def update_video(self):
-        """Actualizar video"""
-        while self.is_camera_active and self.camera:
+    def render_frame(self):
+        """Muestra el último frame capturado (hilo principal, programado con after)"""
+        self.render_job = None
+        if not self.is_camera_active or self.frame_buffer is None:
+            return
+        
+        if self.capture_thread.lost:
+            logger.error("❌ Señal de cámara perdida")
+            self.stop_camera()
+            self.status_label.config(text="🔴 Señal de cámara perdida", fg=COLORS['accent_red'])
+            return
+        
+        item = self.frame_buffer.get()
+        if item is not None and item[0] != self.rendered_sequence:
+            self.rendered_sequence, frame, _ = item
+            self.current_frame = frame
             try:
-                ret, frame = self.camera.read()
-                if not ret:
-                    break
-                
-                height, width = frame.shape[:2]
-                display_width = 800
-                display_height = int(height * display_width / width)
-                display_frame = cv2.resize(frame, (display_width, display_height), interpolation=cv2.INTER_LANCZOS4)
-                
-                face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-                gray = cv2.cvtColor(display_frame, cv2.COLOR_BGR2GRAY)
-                
-                faces = face_cascade.detectMultiScale(
-                    gray,
-                    scaleFactor=1.1,
-                    minNeighbors=5,
-                    minSize=(30, 30),
-                    flags=cv2.CASCADE_SCALE_IMAGE
-                )
-                
-                for (x, y, w, h) in faces:
-                    cv2.rectangle(display_frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
-                    cv2.putText(display_frame, "ROSTRO DETECTADO", (x, y-10),
-                              cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-                
-                if len(faces) > 0:
-                    cv2.putText(display_frame, f"ROSTROS DETECTADOS: {len(faces)}", (10, 30),
-                              cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-                
-                image_rgb = cv2.cvtColor(display_frame, cv2.COLOR_BGR2RGB)
-                image_pil = Image.fromarray(image_rgb)
-                image_tk = ImageTk.PhotoImage(image_pil)
-                
-                self.video_label.config(image=image_tk)
-                self.video_label.image = image_tk
-                
-                self.current_frame = frame
-                
-                time.sleep(0.03)
-                
+                self.show_frame(frame)
             except Exception as e:
                 logging.error(f"Error actualizando video: {e}")
-                break
+        
+        if ADAPTIVE_CAPTURE:
+            _, faces = self.detection_thread.latest()
+            profile = self.rate_controller.update(len(faces) > 0)
+            if profile is not None:
+                self.apply_capture_profile(profile)
+        
+        if self.auto_verify_var.get():
+            self.check_auto_verify()
+        
+        now = time.monotonic()
+        if now - self.last_stats_update >= 1.0:
+            self.last_stats_update = now
+            cpu = self.cpu_meter.sample()
+            if self.capture_thread.connected:
+                mode = f" · {self.rate_controller.mode}" if ADAPTIVE_CAPTURE else ""
+                self.status_label.config(
+                    text=f"🟢 Activo - {self.camera_type}{mode} · captura {self.capture_thread.rate.fps:.0f} fps · "
+                         f"detección {self.detection_thread.rate.fps:.0f} fps · CPU {cpu:.0f}%",
+                    fg=COLORS['accent_green']
+                )
+            else:
+                self.status_label.config(text=f"🟡 Reconectando - {self.camera_type} · CPU {cpu:.0f}%",
+                                         fg=COLORS['accent_yellow'])
+        
+        self.render_job = self.root.after(self.render_interval_ms, self.render_frame)
+    
+    def apply_capture_profile(self, profile):
+        """Lleva captura, detección y render al perfil del modo actual"""
+        logger.info(f"⚙️ Captura en modo {self.rate_controller.mode}")
+        if isinstance(self.capture_thread, StreamCapture):
+            # En cámaras IP la resolución la fija la cámara: se limita la decodificación
+            self.capture_thread.set_decode_fps(profile.capture_fps)
+        else:
+            self.capture_thread.set_profile(profile.width, profile.height, profile.capture_fps)
+        if self.substream_thread is not None:
+            self.substream_thread.set_decode_fps(profile.detection_hz)
+        self.detection_thread.set_rate(profile.detection_hz)
+        self.detection_thread.motion_gate = profile.motion_gate
+        self.render_interval_ms = profile.render_interval_ms
+    
+    def show_frame(self, frame):
+        """Reduce el frame, dibuja los últimos rostros detectados y actualiza el label"""
+        height, width = frame.shape[:2]
+        scale = DISPLAY_WIDTH / width
+        display_frame = cv2.resize(frame, (DISPLAY_WIDTH, int(height * scale)), interpolation=DISPLAY_INTERPOLATION)
+        
+        _, analyzed, faces = self.detection_thread.snapshot()
+        if analyzed is not None and analyzed.shape[:2] != frame.shape[:2]:
+            # Cambio de resolución en curso: las cajas son del frame anterior
+            faces = scale_boxes(faces, analyzed.shape, frame.shape)
+        for face in faces:
+            x, y, w, h = (int(v * scale) for v in face)
+            cv2.rectangle(display_frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
+            cv2.putText(display_frame, "ROSTRO DETECTADO", (x, y-10),
+                      cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+        
+        if len(faces) > 0:
+            cv2.putText(display_frame, f"ROSTROS DETECTADOS: {len(faces)}", (10, 30),
+                      cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+        
+        if self.auto_verify_var.get():
+            overlay_y = display_frame.shape[0] - 20
+            if self.auto_overlay is not None and self.auto_overlay[2] > time.monotonic():
+                text, color, _ = self.auto_overlay
+                cv2.putText(display_frame, text, (10, overlay_y), cv2.FONT_HERSHEY_SIMPLEX, 0.9, color, 2)
+            else:
+                cv2.putText(display_frame, f"AUTO: {self.presence_trigger.status}", (10, overlay_y),
+                          cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 255), 2)
+        
+        image_pil = Image.fromarray(cv2.cvtColor(display_frame, cv2.COLOR_BGR2RGB))
+        # Reutilizar el PhotoImage mientras no cambie el tamaño
+        if self.photo is not None and (self.photo.width(), self.photo.height()) == image_pil.size:
+            self.photo.paste(image_pil)
+        else:
+            self.photo = ImageTk.PhotoImage(image_pil)
+            self.video_label.config(image=self.photo)
+            self.video_label.image = self.photo
+    
+    def on_auto_verify_changed(self):
+        """Activar o desactivar la verificación automática"""
+        self.presence_trigger.reset()
+        self.auto_overlay = None
+        logger.info(f"🤖 Verificación automática {'activada' if self.auto_verify_var.get() else 'desactivada'}")
+    
+    def check_auto_verify(self):
+        """Evalúa el último resultado del detector y envía una verificación si corresponde"""
+        sequence, frame, faces = self.detection_thread.snapshot()
+        if frame is None or sequence == self.trigger_sequence:
+            return
+        self.trigger_sequence = sequence
+        # En reposo la captura está reducida: se espera al perfil activo
+        if ADAPTIVE_CAPTURE and not self.rate_controller.active:
+            return
+        # Recién pasado a activo, los frames analizados pueden ser aún de la
+        # resolución de reposo: no cuentan para el disparo ni se envían
+        if ADAPTIVE_CAPTURE and not self.capture_profile_applied(frame):
+            self.presence_trigger.reset()
+            return
+        
+        box = self.presence_trigger.update(faces, frame)
+        if box is None:
+            return
+        # Si hay una verificación manual en vuelo se reintenta con la próxima detección
+        if self.verifier.submit(frame, self.selected_point, box):
+            self.presence_trigger.mark_submitted()
+            self.pending_auto = True
+            self.verify_btn.config(text="🔄 PROCESANDO...", state='disabled')
+            logger.info("🤖 Verificación automática enviada")
+    
+    def capture_profile_applied(self, frame) -> bool:
+        """El frame ya tiene la resolución del último perfil aplicado (cámaras USB)"""
+        capture = self.capture_thread
+        if not isinstance(capture, CaptureThread):
+            # En cámaras IP el perfil solo cambia los fps decodificados
+            return True
+        if capture.profile_pending:
+            return False
+        return capture.frame_size is None or (frame.shape[1], frame.shape[0]) == capture.frame_size
     
     def verify_access(self):
-        """Verificar acceso"""
+        """Verificar acceso (el envío corre en el hilo de verificación)"""
         if self.current_frame is None:
             messagebox.showwarning("Advertencia", "No hay frame disponible")
             return
         
-        try:
-            # Codificar imagen con calidad alta
-            _, buffer = cv2.imencode('.jpg', self.current_frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
-            image_base64 = base64.b64encode(buffer).decode('utf-8')
-            
-            # Payload correcto para la API
-            payload = {
-                "image_base64": image_base64,
-                "punto_control_id": self.selected_point
-            }
-            
-            logger.info(f"📤 Enviando solicitud de verificación al punto {self.selected_point}...")
-            
-            response = requests.post(
-                f"{self.api_base_url}/recognize-face",
-                json=payload,
-                timeout=10
-            )
-            
-            logger.info(f"📥 Respuesta API: {response.status_code}")
-            
-            if response.status_code == 200:
-                result = response.json()
-                
-                # Procesar resultado
-                decision = result.get('decision', 'ERROR')
-                confidence = result.get('confidence', 0)
-                user_id = result.get('user_id', 'Desconocido')
-                user_name = result.get('user_name', result.get('nombre', 'Desconocido'))
-                
-                # Si no viene el nombre, intentar obtenerlo de la API
-                if user_name == 'Desconocido' and user_id != 'Desconocido':
-                    try:
-                        user_response = requests.get(
-                            f"http://localhost:3000/api/usuarios/{user_id}",
-                            timeout=2
-                        )
-                        if user_response.status_code == 200:
-                            user_data = user_response.json()
-                            if user_data.get('success') and user_data.get('data'):
-                                user_name = user_data['data'].get('nombre', 'Desconocido')
-                                logger.info(f"📝 Nombre obtenido: {user_name}")
-                    except Exception as e:
-                        logger.warning(f"No se pudo obtener nombre del usuario: {e}")
-                
-                timestamp = datetime.now().strftime("%H:%M:%S")
-                
-                if decision == 'PERMITIDO':
-                    self.access_listbox.insert(0, f"[{timestamp}] ✅ {user_name} - {confidence*100:.1f}%")
-                    messagebox.showinfo("✅ Acceso Permitido", f"Usuario: {user_name}\nConfianza: {confidence*100:.1f}%")
-                    logger.info(f"✅ Acceso permitido para {user_name}")
-                elif decision == 'DENEGADO':
-                    self.access_listbox.insert(0, f"[{timestamp}] ❌ Acceso Denegado")
-                    messagebox.showwarning("❌ Acceso Denegado", "No autorizado")
-                    logger.warning(f"❌ Acceso denegado")
-                else:
-                    self.access_listbox.insert(0, f"[{timestamp}] ⚠️ Error: {decision}")
-                    messagebox.showerror("Error", f"Respuesta inválida: {decision}")
-                    logger.error(f"Respuesta inválida: {decision}")
+        # Con rostro detectado se envía el frame que analizó el detector y su
+        # caja (permite el envío recortado); si no, el frame actual completo
+        frame, box = self.current_frame, None
+        if self.detection_thread is not None:
+            _, detected_frame, faces = self.detection_thread.snapshot()
+            if detected_frame is not None and faces:
+                frame, box = detected_frame, max(faces, key=lambda f: f[2] * f[3])
+        
+        # Una sola verificación en vuelo: los clics repetidos se ignoran
+        if not self.verifier.submit(frame, self.selected_point, box):
+            logger.info("⏳ Verificación en curso, se ignora la solicitud")
+            return
+        
+        self.pending_auto = False
+        self.verify_btn.config(text="🔄 PROCESANDO...", state='disabled')
+    
+    def show_verification_result(self, result):
+        """Mostrar el resultado de una verificación (hilo principal)"""
+        self.verify_btn.config(
+            text="✓ VERIFICAR",
+            state='normal' if self.is_camera_active else 'disabled'
+        )
+        # En modo automático no se abren diálogos modales: el resultado va al
+        # historial y se superpone unos segundos en el video
+        auto = self.pending_auto
+        self.pending_auto = False
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        overlay_until = time.monotonic() + AUTO_RESULT_OVERLAY_SECONDS
+        
+        if result.get('error'):
+            logger.error(result['error'])
+            if auto:
+                self.access_listbox.insert(0, f"[{timestamp}] ⚠️ Error de verificación")
+                self.auto_overlay = ("ERROR DE VERIFICACION", (0, 165, 255), overlay_until)
             else:
-                logger.error(f"Error API: {response.status_code} - {response.text}")
-                messagebox.showerror("Error", f"Error en API: {response.status_code}\n{response.text}")
-                
-        except Exception as e:
-            logger.error(f"Error en verificación: {e}")
-            messagebox.showerror("Error", f"Error: {str(e)}")
+                messagebox.showerror("Error", result['error'])
+            return
+        
+        decision = result.get('decision', 'ERROR')
+        confidence = result.get('confidence', 0)
+        user_name = result.get('user_name', 'Desconocido')
+        # Decisiones tomadas en el kiosco sin servicio (se registran al reconectar)
+        offline = " 📴" if result.get('offline') else ""
+        logger.info(f"⏱️ Verificación completada en {result.get('elapsed_ms', 0):.0f} ms")
+        
+        if decision == 'PERMITIDO':
+            self.access_listbox.insert(0, f"[{timestamp}] ✅ {user_name} - {confidence*100:.1f}%{offline}")
+            logger.info(f"✅ Acceso permitido para {user_name}")
+            if auto:
+                self.auto_overlay = (f"PERMITIDO: {user_name}", (0, 255, 0), overlay_until)
+            else:
+                messagebox.showinfo("✅ Acceso Permitido", f"Usuario: {user_name}\nConfianza: {confidence*100:.1f}%")
+        elif decision == 'DENEGADO':
+            self.access_listbox.insert(0, f"[{timestamp}] ❌ Acceso Denegado{offline}")
+            logger.warning(f"❌ Acceso denegado")
+            if auto:
+                self.auto_overlay = ("ACCESO DENEGADO", (0, 0, 255), overlay_until)
+            else:
+                messagebox.showwarning("❌ Acceso Denegado", "No autorizado")
+        else:
+            self.access_listbox.insert(0, f"[{timestamp}] ⚠️ Error: {decision}")
+            logger.error(f"Respuesta inválida: {decision}")
+            if auto:
+                self.auto_overlay = (f"ERROR: {decision}", (0, 165, 255), overlay_until)
+            else:
+                messagebox.showerror("Error", f"Respuesta inválida: {decision}")
     
     def on_closing(self):
         """Cerrar aplicación"""
         self.running = False
         self.is_camera_active = False
-        
-        if self.camera:
-            self.camera.release()
+        self.release_video_pipeline()
+        self.camera_events.stop()
+        self.verifier.stop()
+        if self.edge is not None:
+            self.edge.stop()
         
         self.root.destroy()
 
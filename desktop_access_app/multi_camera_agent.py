@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+Agente sin interfaz para varios puntos de control
+
+Un solo proceso atiende todas las cámaras configuradas en `puntos_control`
+(camera_url / stream_type de los puntos activos, vía /api/puntos-control):
+
+    cámara 1 ──▶ StreamCapture ──▶ LatestFrameBuffer ─┐
+    cámara 2 ──▶ StreamCapture ──▶ LatestFrameBuffer ─┼──▶ pool de detectores ──▶ PresenceTrigger
+    ...                                               ┘         (compartido)          │
+                                                                                      ▼
+                               VerificationWorker por cámara ──▶ Session HTTP compartida ──▶ /recognize-face(-crop)
+
+- Un hilo de captura por stream (stream_ingest.StreamCapture: backend
+  explícito, grab/retrieve y reconexión), que solo conserva el último frame.
+  Si la URL tiene sub-stream, la detección usa el sub-stream y cada rostro se
+  re-detecta en una región del frame principal (los streams no van
+  sincronizados), que es el que se envía a verificar. Si el sub-stream
+  derivado no conecta mientras el principal sí, se detecta sobre el principal.
+- Un pool de `--detector-workers` hilos atiende a todas las cámaras por
+  turnos, ordenados por la próxima detección de cada una: un detector libre
+  toma la cámara que vence primero, y ninguno espera con una cámara tomada.
+  Cada cámara la procesa un solo detector a la vez, a como mucho
+  `--detection-rate` detecciones por segundo.
+- Cada cámara dispara como el modo AUTO de la aplicación de escritorio: una
+  verificación por episodio de presencia, con una sola en vuelo por cámara.
+  Todas las peticiones salen por una Session con un pool de conexiones
+  keep-alive del tamaño del número de cámaras.
+- Cada `--stats-seconds` se registran por cámara los fps de captura y de
+  detección, los frames que la detección descartó y la cola de verificación.
+
+Uso:
+    python multi_camera_agent.py
+    python multi_camera_agent.py --points 1,2,5 --detector-workers 3
+"""
+
+import argparse
+import heapq
+import itertools
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Dict, List, Optional
+
+import requests
+
+from auto_verify import PresenceTrigger
+from verification_client import UserNameCache, VerificationWorker, create_session
+from stream_ingest import STREAM_BACKENDS, StreamCapture, substream_url
+from video_pipeline import FaceDetector, FrameRate, LatestFrameBuffer, scale_boxes
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s',
+    handlers=[
+        logging.FileHandler('multi_camera_agent.log', encoding='utf-8'),
+        logging.StreamHandler()
+    ]
+)
+
+logger = logging.getLogger(__name__)
+
+
+def load_camera_points(session: requests.Session, dashboard_url: str, only: Optional[List[int]] = None) -> List[dict]:
+    """Puntos activos con cámara configurada"""
+    response = session.get(f"{dashboard_url}/api/puntos-control", params={'vista': 'kiosco'}, timeout=10)
+    response.raise_for_status()
+    data = response.json()
+    if not data.get('success'):
+        raise RuntimeError(data.get('error', 'Respuesta inválida de /api/puntos-control'))
+
+    points = []
+    for point in data.get('data') or []:
+        if only and point.get('id') not in only:
+            continue
+        if not point.get('activo', True):
+            continue
+        if not point.get('cameraUrl'):
+            logger.warning(f"⚠️ Punto {point.get('id')} - {point.get('nombre')}: sin camera_url, se omite")
+            continue
+        points.append(point)
+    return sorted(points, key=lambda p: p['id'])
+
+
+class CameraChannel:
+    """Estado de una cámara: captura, disparo por presencia y verificación"""
+
+    def __init__(self, point: dict, trigger: PresenceTrigger, detection_interval: float,
+                 backend: str = "ffmpeg", use_substream: bool = True):
+        self.point_id = point['id']
+        self.name = point.get('nombre') or f"Punto {self.point_id}"
+        self.camera_url = point['cameraUrl']
+        self.stream_type = point.get('streamType') or ('USB' if self.camera_url.isdigit() else 'RTSP')
+        self.worker: Optional[VerificationWorker] = None
+        self.trigger = trigger
+        self.detection_interval = detection_interval
+        self.backend = backend
+        self.substream_url = substream_url(self.camera_url) if use_substream else None
+
+        # `buffer` recibe el stream principal; `detect_buffer` el sub-stream
+        # (o el mismo buffer si no hay)
+        self.buffer: Optional[LatestFrameBuffer] = None
+        self.detect_buffer: Optional[LatestFrameBuffer] = None
+        self.capture: Optional[StreamCapture] = None
+        self.substream: Optional[StreamCapture] = None
+
+        # Solo lo toca el detector que tiene el turno de esta cámara
+        self.detected_sequence = 0
+        self.next_detection = 0.0
+        self.detection_rate = FrameRate()
+        self.skipped_frames = 0
+
+        self.submitted = 0
+        self.results: Dict[str, int] = {}
+        self.latency_ms = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def label(self) -> str:
+        return f"[{self.point_id}] {self.name}"
+
+    def open(self):
+        """Arranca la captura; la conexión y las reconexiones corren en el hilo"""
+        self.buffer = LatestFrameBuffer()
+        self.capture = StreamCapture(self.camera_url, self.buffer, self.backend, name=f"captura-{self.point_id}")
+        self.capture.start()
+        self.detect_buffer = self.buffer
+        if self.substream_url:
+            self.detect_buffer = LatestFrameBuffer()
+            self.substream = StreamCapture(self.substream_url, self.detect_buffer, self.backend,
+                                           decode_fps=1.0 / self.detection_interval, name=f"substream-{self.point_id}")
+            self.substream.start()
+        logger.info(f"📹 {self.label}: {self.stream_type}{' + sub-stream' if self.substream_url else ''}")
+
+    def fallback_to_main_stream(self):
+        """El sub-stream derivado no existe o no responde: detección sobre el principal"""
+        logger.warning(f"⚠️ {self.label}: sub-stream sin conexión, detección sobre el stream principal")
+        substream, self.substream = self.substream, None
+        self.substream_url = None
+        self.detect_buffer = self.buffer
+        self.detected_sequence = 0
+        substream.stop()
+
+    def close(self):
+        for capture in (self.substream, self.capture):
+            if capture is not None:
+                capture.stop()
+        self.capture = self.substream = None
+
+    def on_result(self, result: dict):
+        decision = result.get('decision', 'ERROR')
+        with self._lock:
+            self.results[decision] = self.results.get(decision, 0) + 1
+            elapsed = result.get('elapsed_ms', 0.0)
+            self.latency_ms = elapsed if not self.latency_ms else 0.8 * self.latency_ms + 0.2 * elapsed
+        if decision == 'PERMITIDO':
+            logger.info(f"✅ {self.label}: acceso permitido para {result.get('user_name')} "
+                        f"({result.get('confidence', 0) * 100:.1f}%, {elapsed:.0f} ms)")
+        elif decision == 'DENEGADO':
+            logger.warning(f"❌ {self.label}: acceso denegado ({elapsed:.0f} ms)")
+        else:
+            logger.error(f"⚠️ {self.label}: {result.get('error') or decision}")
+
+    def stats_line(self) -> str:
+        capture_fps = self.capture.rate.fps if self.capture is not None else 0.0
+        with self._lock:
+            results = ", ".join(f"{k.lower()} {v}" for k, v in sorted(self.results.items())) or "sin resultados"
+            latency = self.latency_ms
+        connected = self.capture is not None and self.capture.connected
+        state = "conectada" if connected else f"reconectando, {self.capture.reconnects if self.capture else 0} reconexiones"
+        return (f"📊 {self.label} ({state}): captura {capture_fps:.1f} fps · detección {self.detection_rate.fps:.1f} fps · "
+                f"descartados {self.skipped_frames} · en vuelo {int(self.worker.busy)} · enviados {self.submitted} · "
+                f"rechazados {self.worker.rejected} · {results} · latencia {latency:.0f} ms · {self.trigger.status}")
+
+
+class DetectionSchedule:
+    """
+    Turnos de detección ordenados por `next_detection`. `get` solo entrega una
+    cámara cuando ya le toca: mientras ninguna vence, el detector espera sin
+    retener ninguna, y una cámara devuelta con un vencimiento anterior lo despierta
+    """
+
+    def __init__(self, channels: List[CameraChannel]):
+        self._heap: List[tuple] = []
+        self._order = itertools.count()  # desempate estable entre vencimientos iguales
+        self._condition = threading.Condition()
+        for channel in channels:
+            self.put(channel)
+
+    def put(self, channel: CameraChannel):
+        with self._condition:
+            heapq.heappush(self._heap, (channel.next_detection, next(self._order), channel))
+            self._condition.notify()
+
+    def get(self, timeout: float) -> Optional[CameraChannel]:
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap)[2]
+                if now >= deadline:
+                    return None
+                wait = deadline - now
+                if self._heap:
+                    wait = min(wait, self._heap[0][0] - now)
+                self._condition.wait(wait)
+
+    def due(self) -> int:
+        """Cámaras cuya detección ya venció y esperan un detector libre"""
+        now = time.monotonic()
+        with self._condition:
+            return sum(1 for due_at, _, _ in self._heap if due_at <= now)
+
+
+class DetectorPool:
+    """
+    Hilos de detección compartidos. Las cámaras circulan por DetectionSchedule:
+    el detector que saca una cámara es su único dueño hasta devolverla, así que
+    el estado de detección y el PresenceTrigger de cada cámara no necesitan lock
+    """
+
+    def __init__(self, channels: List[CameraChannel], workers: int, detect_width: int):
+        self.turns = DetectionSchedule(channels)
+        self.detect_width = detect_width
+        self._stop_event = threading.Event()
+        self.threads = [
+            threading.Thread(target=self._run, name=f"detector-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        for thread in self.threads:
+            thread.join(2.0)
+
+    @property
+    def waiting(self) -> int:
+        """Cámaras esperando un detector libre"""
+        return self.turns.due()
+
+    def _run(self):
+        detector = FaceDetector(self.detect_width)
+        while not self._stop_event.is_set():
+            channel = self.turns.get(timeout=0.5)
+            if channel is None:
+                continue
+            try:
+                self._process(channel, detector)
+            except Exception as e:
+                logger.error(f"Error en detección {channel.label}: {e}")
+                # Vuelve al final de los turnos en lugar de reintentarse en el acto
+                channel.next_detection = max(channel.next_detection, time.monotonic() + channel.detection_interval)
+            finally:
+                self.turns.put(channel)
+
+    def _process(self, channel: CameraChannel, detector: FaceDetector):
+        # DetectionSchedule solo entrega la cámara cuando ya le toca
+        substream = channel.substream
+        if (substream is not None and substream.connect_failures and not substream.connected
+                and channel.capture is not None and channel.capture.connected):
+            channel.fallback_to_main_stream()
+
+        buffer = channel.detect_buffer
+        item = buffer.get() if buffer is not None else None
+        if item is None or item[0] == channel.detected_sequence:
+            channel.next_detection = time.monotonic() + 0.01
+            return
+
+        sequence, frame, _ = item
+        if channel.detected_sequence:
+            channel.skipped_frames += max(sequence - channel.detected_sequence - 1, 0)
+        channel.detected_sequence = sequence
+        channel.next_detection = time.monotonic() + channel.detection_interval
+
+        faces = detector.detect(frame)
+        channel.detection_rate.tick()
+        if buffer is not channel.buffer:
+            # Los streams no van sincronizados: las cajas del sub-stream solo
+            # acotan dónde re-detectar en el último frame del principal
+            main = channel.buffer.get()
+            if main is None:
+                return
+            faces = detector.detect_in_regions(main[1], scale_boxes(faces, frame.shape, main[1].shape))
+            frame = main[1]
+
+        box = channel.trigger.update(faces, frame)
+        if box is not None and channel.worker.submit(frame, channel.point_id, box):
+            channel.trigger.mark_submitted()
+            channel.submitted += 1
+            logger.info(f"🤖 {channel.label}: verificación enviada")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Agente multi-cámara sin interfaz")
+    parser.add_argument("--api", default=os.getenv("FACE_API_URL", "http://localhost:8000"), help="URL del servicio de reconocimiento")
+    parser.add_argument("--dashboard", default=os.getenv("DASHBOARD_URL", "http://localhost:3000"), help="URL del dashboard")
+    parser.add_argument("--points", help="IDs de puntos separados por coma (por defecto todos los activos con cámara)")
+    parser.add_argument("--detector-workers", type=int, default=max(1, min(4, (os.cpu_count() or 2) - 1)), help="Hilos de detección compartidos")
+    parser.add_argument("--detection-rate", type=float, default=5.0, help="Detecciones por segundo por cámara")
+    parser.add_argument("--detection-width", type=int, default=640, help="Ancho de la copia reducida que analiza el detector")
+    parser.add_argument("--stats-seconds", type=float, default=30.0, help="Intervalo de estadísticas por cámara")
+    parser.add_argument("--no-crop", action="store_true", help="Enviar el frame completo en lugar del recorte del rostro")
+    parser.add_argument("--backend", choices=STREAM_BACKENDS, default="ffmpeg", help="Backend de captura de los streams")
+    parser.add_argument("--no-substream", action="store_true", help="Detectar sobre el stream principal")
+    args = parser.parse_args()
+
+    only = [int(p) for p in args.points.split(',')] if args.points else None
+
+    # Una Session para todo el proceso: pool keep-alive con una conexión por cámara
+    bootstrap = create_session()
+    points = load_camera_points(bootstrap, args.dashboard, only)
+    bootstrap.close()
+    if not points:
+        logger.error("❌ No hay puntos de control activos con cámara configurada")
+        return 1
+
+    session = create_session(pool_size=len(points) + 2)
+    user_names = UserNameCache(session, args.dashboard)
+    threading.Thread(target=user_names.prefetch, name="precarga-nombres", daemon=True).start()
+
+    channels: List[CameraChannel] = []
+    for point in points:
+        channel = CameraChannel(point, PresenceTrigger(), 1.0 / max(args.detection_rate, 0.1),
+                                backend=args.backend, use_substream=not args.no_substream)
+        # Sin interfaz los resultados se procesan en el mismo hilo de verificación
+        channel.worker = VerificationWorker(args.api, args.dashboard, dispatch=lambda fn: fn(),
+                                            on_result=channel.on_result, crop_upload=not args.no_crop,
+                                            session=session, user_names=user_names)
+        channels.append(channel)
+
+    logger.info(f"🚀 Agente multi-cámara: {len(channels)} cámaras, {args.detector_workers} detectores")
+    for channel in channels:
+        channel.worker.start()
+        channel.open()
+
+    pool = DetectorPool(channels, args.detector_workers, args.detection_width)
+    pool.start()
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+
+    next_stats = time.monotonic() + args.stats_seconds
+    while not stop_event.wait(1.0):
+        if time.monotonic() >= next_stats:
+            next_stats = time.monotonic() + args.stats_seconds
+            logger.info(f"📊 Cámaras esperando detector: {pool.waiting}/{len(channels)}")
+            for channel in channels:
+                logger.info(channel.stats_line())
+
+    logger.info("🛑 Deteniendo agente...")
+    pool.stop()
+    for channel in channels:
+        channel.close()
+        channel.worker.stop()
+    session.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
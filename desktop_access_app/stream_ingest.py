@@ -0,0 +1,183 @@
+"""
+Ingesta de streams de cámaras IP (RTSP / MJPEG por HTTP)
+
+`cv2.VideoCapture(url)` con `read()` acumula retraso en RTSP: si el
+consumidor va más lento que la cámara, los frames se encolan en el buffer del
+backend y lo que se analiza es cada vez más viejo. `StreamCapture`:
+
+- abre el stream con backend explícito: FFmpeg (RTSP por TCP, sin buffer,
+  aceleración por hardware si OpenCV la soporta) o GStreamer (decodebin elige
+  decodificador por hardware; appsink con drop=true y max-buffers=1)
+- fija `CAP_PROP_BUFFERSIZE` (1 por defecto)
+- separa grab/retrieve: hace `grab()` de todos los frames para vaciar el
+  buffer, pero solo `retrieve()` (conversión de color y copia) hasta
+  `decode_fps` por segundo; los frames salteados nunca se convierten
+- reconecta con espera exponencial (con jitter) en lugar de dar la cámara por
+  perdida
+
+`substream_url` deriva el sub-stream de baja resolución (Hikvision canal
+x02, Dahua subtype=1) para que la detección no tenga que procesar el stream
+principal, que solo se usa para los frames que se envían a verificar.
+"""
+
+import logging
+import os
+import random
+import re
+import threading
+import time
+from typing import Optional
+
+import cv2
+
+from video_pipeline import FrameRate, LatestFrameBuffer
+
+logger = logging.getLogger(__name__)
+
+STREAM_BACKENDS = ("ffmpeg", "gstreamer", "auto")
+
+MAX_GRAB_FAILURES = 30         # grab() fallidos seguidos antes de reconectar
+RECONNECT_INITIAL_SECONDS = 1.0
+RECONNECT_MAX_SECONDS = 30.0
+
+# Opciones de FFmpeg para RTSP de baja latencia (OpenCV las lee al abrir)
+FFMPEG_CAPTURE_OPTIONS = "rtsp_transport;tcp|fflags;nobuffer|flags;low_delay|max_delay;500000"
+
+
+def is_local_camera(url: str) -> bool:
+    return str(url).isdigit()
+
+
+def substream_url(url: str) -> Optional[str]:
+    """URL del sub-stream de baja resolución, o None si no se reconoce el fabricante"""
+    hikvision = re.search(r"(/Streaming/Channels/\d*?)01(\b|$)", url, re.IGNORECASE)
+    if hikvision:
+        return url[:hikvision.start()] + hikvision.group(1) + "02" + url[hikvision.end(1) + 2:]
+    if re.search(r"subtype=0\b", url):
+        return re.sub(r"subtype=0\b", "subtype=1", url)
+    return None
+
+
+def gstreamer_pipeline(url: str, latency_ms: int = 0) -> str:
+    """Pipeline de GStreamer que entrega BGR y descarta frames viejos"""
+    sink = "videoconvert ! video/x-raw,format=BGR ! appsink drop=true max-buffers=1 sync=false"
+    if url.lower().startswith("rtsp"):
+        return f"rtspsrc location={url} latency={latency_ms} protocols=tcp ! decodebin ! {sink}"
+    # MJPEG por HTTP
+    return f"souphttpsrc location={url} is-live=true ! multipartdemux ! jpegdec ! {sink}"
+
+
+def open_stream(url: str, backend: str = "ffmpeg", buffer_size: int = 1, hw_accel: bool = True) -> cv2.VideoCapture:
+    """Abre una cámara local (índice) o un stream con el backend indicado"""
+    if is_local_camera(url):
+        capture = cv2.VideoCapture(int(url))
+    elif backend == "gstreamer":
+        capture = cv2.VideoCapture(gstreamer_pipeline(url), cv2.CAP_GSTREAMER)
+    elif backend == "ffmpeg":
+        os.environ.setdefault("OPENCV_FFMPEG_CAPTURE_OPTIONS", FFMPEG_CAPTURE_OPTIONS)
+        params = []
+        if hw_accel and hasattr(cv2, "VIDEO_ACCELERATION_ANY"):
+            params = [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+        capture = cv2.VideoCapture(url, cv2.CAP_FFMPEG, params)
+    else:
+        capture = cv2.VideoCapture(url)
+
+    if capture.isOpened():
+        # No todos los backends lo respetan; con FFmpeg/V4L2 sí
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, buffer_size)
+    return capture
+
+
+class StreamCapture(threading.Thread):
+    """
+    Hilo de captura con grab/retrieve separados y reconexión. Misma interfaz
+    que video_pipeline.CaptureThread (`rate`, `lost`, `connected`, `stop`);
+    `lost` nunca se activa porque el hilo reconecta solo
+    """
+
+    def __init__(self, url: str, buffer: LatestFrameBuffer, backend: str = "ffmpeg", buffer_size: int = 1,
+                 decode_fps: float = 0.0, capture: Optional[cv2.VideoCapture] = None, name: str = "captura-stream"):
+        super().__init__(name=name, daemon=True)
+        self.url = url
+        self.buffer = buffer
+        self.backend = backend
+        self.buffer_size = buffer_size
+        self.decode_interval = 1.0 / decode_fps if decode_fps > 0 else 0.0
+        self.capture = capture
+        self.rate = FrameRate()        # frames decodificados
+        self.grab_rate = FrameRate()   # frames recibidos
+        self.skipped = 0
+        self.reconnects = 0
+        self.connect_failures = 0      # intentos de conexión fallidos (sin contar los exitosos)
+        self.lost = False
+        self.connected = capture is not None and capture.isOpened()
+        self._stop_event = threading.Event()
+
+    def set_decode_fps(self, decode_fps: float):
+        """Cambia en marcha el máximo de frames decodificados (0 = todos)"""
+        self.decode_interval = 1.0 / decode_fps if decode_fps > 0 else 0.0
+
+    @property
+    def safe_url(self) -> str:
+        """URL sin credenciales para los logs"""
+        return re.sub(r"//[^/@]+@", "//***@", self.url)
+
+    def _connect(self, delay: float) -> float:
+        """Intenta abrir el stream; retorna la próxima espera si falla"""
+        self.capture = open_stream(self.url, self.backend, self.buffer_size)
+        if self.capture.isOpened():
+            logger.info(f"✅ Stream conectado ({self.backend}): {self.safe_url}")
+            self.connected = True
+            return RECONNECT_INITIAL_SECONDS
+        self.capture.release()
+        self.capture = None
+        self.connect_failures += 1
+        wait = delay * random.uniform(0.8, 1.2)
+        logger.warning(f"⚠️ No se pudo abrir {self.safe_url}, reintento en {wait:.1f} s")
+        self._stop_event.wait(wait)
+        return min(delay * 2, RECONNECT_MAX_SECONDS)
+
+    def run(self):
+        delay = RECONNECT_INITIAL_SECONDS
+        failures = 0
+        next_decode = 0.0
+        while not self._stop_event.is_set():
+            if self.capture is None:
+                delay = self._connect(delay)
+                failures = 0
+                continue
+
+            if not self.capture.grab():
+                failures += 1
+                if failures >= MAX_GRAB_FAILURES:
+                    logger.error(f"❌ Stream sin frames, reconectando: {self.safe_url}")
+                    self.connected = False
+                    self.capture.release()
+                    self.capture = None
+                    self.reconnects += 1
+                    continue
+                time.sleep(0.01)
+                continue
+            failures = 0
+            self.grab_rate.tick()
+
+            now = time.perf_counter()
+            if now < next_decode:
+                self.skipped += 1
+                continue
+            ok, frame = self.capture.retrieve()
+            if not ok:
+                continue
+            next_decode = now + self.decode_interval
+            self.rate.tick()
+            self.buffer.put(frame)
+
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+        self.buffer.close()
+
+    def stop(self, timeout: float = 2.0):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,282 @@
+"""
+Verificación asíncrona contra el servicio de reconocimiento
+
+La codificación JPEG, el base64 y el POST a /recognize-face corren en un hilo
+propio; el hilo de Tk nunca espera la respuesta. Hay como máximo una
+verificación en vuelo por punto de control: mientras hay una pendiente,
+`submit` rechaza las nuevas en lugar de encolarlas. Los resultados vuelven
+al hilo de la interfaz con la función `dispatch` que recibe el worker.
+
+Las peticiones reutilizan una `requests.Session` (conexiones keep-alive) y
+los nombres de usuario salen de una caché en lugar de un GET a
+/api/usuarios/{id} tras cada acceso permitido.
+
+Con `crop_upload` y una caja de rostro conocida, en lugar del frame completo
+en base64 se envía a /recognize-face-crop (multipart) el recorte del rostro
+con margen a resolución completa más una miniatura del frame como evidencia;
+el servicio usa la caja y no corre su propia detección.
+
+Con un `EdgeEngine` (edge_mode.py) la decisión se toma en el kiosco cuando no
+se puede conectar con el servicio (modo "fallback") o siempre (modo "local").
+Un error del servicio (5xx) o un timeout de lectura no activan la decisión
+local: se mantiene la política del servicio de denegar ante errores. Cada
+envío lleva un `id_solicitud` que la decisión local reutiliza: si el servicio
+llegó a registrar el acceso, el reenvío de la cola no lo duplica.
+"""
+
+import base64
+import logging
+import queue
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+Box = Tuple[int, int, int, int]
+
+
+def crop_face(frame: np.ndarray, box: Box, padding: float) -> Tuple[np.ndarray, Box, Tuple[int, int]]:
+    """
+    Recorte del rostro con `padding` (fracción del tamaño de la caja) por
+    lado. Retorna (recorte, caja dentro del recorte, origen del recorte)
+    """
+    height, width = frame.shape[:2]
+    x, y, w, h = box
+    pad_x, pad_y = int(w * padding), int(h * padding)
+    x0, y0 = max(x - pad_x, 0), max(y - pad_y, 0)
+    x1, y1 = min(x + w + pad_x, width), min(y + h + pad_y, height)
+    return frame[y0:y1, x0:x1], (x - x0, y - y0, w, h), (x0, y0)
+
+
+def create_session(pool_size: int = 2) -> requests.Session:
+    """Session con un pool pequeño de conexiones persistentes"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class UserNameCache:
+    """
+    Nombres de usuario por id. Se precarga con /api/usuarios y solo consulta
+    /api/usuarios/{id} para ids desconocidos o vencidos (`ttl_seconds`)
+    """
+
+    def __init__(self, session: requests.Session, dashboard_url: str, ttl_seconds: float = 600.0):
+        self.session = session
+        self.dashboard_url = dashboard_url
+        self.ttl_seconds = ttl_seconds
+        self._names: Dict[int, Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def _store(self, user_id: int, name: str):
+        with self._lock:
+            self._names[int(user_id)] = (name, time.monotonic() + self.ttl_seconds)
+
+    def prefetch(self, limit: int = 1000):
+        """Carga de una vez los usuarios activos (se llama en segundo plano)"""
+        try:
+            response = self.session.get(f"{self.dashboard_url}/api/usuarios",
+                                        params={"activo": "true", "limit": limit}, timeout=10)
+            if response.status_code == 200:
+                data = response.json()
+                for user in data.get('data') or []:
+                    if user.get('id') is not None and user.get('nombre'):
+                        self._store(user['id'], user['nombre'])
+                logger.info(f"📝 Caché de nombres precargada: {len(self._names)} usuarios")
+        except Exception as e:
+            logger.warning(f"No se pudo precargar nombres de usuario: {e}")
+
+    def get(self, user_id) -> Optional[str]:
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        with self._lock:
+            cached = self._names.get(user_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+
+        try:
+            response = self.session.get(f"{self.dashboard_url}/api/usuarios/{user_id}", timeout=2)
+            if response.status_code == 200:
+                data = response.json()
+                if data.get('success') and data.get('data'):
+                    name = data['data'].get('nombre')
+                    if name:
+                        self._store(user_id, name)
+                        logger.info(f"📝 Nombre obtenido: {name}")
+                        return name
+        except Exception as e:
+            logger.warning(f"No se pudo obtener nombre del usuario: {e}")
+        # Si la consulta falla se conserva el nombre vencido
+        return cached[0] if cached else None
+
+
+class VerificationWorker:
+    """
+    Hilo de verificación con una sola petición en vuelo. `on_result(result)`
+    se ejecuta en el hilo de la interfaz mediante `dispatch`; `result` es la
+    respuesta de /recognize-face más 'user_name', 'elapsed_ms', 'offline' si
+    la decidió el kiosco (`edge`) y, si falló, 'error'
+    """
+
+    def __init__(self, api_base_url: str, dashboard_url: str, dispatch: Callable[[Callable[[], None]], None],
+                 on_result: Callable[[Dict[str, Any]], None], jpeg_quality: int = 95, timeout: float = 10.0,
+                 crop_upload: bool = False, crop_padding: float = 0.4, context_width: int = 480,
+                 context_jpeg_quality: int = 80, session: Optional[requests.Session] = None,
+                 user_names: Optional[UserNameCache] = None, edge=None):
+        self.api_base_url = api_base_url
+        self.dispatch = dispatch
+        self.on_result = on_result
+        self.jpeg_quality = jpeg_quality
+        self.timeout = timeout
+        self.crop_upload = crop_upload
+        self.crop_padding = crop_padding
+        self.context_width = context_width
+        self.context_jpeg_quality = context_jpeg_quality
+        # Varios workers pueden compartir session (pool de conexiones) y caché de nombres
+        self._owns_session = session is None
+        self.session = session or create_session()
+        self.user_names = user_names or UserNameCache(self.session, dashboard_url)
+        self._prefetch_names = user_names is None
+        self.edge = edge
+        self.rejected = 0
+        self._busy = False
+        self._lock = threading.Lock()
+        self._jobs: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="verificacion", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        if self._prefetch_names:
+            threading.Thread(target=self.user_names.prefetch, name="precarga-nombres", daemon=True).start()
+
+    @property
+    def busy(self) -> bool:
+        return self._busy
+
+    def submit(self, frame: np.ndarray, punto_control_id: int, box: Optional[Box] = None) -> bool:
+        """
+        Encola una verificación; False si ya hay una en vuelo. `box` es la
+        caja (x, y, w, h) del rostro en `frame` para el envío recortado
+        """
+        with self._lock:
+            if self._busy:
+                self.rejected += 1
+                return False
+            self._busy = True
+        self._jobs.put((frame, punto_control_id, box, time.perf_counter()))
+        return True
+
+    def stop(self):
+        self._jobs.put(None)
+        if self._owns_session:
+            self.session.close()
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            result = self._verify(*job)
+            self.dispatch(lambda result=result: self._deliver(result))
+
+    def _deliver(self, result: Dict[str, Any]):
+        # En el hilo de la interfaz: se libera el turno antes de mostrar el resultado
+        with self._lock:
+            self._busy = False
+        self.on_result(result)
+
+    def _post_frame(self, frame: np.ndarray, punto_control_id: int, request_id: str) -> requests.Response:
+        _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        payload = {
+            "image_base64": base64.b64encode(buffer).decode('utf-8'),
+            "punto_control_id": punto_control_id,
+            "id_solicitud": request_id
+        }
+        logger.info(f"📤 Enviando solicitud de verificación al punto {punto_control_id} ({len(payload['image_base64']) // 1024} KB)...")
+        return self.session.post(f"{self.api_base_url}/recognize-face", json=payload, timeout=self.timeout)
+
+    def _post_crop(self, frame: np.ndarray, punto_control_id: int, box: Box, request_id: str) -> requests.Response:
+        crop, crop_box, origin = crop_face(frame, box, self.crop_padding)
+        _, face_jpeg = cv2.imencode('.jpg', crop, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.context_width / width)
+        context = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA) if scale < 1.0 else frame
+        _, context_jpeg = cv2.imencode('.jpg', context, [cv2.IMWRITE_JPEG_QUALITY, self.context_jpeg_quality])
+
+        files = {
+            "face": ("rostro.jpg", face_jpeg.tobytes(), "image/jpeg"),
+            "context": ("contexto.jpg", context_jpeg.tobytes(), "image/jpeg")
+        }
+        data = {
+            "punto_control_id": str(punto_control_id),
+            "box": ",".join(str(int(v)) for v in crop_box),
+            "crop_origin": f"{origin[0]},{origin[1]}",
+            "id_solicitud": request_id
+        }
+        logger.info(f"📤 Enviando recorte del rostro al punto {punto_control_id} "
+                    f"({(len(face_jpeg) + len(context_jpeg)) // 1024} KB)...")
+        return self.session.post(f"{self.api_base_url}/recognize-face-crop", files=files, data=data, timeout=self.timeout)
+
+    def _verify_local(self, frame: np.ndarray, punto_control_id: int, box: Optional[Box], started: float,
+                      reason: str, request_id: Optional[str] = None) -> Dict[str, Any]:
+        logger.warning(f"📴 Decisión en el kiosco ({reason})")
+        try:
+            result = self.edge.decide(frame, box, punto_control_id, local_id=request_id)
+        except Exception as e:
+            logger.error(f"Error en decisión local: {e}")
+            result = {"decision": "ERROR", "error": f"Error en decisión local: {str(e)}"}
+        result['user_name'] = result.get('user_name') or 'Desconocido'
+        result['elapsed_ms'] = (time.perf_counter() - started) * 1000
+        return result
+
+    def _verify(self, frame: np.ndarray, punto_control_id: int, box: Optional[Box], started: float) -> Dict[str, Any]:
+        if self.edge is not None and self.edge.mode == "local":
+            return self._verify_local(frame, punto_control_id, box, started, "modo local")
+        request_id = str(uuid.uuid4())
+        try:
+            if self.crop_upload and box is not None:
+                response = self._post_crop(frame, punto_control_id, box, request_id)
+                if response.status_code == 404:
+                    # Servicio sin /recognize-face-crop: se vuelve al frame completo
+                    logger.warning("⚠️ El servicio no acepta recortes, se envía el frame completo")
+                    self.crop_upload = False
+                    response = self._post_frame(frame, punto_control_id, request_id)
+            else:
+                response = self._post_frame(frame, punto_control_id, request_id)
+            logger.info(f"📥 Respuesta API: {response.status_code}")
+
+            if response.status_code != 200:
+                return {"decision": "ERROR", "error": f"Error en API: {response.status_code}\n{response.text}",
+                        "elapsed_ms": (time.perf_counter() - started) * 1000}
+
+            result = response.json()
+            user_name = result.get('user_name', result.get('nombre'))
+            if not user_name and result.get('user_id') is not None:
+                user_name = self.user_names.get(result['user_id'])
+            result['user_name'] = user_name or 'Desconocido'
+            result['elapsed_ms'] = (time.perf_counter() - started) * 1000
+            if self.edge is not None:
+                self.edge.report_online(True)
+            return result
+        except requests.ConnectionError as e:
+            # Incluye ConnectTimeout; un ReadTimeout no (el servicio pudo registrar el acceso)
+            if self.edge is None:
+                logger.error(f"Error en verificación: {e}")
+                return {"decision": "ERROR", "error": f"Error: {str(e)}", "elapsed_ms": (time.perf_counter() - started) * 1000}
+            self.edge.report_online(False)
+            return self._verify_local(frame, punto_control_id, box, started, "servicio no disponible", request_id)
+        except Exception as e:
+            logger.error(f"Error en verificación: {e}")
+            return {"decision": "ERROR", "error": f"Error: {str(e)}", "elapsed_ms": (time.perf_counter() - started) * 1000}
@@ -0,0 +1,335 @@
+"""
+Pipeline de video del punto de control
+
+    cámara ──▶ CaptureThread ──▶ LatestFrameBuffer ──┬──▶ render (Tk after, hilo principal)
+                                                     └──▶ FaceDetectionThread (menor frecuencia)
+
+- La captura solo lee frames y deja el último en un buffer de un hueco: si
+  el render o la detección van lentos se descartan frames viejos en lugar de
+  acumular retraso.
+- La detección Haar corre a su propio ritmo sobre una copia reducida y
+  publica los rostros en coordenadas del frame completo. Con sub-stream, sus
+  cajas solo acotan la búsqueda: el rostro se re-detecta en el frame
+  principal, porque los dos streams no llegan sincronizados.
+- Tk solo se toca desde el hilo principal (ver AccessControlAppMejorada.render_frame),
+  así los fps de pantalla no dependen del costo de la detección.
+- Los ritmos de captura y detección se ajustan en marcha (`set_profile`,
+  `set_rate`, `motion_gate`) según el modo de adaptive_capture.py.
+"""
+
+import logging
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Lecturas fallidas seguidas antes de dar la cámara por perdida (~1 s a 30 fps)
+MAX_READ_FAILURES = 30
+
+# Filtro de movimiento de la detección (ver FaceDetectionThread.motion_gate)
+MOTION_THUMB_SIZE = (64, 48)     # Miniatura en grises que se compara
+MOTION_THRESHOLD = 4.0           # Diferencia media (0-255) que cuenta como movimiento
+MOTION_RECHECK_SECONDS = 2.0     # Detección forzada aunque la escena no cambie
+
+# Margen (fracción del ancho/alto de la caja, por lado) de la región del frame
+# principal donde se re-detecta un rostro hallado en el sub-stream
+ROI_PADDING = 0.5
+
+
+class FrameRate:
+    """Frames por segundo con media móvil exponencial"""
+
+    def __init__(self, smoothing: float = 0.9):
+        self.smoothing = smoothing
+        self.fps = 0.0
+        self._last: Optional[float] = None
+
+    def tick(self):
+        now = time.perf_counter()
+        if self._last is not None and now > self._last:
+            instant = 1.0 / (now - self._last)
+            self.fps = instant if not self.fps else self.smoothing * self.fps + (1 - self.smoothing) * instant
+        self._last = now
+
+
+class LatestFrameBuffer:
+    """
+    Buffer de un solo hueco. `put` sobrescribe el frame anterior; `get`
+    retorna (secuencia, frame, instante) del último, y con `after` espera uno
+    más nuevo que esa secuencia
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._frame: Optional[np.ndarray] = None
+        self._timestamp = 0.0
+        self._sequence = 0
+        self.closed = False
+
+    def put(self, frame: np.ndarray):
+        with self._condition:
+            self._frame = frame
+            self._timestamp = time.monotonic()
+            self._sequence += 1
+            self._condition.notify_all()
+
+    def get(self, after: Optional[int] = None, timeout: Optional[float] = None) -> Optional[Tuple[int, np.ndarray, float]]:
+        with self._condition:
+            if after is not None:
+                self._condition.wait_for(lambda: self._sequence > after or self.closed, timeout)
+            if self._frame is None or (after is not None and self._sequence <= after):
+                return None
+            return self._sequence, self._frame, self._timestamp
+
+    @property
+    def sequence(self) -> int:
+        return self._sequence
+
+    def close(self):
+        """Despierta a los consumidores que esperan un frame"""
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class CaptureThread(threading.Thread):
+    """
+    Lee la cámara y publica cada frame en el buffer. Con `max_fps` hace
+    `grab()` de todos los frames (el driver no acumula retraso) pero solo
+    `retrieve()` hasta `max_fps` por segundo. `set_profile` cambia resolución
+    y fps; se aplica desde este hilo, porque VideoCapture no es seguro entre hilos
+    """
+
+    def __init__(self, camera: cv2.VideoCapture, buffer: LatestFrameBuffer, max_fps: float = 0.0):
+        super().__init__(name="captura-video", daemon=True)
+        self.camera = camera
+        self.buffer = buffer
+        self.decode_interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.rate = FrameRate()
+        self.lost = False
+        self.connected = True
+        # Resolución (ancho, alto) que confirmó el driver con el último perfil
+        self.frame_size: Optional[Tuple[int, int]] = None
+        self._pending_profile: Optional[Tuple[int, int, float]] = None
+        self._stop_event = threading.Event()
+
+    def set_profile(self, width: int, height: int, fps: float):
+        self._pending_profile = (width, height, fps)
+
+    @property
+    def profile_pending(self) -> bool:
+        """Hay un perfil pedido que el hilo de captura aún no aplicó"""
+        return self._pending_profile is not None
+
+    def _apply_profile(self):
+        width, height, fps = self._pending_profile
+        self._pending_profile = None
+        self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        if fps > 0:
+            self.camera.set(cv2.CAP_PROP_FPS, fps)
+        # Si el driver no baja los fps, se limitan los frames decodificados
+        self.decode_interval = 1.0 / fps if fps > 0 else 0.0
+        actual_width = int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH))
+        actual_height = int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.frame_size = (actual_width, actual_height)
+        logger.info(f"🎥 Captura ajustada a {actual_width}x{actual_height} @ {fps:.0f} fps")
+
+    def run(self):
+        failures = 0
+        next_decode = 0.0
+        while not self._stop_event.is_set():
+            if self._pending_profile is not None:
+                self._apply_profile()
+            if not self.camera.grab():
+                failures += 1
+                if failures >= MAX_READ_FAILURES:
+                    logger.error("❌ La cámara dejó de entregar frames")
+                    self.lost = True
+                    self.connected = False
+                    break
+                time.sleep(0.01)
+                continue
+            failures = 0
+            now = time.perf_counter()
+            if now < next_decode:
+                continue
+            ret, frame = self.camera.retrieve()
+            if not ret:
+                continue
+            next_decode = now + self.decode_interval
+            self.rate.tick()
+            self.buffer.put(frame)
+        self.buffer.close()
+
+    def stop(self, timeout: float = 2.0):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
+def scale_boxes(faces: List[Tuple[int, int, int, int]], source_shape, target_shape) -> List[Tuple[int, int, int, int]]:
+    """Lleva cajas (x, y, w, h) de un frame a otro de distinta resolución (sub-stream -> principal)"""
+    sx = target_shape[1] / source_shape[1]
+    sy = target_shape[0] / source_shape[0]
+    return [(int(x * sx), int(y * sy), int(w * sx), int(h * sy)) for x, y, w, h in faces]
+
+
+class FaceDetector:
+    """
+    Detector Haar sobre una copia reducida a `detect_width` px; retorna cajas
+    (x, y, w, h) en coordenadas del frame completo. El clasificador no es
+    seguro entre hilos: cada hilo usa su propio FaceDetector
+    """
+
+    def __init__(self, detect_width: int = 640):
+        self.detect_width = detect_width
+        self.cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+
+    def detect(self, frame: np.ndarray) -> List[Tuple[int, int, int, int]]:
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.detect_width / width)
+        small = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA) if scale < 1.0 else frame
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        faces = self.cascade.detectMultiScale(
+            gray,
+            scaleFactor=1.1,
+            minNeighbors=5,
+            minSize=(30, 30),
+            flags=cv2.CASCADE_SCALE_IMAGE
+        )
+        return [tuple(int(round(v / scale)) for v in face) for face in faces]
+
+    def detect_in_regions(self, frame: np.ndarray, boxes: List[Tuple[int, int, int, int]],
+                          padding: float = ROI_PADDING) -> List[Tuple[int, int, int, int]]:
+        """
+        Re-detecta cada caja (ya escalada a `frame`) dentro de una región
+        ampliada en `padding`. Las cajas de otro stream son de otro instante:
+        si la persona ya no está en la región, la caja se descarta en lugar de
+        publicarse desplazada
+        """
+        height, width = frame.shape[:2]
+        confirmed: List[Tuple[int, int, int, int]] = []
+        for x, y, w, h in boxes:
+            pad_x, pad_y = int(w * padding), int(h * padding)
+            x0, y0 = max(0, x - pad_x), max(0, y - pad_y)
+            x1, y1 = min(width, x + w + pad_x), min(height, y + h + pad_y)
+            if x1 <= x0 or y1 <= y0:
+                continue
+            found = self.detect(frame[y0:y1, x0:x1])
+            if not found:
+                continue
+            fx, fy, fw, fh = max(found, key=lambda face: face[2] * face[3])
+            face = (x0 + fx, y0 + fy, fw, fh)
+            # Regiones solapadas pueden hallar el mismo rostro
+            cx, cy = face[0] + fw // 2, face[1] + fh // 2
+            if any(bx <= cx < bx + bw and by <= cy < by + bh for bx, by, bw, bh in confirmed):
+                continue
+            confirmed.append(face)
+        return confirmed
+
+
+class FaceDetectionThread(threading.Thread):
+    """
+    Detección Haar a `rate_hz` como máximo sobre el último frame reducido a
+    `detect_width` px. `faces` son (x, y, w, h) en coordenadas del frame completo.
+    Con `frame_buffer` se detecta sobre `buffer` (sub-stream de baja
+    resolución) y cada rostro se re-detecta en una región ampliada del último
+    frame de `frame_buffer` (stream principal), que es el que se publica como
+    frame analizado: los streams no van sincronizados y escalar las cajas sin
+    más las dejaría desplazadas si la persona se movió.
+    Con `motion_gate` (modo reposo) se salta la detección mientras la escena
+    no cambia y no había rostros, salvo cada MOTION_RECHECK_SECONDS
+    """
+
+    def __init__(self, buffer: LatestFrameBuffer, rate_hz: float = 8.0, detect_width: int = 640,
+                 frame_buffer: Optional[LatestFrameBuffer] = None):
+        super().__init__(name="deteccion-rostros", daemon=True)
+        self.buffer = buffer
+        self.frame_buffer = frame_buffer
+        self.interval = 1.0 / rate_hz if rate_hz > 0 else 0.0
+        # Un solo clasificador para todo el hilo (antes se creaba uno por frame)
+        self.detector = FaceDetector(detect_width)
+        self.rate = FrameRate()
+        self.faces: List[Tuple[int, int, int, int]] = []
+        self.frame: Optional[np.ndarray] = None
+        self.frame_sequence = 0
+        self.motion_gate = False
+        self.skipped = 0
+        self._last_thumb: Optional[np.ndarray] = None
+        self._last_detection = 0.0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def set_rate(self, rate_hz: float):
+        self.interval = 1.0 / rate_hz if rate_hz > 0 else 0.0
+
+    def _scene_static(self, frame: np.ndarray) -> bool:
+        """Compara una miniatura en grises con la de la detección anterior"""
+        thumb = cv2.resize(frame, MOTION_THUMB_SIZE, interpolation=cv2.INTER_NEAREST)
+        if thumb.ndim == 3:
+            thumb = cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY)
+        previous, self._last_thumb = self._last_thumb, thumb
+        if previous is None or not self.motion_gate or self.faces:
+            return False
+        if time.monotonic() - self._last_detection >= MOTION_RECHECK_SECONDS:
+            return False
+        return float(cv2.absdiff(thumb, previous).mean()) < MOTION_THRESHOLD
+
+    def run(self):
+        last_sequence = 0
+        while not self._stop_event.is_set():
+            started = time.perf_counter()
+            item = self.buffer.get(after=last_sequence, timeout=0.5)
+            if item is None:
+                if self.buffer.closed:
+                    break
+                continue
+            last_sequence, frame, _ = item
+            if self._scene_static(frame):
+                self.skipped += 1
+                self._stop_event.wait(self.interval)
+                continue
+            self._last_detection = time.monotonic()
+            try:
+                faces = self.detector.detect(frame)
+            except Exception as e:
+                logger.error(f"Error en detección de rostros: {e}")
+                faces = []
+            if self.frame_buffer is not None:
+                main = self.frame_buffer.get()
+                if main is None:
+                    continue
+                faces = self.detector.detect_in_regions(main[1], scale_boxes(faces, frame.shape, main[1].shape))
+                frame = main[1]
+            with self._lock:
+                self.faces = faces
+                self.frame = frame
+                self.frame_sequence = last_sequence
+            self.rate.tick()
+            remaining = self.interval - (time.perf_counter() - started)
+            if remaining > 0:
+                self._stop_event.wait(remaining)
+
+    def latest(self) -> Tuple[int, List[Tuple[int, int, int, int]]]:
+        """(secuencia del frame analizado, rostros)"""
+        with self._lock:
+            return self.frame_sequence, list(self.faces)
+
+    def snapshot(self) -> Tuple[int, Optional[np.ndarray], List[Tuple[int, int, int, int]]]:
+        """
+        (secuencia, frame analizado, rostros): los rostros se detectaron sobre
+        ese frame (con sub-stream, re-detectados en el principal; la secuencia
+        es la del frame del sub-stream)
+        """
+        with self._lock:
+            return self.frame_sequence, self.frame, list(self.faces)
+
+    def stop(self, timeout: float = 2.0):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,140 @@
+"""
+Avisos de cambios en la configuración de cámaras de los puntos de control
+Un trigger en `puntos_control` notifica el canal `puntos_control_camara`
+cuando cambia la cámara (url, credenciales, tipo de stream), el nombre o el
+estado de un punto. El servicio escucha en una conexión propia y reenvía cada
+aviso a los kioscos suscritos a /events/camaras (Server-Sent Events), que
+revalidan su caché local contra el dashboard (ETag) en lugar de consultar la
+configuración en cada arranque de cámara.
+"""
+
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional, Set
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+CAMERA_CHANNEL = "puntos_control_camara"
+
+# Idempotente: se ejecuta en cada arranque del servicio
+CAMERA_TRIGGERS_SQL = f"""
+CREATE OR REPLACE FUNCTION notificar_camara_punto() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('{CAMERA_CHANNEL}', json_build_object('id', OLD.id, 'op', TG_OP)::text);
+        RETURN OLD;
+    END IF;
+    PERFORM pg_notify('{CAMERA_CHANNEL}', json_build_object('id', NEW.id, 'op', TG_OP)::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_camara_punto ON puntos_control;
+CREATE TRIGGER trg_camara_punto
+    AFTER INSERT OR DELETE OR UPDATE OF camera_url, camera_user, camera_pass, stream_type, nombre, activo
+    ON puntos_control
+    FOR EACH ROW EXECUTE FUNCTION notificar_camara_punto();
+"""
+
+
+async def install_camera_triggers(conn):
+    """Crea (o reemplaza) la función y el trigger de notificación"""
+    await conn.execute(CAMERA_TRIGGERS_SQL)
+    logger.info(f"🔔 Trigger de cámaras instalado (canal {CAMERA_CHANNEL})")
+
+
+class CameraConfigBroadcaster:
+    """
+    Escucha `CAMERA_CHANNEL` y reparte cada aviso a las colas de los
+    suscriptores. Tras una reconexión envía {"op": "RESYNC"}: pudieron
+    perderse avisos y los kioscos deben revalidar toda su caché
+    """
+
+    def __init__(self, dsn: str, channel: str = CAMERA_CHANNEL, max_backoff: float = 30.0, queue_size: int = 100):
+        self.dsn = dsn
+        self.channel = channel
+        self.max_backoff = max_backoff
+        self.queue_size = queue_size
+        self.connected = False
+        self.events = 0
+        self.last_event: Optional[str] = None
+        self.last_error: Optional[str] = None
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, event: Dict[str, Any]):
+        self.events += 1
+        self.last_event = datetime.now().isoformat()
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Un suscriptor atascado recibe una resincronización completa
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"op": "RESYNC"})
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            self.publish(json.loads(payload))
+        except ValueError:
+            logger.warning(f"⚠️ Notificación de cámara inválida: {payload}")
+
+    async def _listen(self):
+        backoff = 1.0
+        first_connection = True
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda _: lost.set())
+                await conn.add_listener(self.channel, self._on_notify)
+                self.connected = True
+                backoff = 1.0
+                logger.info(f"🔔 Escuchando cambios de cámaras en '{self.channel}'")
+                if not first_connection:
+                    self.publish({"op": "RESYNC"})
+                first_connection = False
+                await lost.wait()
+                logger.warning("⚠️ Conexión de escucha de cámaras perdida")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"❌ Error en escucha de cámaras: {str(e)}")
+            finally:
+                self.connected = False
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "conectado": self.connected,
+            "suscriptores": len(self._subscribers),
+            "eventos": self.events,
+            "ultimo_evento": self.last_event,
+            "ultimo_error": self.last_error,
+        }
@@ -0,0 +1,111 @@
+"""
+Paquete de decisión sin conexión para los kioscos
+Cada kiosco descarga, para su punto de control, una copia cifrada del
+subconjunto de la galería que puede entrar a la zona (usuarios activos con
+reglas en `reglas_acceso`), esas reglas y el umbral de confianza. Con ella
+decide localmente si el servicio o la base de datos no responden, y encola
+las decisiones para registrarlas después en `accesos`/`alertas`
+(POST /edge/decisiones, idempotente por `decisiones_edge.id_local`).
+
+El paquete y el lote de decisiones viajan cifrados y autenticados con Fernet
+usando EDGE_SYNC_KEY, una clave propia de los kioscos: ENCRYPTION_KEY (la que
+descifra `rostros`) nunca sale del servicio.
+
+Formato del paquete (antes de cifrar): npz con
+    cabecera    JSON en uint8 (punto, modelo, umbral, reglas, nombres, versión)
+    ids         ids de `rostros` (int64)
+    usuarios    usuario de cada fila (int64)
+    embeddings  filas normalizadas L2 (float32)
+"""
+
+import hashlib
+import io
+import json
+import logging
+from datetime import datetime, time as dt_time
+from typing import Any, Dict, List
+
+import numpy as np
+from cryptography.fernet import Fernet
+
+from embedding_gallery import GallerySnapshot
+from embedding_storage import dequantize
+
+logger = logging.getLogger(__name__)
+
+EDGE_BUNDLE_FORMAT = 1
+
+EDGE_DECISIONS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS decisiones_edge (
+    id_local UUID PRIMARY KEY,
+    punto_id INTEGER REFERENCES puntos_control(id),
+    acceso_id INTEGER REFERENCES accesos(id),
+    alerta_id INTEGER REFERENCES alertas(id),
+    decidido_en TIMESTAMPTZ NOT NULL,
+    recibido_en TIMESTAMPTZ DEFAULT NOW()
+);
+"""
+
+EDGE_RULES_SQL = """
+SELECT r.usuario_id, r.dia_semana, r.hora_inicio, r.hora_fin, u.nombre
+FROM reglas_acceso r
+JOIN usuarios u ON u.id = r.usuario_id
+WHERE r.zona_id = $1 AND r.activo = true AND u.activo = true
+ORDER BY r.usuario_id, r.dia_semana NULLS LAST
+"""
+
+
+def _time_str(value: dt_time) -> str:
+    return value.strftime("%H:%M:%S")
+
+
+def build_edge_bundle(cipher: Fernet, punto: Dict[str, Any], rules: List[Dict[str, Any]], snapshot: GallerySnapshot,
+                      model_name: str, confidence_threshold: float) -> tuple:
+    """
+    Arma y cifra el paquete de un punto. Retorna (token, versión): la versión
+    es un hash del contenido (sin la fecha de generación) y sirve de ETag
+    """
+    user_ids = sorted({int(rule["usuario_id"]) for rule in rules})
+    rows = np.flatnonzero(np.isin(snapshot.user_ids, np.array(user_ids, dtype=np.int64)))
+    embeddings = dequantize(snapshot.matrix[rows], snapshot.scales[rows]).astype("<f4")
+    ids = snapshot.ids[rows].astype("<i8")
+    owners = snapshot.user_ids[rows].astype("<i8")
+
+    header = {
+        "formato": EDGE_BUNDLE_FORMAT,
+        "punto": {"id": punto["id"], "nombre": punto["nombre"], "zona_id": punto["zona_id"]},
+        "modelo": model_name,
+        "modelo_id": snapshot.model_id,
+        "umbral_confianza": confidence_threshold,
+        "reglas": [
+            {
+                "usuario_id": int(rule["usuario_id"]),
+                "dia_semana": rule["dia_semana"],
+                "hora_inicio": _time_str(rule["hora_inicio"]),
+                "hora_fin": _time_str(rule["hora_fin"]),
+            }
+            for rule in rules
+        ],
+        "nombres": {str(rule["usuario_id"]): rule["nombre"] for rule in rules},
+    }
+
+    digest = hashlib.sha1(json.dumps(header, sort_keys=True).encode())
+    for array in (ids, owners, embeddings):
+        digest.update(array.tobytes())
+    header["version"] = digest.hexdigest()
+    header["generado_en"] = datetime.now().isoformat()
+
+    buffer = io.BytesIO()
+    np.savez(buffer, cabecera=np.frombuffer(json.dumps(header).encode(), dtype=np.uint8),
+             ids=ids, usuarios=owners, embeddings=embeddings)
+    logger.info(f"📦 Paquete sin conexión del punto {punto['id']}: {len(user_ids)} usuarios, {len(rows)} rostros")
+    return cipher.encrypt(buffer.getvalue()), header["version"]
+
+
+def decrypt_decisions(cipher: Fernet, token: bytes) -> List[Dict[str, Any]]:
+    """Lote de decisiones enviado por un kiosco (InvalidToken si no es auténtico)"""
+    body = json.loads(cipher.decrypt(token))
+    decisions = body.get("decisiones")
+    if not isinstance(decisions, list):
+        raise ValueError("El lote no contiene 'decisiones'")
+    return decisions
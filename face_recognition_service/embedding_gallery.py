@@ -0,0 +1,316 @@
+"""
+Galería de embeddings en memoria
+Mantiene descifrados los embeddings de usuarios activos para no consultar y
+descifrar toda la tabla `rostros` en cada reconocimiento.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from functools import cached_property
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+from embedding_storage import approximate_cosines, dequantize, quantize, top_k
+
+logger = logging.getLogger(__name__)
+
+
+class GallerySnapshot:
+    """
+    Versión inmutable de la galería: ids de `rostros`, usuario de cada fila y
+    la matriz (N, D) de embeddings normalizados en la precisión configurada
+    (con escala por fila para int8). La matriz puede vivir en memoria
+    compartida, por eso nunca se modifica: cada recarga crea un snapshot nuevo.
+    `model_id` es el `modelos_faciales.id` de sus filas (None = sin filtrar),
+    y determina el modelo con el que se generan las consultas. `generation`
+    solo avanza con cada recarga completa (los cambios incrementales la
+    conservan): lo que se deriva de la galería completa se recalcula al cambiar.
+    """
+
+    def __init__(self, ids: np.ndarray, user_ids: np.ndarray, matrix: np.ndarray, version: int = 0,
+                 scales: Optional[np.ndarray] = None, model_id: Optional[int] = None, generation: int = 0):
+        self.ids = ids
+        self.user_ids = user_ids
+        self.matrix = matrix
+        self.scales = scales if scales is not None else np.ones(len(ids), dtype=np.float32)
+        self.version = version
+        self.model_id = model_id
+        self.generation = generation
+
+    @property
+    def precision(self) -> str:
+        return self.matrix.dtype.name
+
+    @property
+    def dim(self) -> int:
+        return self.matrix.shape[1]
+
+    @classmethod
+    def empty(cls, dim: int = 512, version: int = 0, precision: str = "float32",
+              model_id: Optional[int] = None) -> "GallerySnapshot":
+        return cls(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                   np.zeros((0, dim), dtype=precision), version, model_id=model_id)
+
+    @classmethod
+    def from_entries(cls, entries: List[Dict[str, Any]], version: int = 0,
+                     precision: str = "float32", model_id: Optional[int] = None) -> "GallerySnapshot":
+        """Construye la matriz a partir de filas {'id', 'usuario_id', 'embedding'}"""
+        # Solo se apilan embeddings de la dimensión dominante (DeepFace 512)
+        if not entries:
+            return cls.empty(version=version, precision=precision, model_id=model_id)
+        dims = [len(entry['embedding']) for entry in entries]
+        dim = max(set(dims), key=dims.count)
+        skipped = sum(1 for d in dims if d != dim)
+        if skipped:
+            logger.warning(f"⚠️ Galería: {skipped} embeddings con dimensión distinta de {dim} descartados")
+        entries = [entry for entry in entries if len(entry['embedding']) == dim]
+
+        matrix, scales = quantize(np.vstack([entry['embedding'] for entry in entries]), precision)
+        return cls(
+            np.array([entry['id'] for entry in entries], dtype=np.int64),
+            np.array([entry['usuario_id'] for entry in entries], dtype=np.int64),
+            matrix,
+            version,
+            scales,
+            model_id,
+        )
+
+    def with_changes(self, removed_ids: Iterable[int] = (), added: Optional[List[Dict[str, Any]]] = None,
+                     version: Optional[int] = None) -> "GallerySnapshot":
+        """Nuevo snapshot sin `removed_ids` y con las filas `added` (o reemplazadas)"""
+        added = [entry for entry in (added or []) if len(entry['embedding']) == self.dim]
+        removed = np.fromiter(removed_ids, dtype=np.int64)
+        if added:
+            removed = np.concatenate([removed, np.array([entry['id'] for entry in added], dtype=np.int64)])
+        keep = ~np.isin(self.ids, removed) if removed.size else np.ones(len(self.ids), dtype=bool)
+
+        ids, user_ids, matrix, scales = self.ids[keep], self.user_ids[keep], self.matrix[keep], self.scales[keep]
+        if added:
+            delta = GallerySnapshot.from_entries(added, precision=self.precision)
+            ids = np.concatenate([ids, delta.ids])
+            user_ids = np.concatenate([user_ids, delta.user_ids])
+            matrix = np.vstack([matrix, delta.matrix])
+            scales = np.concatenate([scales, delta.scales])
+        return GallerySnapshot(ids, user_ids, matrix, self.version if version is None else version, scales,
+                               self.model_id, self.generation)
+
+    def search(self, query: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Filas más parecidas a `query`: (índices, cosenos) de mayor a menor.
+        `rows` limita la búsqueda a esas filas (segunda etapa por usuario).
+        Con float16/int8 los cosenos son aproximados (re-ordenar con rerank)
+        """
+        if not len(self) or len(query) != self.dim:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        if rows is None:
+            cosines = approximate_cosines(self.matrix, self.scales, query)
+            best = top_k(cosines, k)
+            return best, cosines[best]
+        cosines = approximate_cosines(self.matrix[rows], self.scales[rows], query)
+        best = top_k(cosines, k)
+        return rows[best], cosines[best]
+
+    @cached_property
+    def _user_order(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        order = np.argsort(self.user_ids, kind="stable")
+        users, starts = np.unique(self.user_ids[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        return order, users, np.stack([starts, ends], axis=1)
+
+    @property
+    def unique_users(self) -> np.ndarray:
+        return self._user_order[1]
+
+    @property
+    def user_row_counts(self) -> np.ndarray:
+        """Filas de cada usuario, alineadas con `unique_users`"""
+        bounds = self._user_order[2]
+        return bounds[:, 1] - bounds[:, 0]
+
+    def rows_for_users(self, user_ids: np.ndarray) -> np.ndarray:
+        """Índices de las filas de esos usuarios sin recorrer toda la galería"""
+        order, users, bounds = self._user_order
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        if not len(users) or not len(user_ids):
+            return np.zeros(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(users, user_ids), len(users) - 1)
+        positions = positions[users[positions] == user_ids]
+        if not len(positions):
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([order[start:end] for start, end in bounds[positions]])
+
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + self.scales.nbytes + self.ids.nbytes + self.user_ids.nbytes
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @cached_property
+    def entries(self) -> List[Dict[str, Any]]:
+        """Filas en el formato de get_user_embeddings (normalizadas, en float32)"""
+        embeddings = dequantize(self.matrix, self.scales)
+        return [
+            {'id': int(row_id), 'usuario_id': int(user_id), 'embedding': embeddings[i]}
+            for i, (row_id, user_id) in enumerate(zip(self.ids, self.user_ids))
+        ]
+
+
+GalleryLoader = Callable[[], Awaitable[Union[List[Dict[str, Any]], GallerySnapshot]]]
+
+
+def as_snapshot(loaded: Union[List[Dict[str, Any]], GallerySnapshot], version: int,
+                precision: str = "float32", generation: int = 0) -> GallerySnapshot:
+    """Acepta tanto filas de get_user_embeddings como un snapshot ya armado"""
+    if isinstance(loaded, GallerySnapshot):
+        return GallerySnapshot(loaded.ids, loaded.user_ids, loaded.matrix, version, loaded.scales, loaded.model_id,
+                               generation)
+    snapshot = GallerySnapshot.from_entries(loaded, version, precision)
+    snapshot.generation = generation
+    return snapshot
+
+
+class EmbeddingGallery:
+    """
+    Copia en memoria de la galería de rostros.
+
+    `loader` es una corrutina que retorna la lista de embeddings
+    ({'id', 'usuario_id', 'embedding'}) o directamente un GallerySnapshot.
+    La galería se recarga cuando se invalida (p. ej. tras /enroll-face) o
+    cuando supera `refresh_seconds`, para recoger cambios hechos fuera del
+    servicio. `precision` es la representación de la matriz en memoria.
+    """
+
+    def __init__(self, loader: GalleryLoader, refresh_seconds: float = 60.0, precision: str = "float32"):
+        self._loader = loader
+        self.refresh_seconds = refresh_seconds
+        self.precision = precision
+        self.snapshot = GallerySnapshot.empty(precision=precision)
+        self.loaded_at: Optional[float] = None
+        self.load_ms: Optional[float] = None
+        self._valid = False
+        self._lock = asyncio.Lock()
+
+    @property
+    def version(self) -> int:
+        return self.snapshot.version
+
+    @property
+    def entries(self) -> List[Dict[str, Any]]:
+        return self.snapshot.entries
+
+    @property
+    def is_stale(self) -> bool:
+        if not self._valid or self.loaded_at is None:
+            return True
+        return self.refresh_seconds > 0 and time.monotonic() - self.loaded_at > self.refresh_seconds
+
+    def invalidate(self):
+        """Marca la galería para recargarse en el próximo uso"""
+        self._valid = False
+
+    async def _reload(self) -> GallerySnapshot:
+        start = time.perf_counter()
+        self.snapshot = as_snapshot(await self._loader(), self.version + 1, self.precision,
+                                    self.snapshot.generation + 1)
+        self.loaded_at = time.monotonic()
+        self.load_ms = (time.perf_counter() - start) * 1000
+        self._valid = True
+        logger.info(f"🗂️ Galería cargada: {len(self.snapshot)} embeddings en {self.load_ms:.0f} ms (versión {self.version})")
+        return self.snapshot
+
+    async def refresh(self) -> GallerySnapshot:
+        """Recarga la galería completa desde la base de datos"""
+        async with self._lock:
+            return await self._reload()
+
+    async def get(self) -> GallerySnapshot:
+        """Snapshot vigente, recargando si la copia está vencida"""
+        if self.is_stale:
+            async with self._lock:
+                # Otra petición pudo recargar mientras esperábamos el lock
+                if self.is_stale:
+                    await self._reload()
+        return self.snapshot
+
+    async def apply_changes(self, removed_ids: Iterable[int] = (), added: Optional[List[Dict[str, Any]]] = None,
+                            removed_user_ids: Iterable[int] = ()):
+        """
+        Aplica altas y bajas puntuales (p. ej. desde LISTEN/NOTIFY) sin
+        recargar. Si aún no hay galería cargada, la primera carga ya las incluye
+        """
+        async with self._lock:
+            if self.loaded_at is None:
+                return
+            if self.snapshot.model_id is not None and added:
+                # Filas leídas antes de un cambio de modelo no pertenecen a esta galería
+                added = [entry for entry in added if entry.get('modelo_id', self.snapshot.model_id) == self.snapshot.model_id]
+            removed = set(removed_ids)
+            removed_user_ids = list(removed_user_ids)
+            if removed_user_ids:
+                removed.update(self.snapshot.ids[np.isin(self.snapshot.user_ids, removed_user_ids)].tolist())
+            self.snapshot = self.snapshot.with_changes(removed_ids=removed, added=added, version=self.version + 1)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "embeddings": len(self.snapshot),
+            "usuarios": len(self.snapshot.unique_users),
+            "version": self.version,
+            "precision": self.snapshot.precision,
+            "modelo_id": self.snapshot.model_id,
+            "memoria_mb": round(self.snapshot.nbytes / 1e6, 2),
+            "carga_ms": self.load_ms,
+        }
+
+
+class RerankCache:
+    """
+    Embeddings en precisión completa para re-puntuar el top-k de una galería
+    float16/int8 sin ir a la base ni descifrar en cada reconocimiento. LRU
+    acotado por `max_entries` (0 = deshabilitado) y llaveado por `rostros.id`:
+    se llena al cargar la galería con las filas ya descifradas, y los fallos
+    (p. ej. snapshot en disco o workers de memoria compartida) se completan en
+    lote y quedan cacheados
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(0, max_entries)
+        self._entries: "OrderedDict[int, np.ndarray]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def put_many(self, items: Iterable[Tuple[int, np.ndarray]]):
+        if not self.max_entries:
+            return
+        for embedding_id, embedding in items:
+            self._entries[embedding_id] = np.asarray(embedding, dtype=np.float32)
+            self._entries.move_to_end(embedding_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get_many(self, embedding_ids: Iterable[int]) -> Dict[int, np.ndarray]:
+        found = {}
+        for embedding_id in embedding_ids:
+            embedding = self._entries.get(embedding_id)
+            if embedding is None:
+                self.misses += 1
+                continue
+            self._entries.move_to_end(embedding_id)
+            found[embedding_id] = embedding
+            self.hits += 1
+        return found
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "embeddings": len(self._entries),
+            "max": self.max_entries,
+            "aciertos": self.hits,
+            "fallos": self.misses,
+            "memoria_mb": round(sum(e.nbytes for e in self._entries.values()) / 1e6, 2),
+        }
@@ -0,0 +1,116 @@
+"""
+Representación compacta de embeddings
+- Serialización de `rostros.embedding`: float32 con prefijo de formato
+  (ArcFace produce float32, así que no hay pérdida). Las filas antiguas, sin
+  prefijo, se leen como float64.
+- Precisión de la galería en memoria: float64, float32, float16 o int8 con
+  escala por vector. Las filas se guardan normalizadas L2 para que el
+  producto matriz-vector dé directamente la similitud coseno.
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+# Prefijo de los embeddings float32 en `rostros.embedding`
+EMBEDDING_FORMAT_FLOAT32 = b"EMB4"
+
+GALLERY_PRECISIONS = ("float64", "float32", "float16", "int8")
+
+# Con estas precisiones el coseno es aproximado y el top-k se re-ordena
+# con los embeddings completos
+APPROXIMATE_PRECISIONS = ("float16", "int8")
+
+# Filas por bloque al convertir float16/int8 a float32 para el producto
+SEARCH_CHUNK_ROWS = 16384
+
+
+def serialize_embedding(embedding: np.ndarray) -> bytes:
+    """Bytes a cifrar para `rostros.embedding` (formato float32)"""
+    return EMBEDDING_FORMAT_FLOAT32 + np.asarray(embedding, dtype="<f4").tobytes()
+
+
+def deserialize_embedding(data: bytes) -> np.ndarray:
+    """Lee tanto el formato float32 actual como el float64 heredado"""
+    if data[:len(EMBEDDING_FORMAT_FLOAT32)] == EMBEDDING_FORMAT_FLOAT32:
+        return np.frombuffer(data, dtype="<f4", offset=len(EMBEDDING_FORMAT_FLOAT32))
+    return np.frombuffer(data, dtype=np.float64)
+
+
+def is_legacy_embedding(data: bytes) -> bool:
+    return data[:len(EMBEDDING_FORMAT_FLOAT32)] != EMBEDDING_FORMAT_FLOAT32
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float64)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / (norms + 1e-8)
+
+
+def quantize(matrix: np.ndarray, precision: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Normaliza y convierte las filas a `precision`. Retorna (datos, escalas):
+    para int8 la escala por vector es max|x|/127; para el resto vale 1.
+    """
+    if precision not in GALLERY_PRECISIONS:
+        raise ValueError(f"Precisión de galería no soportada: {precision}")
+    normalized = normalize_rows(matrix)
+    scales = np.ones(len(normalized), dtype=np.float32)
+
+    if precision == "int8":
+        max_abs = np.abs(normalized).max(axis=1) if normalized.size else np.zeros(len(normalized))
+        scales = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+        data = np.round(normalized / scales[:, None]).astype(np.int8)
+    else:
+        data = normalized.astype(precision)
+    return data, scales
+
+
+def dequantize(data: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    """Filas normalizadas en float32 (aproximadas si la precisión es reducida)"""
+    return data.astype(np.float32) * scales[:, None]
+
+
+def approximate_cosines(data: np.ndarray, scales: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Similitud coseno de `query` contra todas las filas"""
+    if data.dtype == np.float64:
+        query = normalize_rows(query)
+        return data @ query
+
+    query = normalize_rows(query).astype(np.float32)
+    if data.dtype == np.float32:
+        return data @ query
+
+    # numpy no acelera float16/int8 con BLAS: convertir por bloques a float32
+    cosines = np.empty(len(data), dtype=np.float32)
+    for start in range(0, len(data), SEARCH_CHUNK_ROWS):
+        chunk = data[start:start + SEARCH_CHUNK_ROWS].astype(np.float32)
+        cosines[start:start + len(chunk)] = (chunk @ query) * scales[start:start + len(chunk)]
+    return cosines
+
+
+def top_k(cosines: np.ndarray, k: int) -> np.ndarray:
+    """Índices de las k mayores similitudes, de mayor a menor"""
+    if k <= 0 or k >= len(cosines):
+        return np.argsort(-cosines)
+    candidates = np.argpartition(-cosines, k)[:k]
+    return candidates[np.argsort(-cosines[candidates])]
+
+
+def cosine_to_confidence(cosines) -> np.ndarray:
+    """
+    Curva coseno -> confianza de calculate_similarity_score_deepface,
+    vectorizada para puntuar toda la galería de una vez
+    """
+    c = np.asarray(cosines, dtype=np.float64)
+    confidence = np.select(
+        [c >= 0.70, c >= 0.60, c >= 0.50, c >= 0.40],
+        [0.85 + (c - 0.70) * 0.5, 0.70 + (c - 0.60) * 1.5, 0.50 + (c - 0.50) * 2.0, 0.30 + (c - 0.40) * 2.0],
+        default=np.maximum(0.0, c * 0.75),
+    )
+    return np.clip(confidence, 0.0, 1.0)
+
+
+def bytes_per_vector(precision: str, dim: int = 512) -> int:
+    """Memoria por embedding en la galería (int8 incluye su escala)"""
+    return dim * np.dtype(precision).itemsize + (4 if precision == "int8" else 0)
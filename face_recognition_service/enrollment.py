@@ -0,0 +1,86 @@
+"""
+Etapas del registro facial previas a guardar en `rostros`
+Evita que los registros repetidos acumulen vectores casi idénticos: cada
+embedding nuevo se compara con los que el usuario ya tiene y con el resto
+del lote, y la galería del usuario se limita a un conjunto diverso.
+"""
+
+import logging
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+from embedding_storage import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+
+class PruningResult:
+    """Índices (sobre el lote) de los embeddings que se guardan y los descartados"""
+
+    def __init__(self, kept: List[int], duplicates: List[int], over_cap: List[int]):
+        self.kept = kept
+        self.duplicates = duplicates
+        self.over_cap = over_cap
+
+    @property
+    def pruned(self) -> int:
+        return len(self.duplicates) + len(self.over_cap)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"guardados": len(self.kept), "duplicados": len(self.duplicates), "sobre_limite": len(self.over_cap)}
+
+    def describe(self, max_faces: int) -> str:
+        """Motivos de los descartes para el mensaje al cliente ('' si no hubo)"""
+        reasons = []
+        if self.duplicates:
+            reasons.append(f"{len(self.duplicates)} casi duplicados de rostros ya registrados")
+        if self.over_cap:
+            reasons.append(f"{len(self.over_cap)} sin guardar por el límite de {max_faces} rostros por usuario")
+        return ", ".join(reasons)
+
+
+def prune_enrollment_embeddings(new_embeddings: Sequence[np.ndarray], qualities: Sequence[float],
+                                existing_embeddings: Sequence[np.ndarray], duplicate_threshold: float = 0.95,
+                                max_faces: int = 20) -> PruningResult:
+    """
+    Selecciona qué embeddings nuevos guardar.
+
+    1. En orden de calidad, descarta los que tienen similitud coseno mayor
+       que `duplicate_threshold` con un rostro ya guardado o ya aceptado.
+    2. Si el usuario superaría `max_faces` (0 = sin límite), añade solo los
+       más distintos de lo ya guardado (punto más lejano), de modo que el
+       conjunto final cubra más variación de pose e iluminación.
+    Los rostros existentes nunca se borran.
+    """
+    if not len(new_embeddings):
+        return PruningResult([], [], [])
+
+    new = normalize_rows(np.vstack(new_embeddings))
+    existing = [row for row in existing_embeddings if len(row) == new.shape[1]]
+    kept_matrix = normalize_rows(np.vstack(existing)) if existing else np.zeros((0, new.shape[1]))
+
+    accepted, duplicates = [], []
+    for index in np.argsort(-np.asarray(qualities, dtype=np.float64), kind="stable"):
+        reference = np.vstack([kept_matrix, new[accepted]]) if accepted else kept_matrix
+        if len(reference) and float(np.max(reference @ new[index])) > duplicate_threshold:
+            duplicates.append(int(index))
+        else:
+            accepted.append(int(index))
+
+    over_cap = []
+    slots = max_faces - len(kept_matrix) if max_faces > 0 else len(accepted)
+    if len(accepted) > slots:
+        chosen = []
+        remaining = list(accepted)
+        if not len(kept_matrix) and slots > 0:
+            # Sin rostros previos se empieza por el de mejor calidad
+            chosen.append(remaining.pop(0))
+        while len(chosen) < max(slots, 0) and remaining:
+            reference = np.vstack([kept_matrix, new[chosen]]) if chosen else kept_matrix
+            closeness = (new[remaining] @ reference.T).max(axis=1)
+            chosen.append(remaining.pop(int(np.argmin(closeness))))
+        over_cap = remaining
+        accepted = chosen
+
+    return PruningResult(sorted(accepted), sorted(duplicates), sorted(over_cap))
@@ -0,0 +1,141 @@
+"""
+Contexto compartido de análisis facial
+Calcula una sola vez (y de forma perezosa) los recortes, escalas de grises,
+gradientes, FFT y HSV que usan los detectores de liveness y anti-spoofing
+"""
+
+from functools import cached_property
+
+import cv2
+import numpy as np
+
+
+class FaceAnalysisContext:
+    """
+    Análisis de un rostro detectado en una imagen.
+
+    Cada característica se calcula la primera vez que se solicita y se
+    reutiliza en las siguientes lecturas, de modo que el filtro de nitidez de
+    reconocimiento, `detect_liveness`, `advanced_liveness_tensorflow` y
+    `detect_spoofing_tensorflow` comparten el mismo trabajo sobre el rostro.
+    """
+
+    LIVENESS_SIZE = (64, 64)
+    SPOOFING_SIZE = (128, 128)
+
+    def __init__(self, image: np.ndarray, face_location: tuple):
+        self.image = image
+        self.face_location = face_location
+
+    # ------------------------------------------------------------------
+    # Rostro a resolución original
+    # ------------------------------------------------------------------
+    @cached_property
+    def roi(self) -> np.ndarray:
+        top, right, bottom, left = self.face_location
+        return self.image[top:bottom, left:right]
+
+    @property
+    def is_empty(self) -> bool:
+        return self.roi.size == 0
+
+    @cached_property
+    def roi_rgb(self) -> np.ndarray:
+        """Rostro en RGB para los modelos Keras"""
+        return cv2.cvtColor(self.roi, cv2.COLOR_BGR2RGB)
+
+    @cached_property
+    def gray(self) -> np.ndarray:
+        return cv2.cvtColor(self.roi, cv2.COLOR_BGR2GRAY)
+
+    @cached_property
+    def laplacian_var(self) -> float:
+        """Varianza del Laplaciano (nitidez) del rostro completo"""
+        return float(cv2.Laplacian(self.gray, cv2.CV_64F).var())
+
+    @cached_property
+    def edges(self) -> np.ndarray:
+        return cv2.Canny(self.gray, 50, 150)
+
+    @cached_property
+    def edge_density(self) -> float:
+        return float(np.sum(self.edges > 0) / self.edges.size)
+
+    @cached_property
+    def contrast(self) -> float:
+        return float(self.gray.std())
+
+    # ------------------------------------------------------------------
+    # Recorte 64x64 (liveness)
+    # ------------------------------------------------------------------
+    @cached_property
+    def face_64(self) -> np.ndarray:
+        return cv2.resize(self.roi, self.LIVENESS_SIZE)
+
+    @cached_property
+    def gray_64(self) -> np.ndarray:
+        return cv2.cvtColor(self.face_64, cv2.COLOR_BGR2GRAY)
+
+    @cached_property
+    def laplacian_var_64(self) -> float:
+        return float(cv2.Laplacian(self.gray_64, cv2.CV_64F).var())
+
+    @cached_property
+    def magnitude_spectrum_64(self) -> np.ndarray:
+        f_shift = np.fft.fftshift(np.fft.fft2(self.gray_64))
+        return np.log(np.abs(f_shift) + 1)
+
+    @cached_property
+    def frequency_score_64(self) -> float:
+        return float(np.std(self.magnitude_spectrum_64))
+
+    @cached_property
+    def gradient_magnitude_64(self) -> np.ndarray:
+        return _gradient_magnitude(self.gray_64)
+
+    @cached_property
+    def gradient_score_64(self) -> float:
+        return float(np.mean(self.gradient_magnitude_64))
+
+    @cached_property
+    def texture_score_64(self) -> float:
+        """Desviación estándar del gris (LBP simulado)"""
+        return float(np.std(self.gray_64))
+
+    # ------------------------------------------------------------------
+    # Recorte 128x128 (anti-spoofing)
+    # ------------------------------------------------------------------
+    @cached_property
+    def face_128(self) -> np.ndarray:
+        return cv2.resize(self.roi, self.SPOOFING_SIZE)
+
+    @cached_property
+    def gray_128(self) -> np.ndarray:
+        return cv2.cvtColor(self.face_128, cv2.COLOR_BGR2GRAY)
+
+    @cached_property
+    def edge_density_128(self) -> float:
+        edges = cv2.Canny(self.gray_128, 50, 150)
+        return float(np.sum(edges > 0) / edges.size)
+
+    @cached_property
+    def hsv_128(self) -> np.ndarray:
+        return cv2.cvtColor(self.face_128, cv2.COLOR_BGR2HSV)
+
+    @cached_property
+    def saturation_var_128(self) -> float:
+        return float(np.var(self.hsv_128[:, :, 1]))
+
+    @cached_property
+    def gradient_magnitude_128(self) -> np.ndarray:
+        return _gradient_magnitude(self.gray_128)
+
+    @cached_property
+    def depth_variation_128(self) -> float:
+        return float(np.std(self.gradient_magnitude_128))
+
+
+def _gradient_magnitude(gray: np.ndarray) -> np.ndarray:
+    grad_x = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=3)
+    grad_y = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3)
+    return np.sqrt(grad_x**2 + grad_y**2)
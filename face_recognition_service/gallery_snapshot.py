@@ -0,0 +1,158 @@
+"""
+Snapshot cifrado de la galería en disco
+Guarda ids, usuarios y embeddings ya descifrados en un archivo local cifrado
+por bloques (AES-GCM), para que al reiniciar no haya que descifrar con Fernet
+cada fila de `rostros`: se mapea el archivo con `np.memmap`, se descifran los
+bloques y solo se consultan las filas posteriores a la marca de agua.
+
+Formato:
+    b"FGSNAP01" | uint32 longitud de cabecera | cabecera JSON
+    bloques: nonce (12) | registros cifrados | tag (16)
+
+La cabecera (n, dim, precisión, modelo, filas por bloque, max(rostros.id), max(creado_en)) va
+en claro pero autenticada: forma parte de los datos asociados de cada bloque.
+"""
+
+import base64
+import json
+import logging
+import os
+import struct
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from embedding_gallery import GallerySnapshot
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"FGSNAP01"
+NONCE_SIZE = 12
+TAG_SIZE = 16
+DEFAULT_BLOCK_ROWS = 4096
+
+
+def derive_snapshot_key(encryption_key: bytes) -> bytes:
+    """
+    Clave AES-256 del snapshot derivada de ENCRYPTION_KEY: si cambia la clave
+    del servicio, el snapshot deja de poder abrirse y se reconstruye
+    """
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"face-gallery-snapshot-v1",
+    ).derive(base64.urlsafe_b64decode(encryption_key))
+
+
+def record_dtype(dim: int, precision: str) -> np.dtype:
+    return np.dtype([("id", "<i8"), ("usuario_id", "<i8"), ("scale", "<f4"), ("embedding", precision, (dim,))])
+
+
+class GallerySnapshotStore:
+    """
+    Lectura y escritura del snapshot. `high_water` es
+    {'max_id': int, 'max_creado_en': str ISO} de las filas incluidas. Un
+    snapshot guardado con otra precisión de galería se descarta al cargar.
+    """
+
+    def __init__(self, path: str, encryption_key: bytes, precision: str = "float32",
+                 block_rows: int = DEFAULT_BLOCK_ROWS):
+        self.path = path
+        self.precision = precision
+        self.block_rows = block_rows
+        self._aead = AESGCM(derive_snapshot_key(encryption_key))
+        self.last_saved: Optional[float] = None
+        self.load_ms: Optional[float] = None
+
+    @property
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def save(self, snapshot: GallerySnapshot, high_water: Dict[str, Any]):
+        """Escribe el snapshot en un archivo temporal y lo reemplaza de forma atómica"""
+        start = time.perf_counter()
+        n, dim = snapshot.matrix.shape
+        header = json.dumps({
+            "n": int(n),
+            "dim": int(dim),
+            "precision": snapshot.precision,
+            "modelo_id": snapshot.model_id,
+            "block_rows": self.block_rows,
+            "max_id": int(high_water.get("max_id") or 0),
+            "max_creado_en": high_water.get("max_creado_en"),
+            "guardado_en": datetime.now(timezone.utc).isoformat(),
+        }).encode()
+
+        records = np.empty(n, dtype=record_dtype(dim, snapshot.precision))
+        records["id"] = snapshot.ids
+        records["usuario_id"] = snapshot.user_ids
+        records["scale"] = snapshot.scales
+        records["embedding"] = snapshot.matrix
+        payload = records.view(np.uint8)
+        block_bytes = self.block_rows * records.dtype.itemsize
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            for offset in range(0, payload.size, block_bytes):
+                nonce = os.urandom(NONCE_SIZE)
+                f.write(nonce)
+                f.write(self._aead.encrypt(nonce, payload[offset:offset + block_bytes].tobytes(), header))
+        os.replace(tmp_path, self.path)
+
+        self.last_saved = time.monotonic()
+        logger.info(f"💾 Snapshot de galería guardado: {n} embeddings en {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    def load(self) -> Optional[Tuple[GallerySnapshot, Dict[str, Any]]]:
+        """Abre el snapshot; retorna None si no existe o no se puede descifrar"""
+        if not self.exists:
+            return None
+        start = time.perf_counter()
+        try:
+            data = np.memmap(self.path, dtype=np.uint8, mode="r")
+            if bytes(data[:len(MAGIC)]) != MAGIC:
+                raise ValueError("formato desconocido")
+            header_size = struct.unpack("<I", bytes(data[len(MAGIC):len(MAGIC) + 4]))[0]
+            header_start = len(MAGIC) + 4
+            header_bytes = bytes(data[header_start:header_start + header_size])
+            header = json.loads(header_bytes)
+
+            n, dim, block_rows = header["n"], header["dim"], header["block_rows"]
+            if header.get("precision") != self.precision:
+                raise ValueError(f"precisión {header.get('precision')} distinta de {self.precision}")
+            records = np.empty(n, dtype=record_dtype(dim, self.precision))
+            plain = records.view(np.uint8)
+            block_bytes = block_rows * records.dtype.itemsize
+
+            position = header_start + header_size
+            for offset in range(0, plain.size, block_bytes):
+                size = min(block_bytes, plain.size - offset)
+                nonce = bytes(data[position:position + NONCE_SIZE])
+                position += NONCE_SIZE
+                ciphertext = data[position:position + size + TAG_SIZE]
+                position += size + TAG_SIZE
+                plain[offset:offset + size] = np.frombuffer(self._aead.decrypt(nonce, memoryview(ciphertext), header_bytes), dtype=np.uint8)
+            del data
+        except Exception as e:
+            logger.warning(f"⚠️ Snapshot de galería inválido, se reconstruirá desde la base de datos: {str(e)}")
+            return None
+
+        snapshot = GallerySnapshot(
+            np.ascontiguousarray(records["id"]),
+            np.ascontiguousarray(records["usuario_id"]),
+            np.ascontiguousarray(records["embedding"]),
+            scales=np.ascontiguousarray(records["scale"]),
+            model_id=header.get("modelo_id"),
+        )
+        self.load_ms = (time.perf_counter() - start) * 1000
+        logger.info(f"💾 Snapshot de galería cargado: {n} embeddings en {self.load_ms:.0f} ms")
+        return snapshot, {"max_id": header["max_id"], "max_creado_en": header["max_creado_en"]}
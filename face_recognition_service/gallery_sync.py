@@ -0,0 +1,212 @@
+"""
+Sincronización incremental de la galería con LISTEN/NOTIFY
+Los rostros también se registran o borran desde el dashboard (Next.js) y los
+scripts de limpieza, así que el servicio no puede depender solo de
+/enroll-face. Unos triggers en `rostros` y `usuarios.activo` notifican el
+canal `galeria_rostros`; una conexión dedicada escucha y aplica altas, bajas
+y desactivaciones sobre la galería en memoria sin recargarla completa.
+"""
+
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+GALLERY_CHANNEL = "galeria_rostros"
+
+# Idempotente: se ejecuta en cada arranque del servicio
+TRIGGERS_SQL = f"""
+CREATE OR REPLACE FUNCTION notificar_galeria_rostros() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify('{GALLERY_CHANNEL}', json_build_object('tabla', 'rostros', 'op', 'TRUNCATE')::text);
+        RETURN NULL;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('{GALLERY_CHANNEL}', json_build_object(
+            'tabla', 'rostros', 'op', 'DELETE', 'id', OLD.id, 'usuario_id', OLD.usuario_id)::text);
+        RETURN OLD;
+    END IF;
+    PERFORM pg_notify('{GALLERY_CHANNEL}', json_build_object(
+        'tabla', 'rostros', 'op', TG_OP, 'id', NEW.id, 'usuario_id', NEW.usuario_id)::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notificar_galeria_usuarios() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{GALLERY_CHANNEL}', json_build_object(
+        'tabla', 'usuarios', 'op', TG_OP, 'id', NEW.id, 'activo', NEW.activo)::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_galeria_rostros ON rostros;
+CREATE TRIGGER trg_galeria_rostros
+    AFTER INSERT OR UPDATE OR DELETE ON rostros
+    FOR EACH ROW EXECUTE FUNCTION notificar_galeria_rostros();
+
+DROP TRIGGER IF EXISTS trg_galeria_rostros_truncate ON rostros;
+CREATE TRIGGER trg_galeria_rostros_truncate
+    AFTER TRUNCATE ON rostros
+    FOR EACH STATEMENT EXECUTE FUNCTION notificar_galeria_rostros();
+
+DROP TRIGGER IF EXISTS trg_galeria_usuarios ON usuarios;
+CREATE TRIGGER trg_galeria_usuarios
+    AFTER UPDATE OF activo ON usuarios
+    FOR EACH ROW WHEN (OLD.activo IS DISTINCT FROM NEW.activo)
+    EXECUTE FUNCTION notificar_galeria_usuarios();
+"""
+
+
+async def install_triggers(conn):
+    """Crea (o reemplaza) las funciones y triggers de notificación"""
+    await conn.execute(TRIGGERS_SQL)
+    logger.info(f"🔔 Triggers de galería instalados (canal {GALLERY_CHANNEL})")
+
+
+class GalleryChanges:
+    """Eventos acumulados de un lote, en el orden en que llegaron"""
+
+    def __init__(self):
+        self.upserted_ids: Set[int] = set()
+        self.deleted_ids: Set[int] = set()
+        self.activated_users: Set[int] = set()
+        self.deactivated_users: Set[int] = set()
+        self.full_reload = False
+
+    def add(self, event: Dict[str, Any]):
+        table, op = event.get("tabla"), event.get("op")
+        if op == "TRUNCATE":
+            self.full_reload = True
+        elif table == "rostros" and op == "DELETE":
+            self.deleted_ids.add(event["id"])
+            self.upserted_ids.discard(event["id"])
+        elif table == "rostros":
+            self.upserted_ids.add(event["id"])
+            self.deleted_ids.discard(event["id"])
+        elif table == "usuarios" and event.get("activo"):
+            self.activated_users.add(event["id"])
+            self.deactivated_users.discard(event["id"])
+        elif table == "usuarios":
+            self.deactivated_users.add(event["id"])
+            self.activated_users.discard(event["id"])
+
+
+class GallerySyncListener:
+    """
+    Escucha el canal de la galería en una conexión propia y aplica los
+    cambios por lotes. `fetch_rows(embedding_ids, user_ids)` retorna las
+    filas descifradas de usuarios activos; si la conexión se pierde se
+    reconecta y se pide una recarga, porque pudo perder notificaciones.
+    """
+
+    def __init__(self, dsn: str, gallery, fetch_rows: Callable[[List[int], List[int]], Awaitable[List[Dict[str, Any]]]],
+                 channel: str = GALLERY_CHANNEL, batch_delay: float = 0.2, max_backoff: float = 30.0):
+        self.dsn = dsn
+        self.gallery = gallery
+        self.fetch_rows = fetch_rows
+        self.channel = channel
+        self.batch_delay = batch_delay
+        self.max_backoff = max_backoff
+        self.connected = False
+        self.events = 0
+        self.batches = 0
+        self.last_event: Optional[str] = None
+        self.last_error: Optional[str] = None
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._apply_loop())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            self._queue.put_nowait(json.loads(payload))
+        except ValueError:
+            logger.warning(f"⚠️ Notificación de galería inválida: {payload}")
+
+    async def _listen(self):
+        backoff = 1.0
+        first_connection = True
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda _: lost.set())
+                await conn.add_listener(self.channel, self._on_notify)
+                self.connected = True
+                backoff = 1.0
+                logger.info(f"🔔 Escuchando cambios de galería en '{self.channel}'")
+                if not first_connection:
+                    # Sin conexión no llegaron notificaciones: reconciliar
+                    self._queue.put_nowait({"op": "TRUNCATE"})
+                first_connection = False
+                await lost.wait()
+                logger.warning("⚠️ Conexión de escucha de galería perdida")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"❌ Error en escucha de galería: {str(e)}")
+            finally:
+                self.connected = False
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def _apply_loop(self):
+        while True:
+            changes = GalleryChanges()
+            changes.add(await self._queue.get())
+            # Agrupar ráfagas (p. ej. DELETE FROM rostros) en un solo cambio
+            await asyncio.sleep(self.batch_delay)
+            count = 1
+            while not self._queue.empty():
+                changes.add(self._queue.get_nowait())
+                count += 1
+            self.events += count
+            self.batches += 1
+            self.last_event = datetime.now().isoformat()
+            try:
+                await self._apply(changes)
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"❌ Error aplicando cambios de galería, se recargará: {str(e)}")
+                self.gallery.invalidate()
+
+    async def _apply(self, changes: GalleryChanges):
+        if changes.full_reload:
+            self.gallery.invalidate()
+            return
+
+        wanted_ids = sorted(changes.upserted_ids)
+        wanted_users = sorted(changes.activated_users)
+        added = await self.fetch_rows(wanted_ids, wanted_users) if wanted_ids or wanted_users else []
+        # Filas modificadas que ya no corresponden a un usuario activo
+        removed_ids = changes.deleted_ids | (changes.upserted_ids - {entry['id'] for entry in added})
+
+        await self.gallery.apply_changes(removed_ids=removed_ids, added=added,
+                                         removed_user_ids=changes.deactivated_users)
+        logger.info(f"🔔 Galería sincronizada: +{len(added)} filas, -{len(removed_ids)} filas, "
+                    f"-{len(changes.deactivated_users)} usuarios")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "conectado": self.connected,
+            "eventos": self.events,
+            "lotes": self.batches,
+            "ultimo_evento": self.last_event,
+            "ultimo_error": self.last_error,
+        }
@@ -0,0 +1,48 @@
+"""
+Importación diferida de dependencias pesadas
+TensorFlow, Keras y DeepFace tardan decenas de segundos en importarse; con
+`LazyModule` solo se cargan cuando se usa alguno de sus atributos, de modo que
+los procesos que sirven /health o evidencias arrancan en segundos.
+"""
+
+import importlib
+import threading
+from typing import Any, Callable, Optional
+
+
+class LazyModule:
+    """
+    Proxy de un módulo que se importa en el primer acceso a un atributo.
+
+    `attribute` permite exponer un submódulo accesible solo como atributo
+    (p. ej. `keras` dentro de `tensorflow`). `on_load` se ejecuta una única
+    vez tras la importación (configurar loggers, etc.).
+    """
+
+    def __init__(self, name: str, attribute: Optional[str] = None,
+                 on_load: Optional[Callable[[Any], None]] = None):
+        self._name = name
+        self._attribute = attribute
+        self._on_load = on_load
+        self._module = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._module is not None
+
+    def load(self):
+        """Importa el módulo (seguro entre hilos) y lo retorna"""
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    module = importlib.import_module(self._name)
+                    if self._attribute:
+                        module = getattr(module, self._attribute)
+                    if self._on_load:
+                        self._on_load(module)
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
@@ -0,0 +1,178 @@
+"""
+Motor de puntuación de liveness y anti-spoofing
+Las cabezas lineales (producto punto + sigmoide) se evalúan con NumPy o con un
+grafo `tf.function` precompilado cuyos pesos viven en variables persistentes.
+Ambos backends aceptan lotes de rostros.
+"""
+
+import logging
+from typing import Any, Dict, List
+
+import numpy as np
+
+from face_analysis import FaceAnalysisContext
+
+logger = logging.getLogger(__name__)
+
+# Pesos de las cabezas lineales (antes se creaban con tf.constant en cada llamada)
+LINEAR_HEADS = {
+    # Características: nitidez, frecuencia, gradiente, textura
+    "liveness": {
+        "weights": [0.3, 0.25, 0.25, 0.2],
+        "bias": 0.1,
+    },
+    # Características: foto impresa, pantalla, profundidad
+    "spoofing": {
+        "weights": [0.4, 0.3, 0.3],
+        "bias": 0.0,
+    },
+}
+
+SCORING_BACKENDS = ("numpy", "tensorflow")
+
+
+def liveness_features(context: FaceAnalysisContext) -> np.ndarray:
+    """Vector de 4 características normalizadas para la cabeza de liveness"""
+    return np.array([
+        context.laplacian_var_64 / 500.0,
+        context.frequency_score_64 / 10.0,
+        context.gradient_score_64 / 50.0,
+        context.texture_score_64 / 100.0,
+    ], dtype=np.float32)
+
+
+def spoofing_attack_scores(context: FaceAnalysisContext) -> Dict[str, float]:
+    """Scores por tipo de ataque (foto, pantalla, máscara) de un rostro"""
+    # Las fotos impresas tienden a tener bordes más definidos
+    edge_density = context.edge_density_128
+    photo_attack_score = 1.0 if edge_density > 0.15 else edge_density / 0.15
+
+    # Las pantallas tienen patrones de píxeles regulares
+    saturation_var = context.saturation_var_128
+    screen_attack_score = 1.0 if saturation_var < 200 else (400 - saturation_var) / 200
+
+    # Rostros reales tienen más variación de profundidad
+    depth_score = 1.0 - min(1.0, context.depth_variation_128 / 30.0)
+
+    return {
+        "photo": photo_attack_score,
+        "screen": screen_attack_score,
+        "mask": depth_score,
+    }
+
+
+def spoofing_features(attack_scores: Dict[str, float]) -> np.ndarray:
+    """Vector de 3 características para la cabeza de spoofing"""
+    return np.array([
+        attack_scores["photo"],
+        attack_scores["screen"],
+        attack_scores["mask"],
+    ], dtype=np.float32)
+
+
+class _NumpyHeads:
+    """Cabezas lineales evaluadas con NumPy (sin overhead de despacho de TF)"""
+
+    def __init__(self):
+        self.weights = {
+            name: np.asarray(head["weights"], dtype=np.float32)
+            for name, head in LINEAR_HEADS.items()
+        }
+        self.bias = {
+            name: np.float32(head["bias"])
+            for name, head in LINEAR_HEADS.items()
+        }
+
+    def score(self, head: str, features: np.ndarray) -> np.ndarray:
+        raw = features @ self.weights[head] + self.bias[head]
+        return 1.0 / (1.0 + np.exp(-raw))
+
+
+class _TensorFlowHeads:
+    """Cabezas lineales compiladas con `tf.function` y pesos en `tf.Variable`"""
+
+    def __init__(self):
+        import tensorflow as tf
+
+        self._tf = tf
+        self.weights = {
+            name: tf.Variable(
+                np.asarray(head["weights"], dtype=np.float32).reshape(-1, 1),
+                trainable=False,
+                name=f"{name}_weights",
+            )
+            for name, head in LINEAR_HEADS.items()
+        }
+        self.bias = {
+            name: tf.Variable([head["bias"]], dtype=tf.float32, trainable=False, name=f"{name}_bias")
+            for name, head in LINEAR_HEADS.items()
+        }
+        # Un grafo por cabeza; el lote es de tamaño variable para no retrazar
+        self._graphs = {
+            name: tf.function(
+                self._make_head(name),
+                input_signature=[tf.TensorSpec(shape=[None, len(head["weights"])], dtype=tf.float32)],
+            )
+            for name, head in LINEAR_HEADS.items()
+        }
+
+    def _make_head(self, name: str):
+        tf = self._tf
+        weights = self.weights[name]
+        bias = self.bias[name]
+
+        def head(features):
+            return tf.sigmoid(tf.matmul(features, weights) + bias)[:, 0]
+
+        return head
+
+    def score(self, head: str, features: np.ndarray) -> np.ndarray:
+        return self._graphs[head](features).numpy()
+
+
+class LivenessScoringEngine:
+    """
+    Evalúa las cabezas de liveness y spoofing sobre uno o varios rostros.
+
+    backend="numpy" usa un producto matricial de NumPy; backend="tensorflow"
+    usa un grafo precompilado. Ambos devuelven un array de scores por rostro.
+    """
+
+    def __init__(self, backend: str = "numpy"):
+        if backend not in SCORING_BACKENDS:
+            raise ValueError(f"Backend de scoring desconocido: {backend}")
+
+        if backend == "tensorflow":
+            try:
+                self._heads = _TensorFlowHeads()
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo compilar el grafo TensorFlow de liveness ({e}), usando NumPy")
+                backend = "numpy"
+                self._heads = _NumpyHeads()
+        else:
+            self._heads = _NumpyHeads()
+
+        self.backend = backend
+        logger.info(f"✅ Motor de scoring de liveness: {self.backend}")
+
+    def score(self, head: str, features: np.ndarray) -> np.ndarray:
+        """Aplica una cabeza lineal a una matriz (N, k) de características"""
+        features = np.asarray(features, dtype=np.float32)
+        if features.size == 0:
+            return np.zeros(0, dtype=np.float32)
+        return self._heads.score(head, np.atleast_2d(features))
+
+    def score_liveness(self, contexts: List[FaceAnalysisContext]) -> np.ndarray:
+        """Scores de liveness para un lote de rostros"""
+        features = np.stack([liveness_features(context) for context in contexts]) if contexts else []
+        return self.score("liveness", features)
+
+    def score_spoofing(self, contexts: List[FaceAnalysisContext]) -> List[Dict[str, Any]]:
+        """Probabilidad de spoofing y scores por ataque para un lote de rostros"""
+        attack_scores = [spoofing_attack_scores(context) for context in contexts]
+        features = np.stack([spoofing_features(scores) for scores in attack_scores]) if attack_scores else []
+        probabilities = self.score("spoofing", features)
+        return [
+            {"probability": float(probability), "attack_scores": scores}
+            for probability, scores in zip(probabilities, attack_scores)
+        ]
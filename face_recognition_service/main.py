@@ -3,8 +3,8 @@ import numpy as np
 import os
 import logging
 # import mediapipe as mp  # Temporalmente deshabilitado por conflictos
-from fastapi import FastAPI, File, UploadFile, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
@@ -12,32 +12,48 @@ from PIL import Image
 import io
 import base64
 import json
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 import asyncio
+import time
 from datetime import datetime
 import asyncpg
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 from dotenv import load_dotenv
 import aiofiles
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.preprocessing import LabelEncoder
 import warnings
 # import face_recognition  # Requiere dlib - usar OpenCV por ahora
-import tensorflow as tf
-from tensorflow import keras
-from deepface import DeepFace
 import tempfile
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import hashlib
+import uuid
+
+from face_analysis import FaceAnalysisContext
+from liveness_scoring import LivenessScoringEngine
+from tensorflow_models import TensorFlowModelManager, SPOOFING_LABELS
+from lazy_imports import LazyModule
+from embedding_gallery import EmbeddingGallery, GallerySnapshot, RerankCache
+from gallery_snapshot import GallerySnapshotStore
+from embedding_storage import APPROXIMATE_PRECISIONS, GALLERY_PRECISIONS, cosine_to_confidence, deserialize_embedding, serialize_embedding
+from shared_gallery import SharedEmbeddingGallery, run_publisher_loop
+from gallery_sync import GallerySyncListener, install_triggers
+from camera_config_sync import CameraConfigBroadcaster, install_camera_triggers
+from edge_sync import EDGE_DECISIONS_TABLE_SQL, EDGE_RULES_SQL, build_edge_bundle, decrypt_decisions
+from enrollment import prune_enrollment_embeddings
+from serving_model import DEFAULT_EMBEDDING_MODEL, embedding_model_name, get_serving_model_id
+from user_aggregates import AGGREGATES_TABLE_SQL, AggregateCache, compute_user_aggregate, deserialize_aggregate, serialize_aggregate, two_stage_rows
+
+# DeepFace (y con él TensorFlow) se importa en el primer embedding, no al
+# arrancar: /health y /evidencias responden sin esperar a cargar TF
+DeepFace = LazyModule("deepface.DeepFace")
 
 # Cargar variables de entorno desde el archivo .env consolidado en la raíz
 load_dotenv(dotenv_path="../.env")
 
 # Suprimir warnings para output limpio
 warnings.filterwarnings('ignore')
-tf.get_logger().setLevel('ERROR')  # Suprimir warnings de TensorFlow
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")  # Suprimir warnings de TensorFlow (su logger se ajusta al importarlo)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -82,10 +98,64 @@ LIVENESS_THRESHOLD = float(os.getenv("LIVENESS_THRESHOLD", "0.7"))  # UMBRAL MUY
 MAX_IMAGE_SIZE = int(os.getenv("MAX_IMAGE_SIZE", "5242880"))  # 5MB
 ENABLE_TENSORFLOW = os.getenv("ENABLE_TENSORFLOW", "true").lower() == "true"
 TF_LIVENESS_THRESHOLD = float(os.getenv("TF_LIVENESS_THRESHOLD", "0.05"))  # Muy relajado para pruebas
+LIVENESS_SCORING_BACKEND = os.getenv("LIVENESS_SCORING_BACKEND", "numpy").lower()  # numpy | tensorflow
+TF_MODELS_DIR = os.getenv("TF_MODELS_DIR", "face_recognition_service/models")
+if not os.path.isabs(TF_MODELS_DIR):
+    # Rutas relativas a la raíz del proyecto (igual que el .env consolidado)
+    TF_MODELS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), TF_MODELS_DIR)
+LIVENESS_MODEL_BUDGET_MS = float(os.getenv("LIVENESS_MODEL_BUDGET_MS", "40"))
+SPOOFING_MODEL_BUDGET_MS = float(os.getenv("SPOOFING_MODEL_BUDGET_MS", "80"))
+MODEL_RUNTIME_BACKEND = os.getenv("MODEL_RUNTIME_BACKEND", "keras").lower()  # keras | tflite | onnx
+MODEL_PRELOAD = os.getenv("MODEL_PRELOAD", "true").lower() == "true"  # Carga en segundo plano al arrancar
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+WARMUP_STAGES = [stage.strip() for stage in os.getenv("WARMUP_STAGES", "detection,liveness,embedding,gallery").split(",") if stage.strip()]
+GALLERY_REFRESH_SECONDS = float(os.getenv("GALLERY_REFRESH_SECONDS", "60"))  # 0 = solo recargar al invalidar
+SERVICE_WORKERS = int(os.getenv("SERVICE_WORKERS", "1"))  # >1 = galería en memoria compartida
+GALLERY_SHM_NAME = os.getenv("GALLERY_SHM_NAME", "face_gallery")
+GALLERY_SNAPSHOT_PATH = os.getenv("GALLERY_SNAPSHOT_PATH", "face_recognition_service/cache/gallery.snap")  # vacío = deshabilitado
+if GALLERY_SNAPSHOT_PATH and not os.path.isabs(GALLERY_SNAPSHOT_PATH):
+    GALLERY_SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), GALLERY_SNAPSHOT_PATH)
+GALLERY_SNAPSHOT_SAVE_SECONDS = float(os.getenv("GALLERY_SNAPSHOT_SAVE_SECONDS", "300"))  # Intervalo mínimo entre escrituras
+GALLERY_PRECISION = os.getenv("GALLERY_PRECISION", "float32").lower()  # float64 | float32 | float16 | int8
+if GALLERY_PRECISION not in GALLERY_PRECISIONS:
+    logger.warning(f"⚠️ GALLERY_PRECISION inválida ({GALLERY_PRECISION}), usando float32")
+    GALLERY_PRECISION = "float32"
+GALLERY_RERANK_K = int(os.getenv("GALLERY_RERANK_K", "10"))  # Candidatos re-puntuados en precisión completa
+GALLERY_RERANK_CACHE_SIZE = int(os.getenv("GALLERY_RERANK_CACHE_SIZE", "20000"))  # Embeddings completos en memoria para el re-ranking
+GALLERY_NOTIFY = os.getenv("GALLERY_NOTIFY", "true").lower() == "true"  # Sincronizar con LISTEN/NOTIFY
+CAMERA_CONFIG_NOTIFY = os.getenv("CAMERA_CONFIG_NOTIFY", "true").lower() == "true"  # Avisos de cambios de cámara (/events/camaras)
+CAMERA_EVENTS_KEEPALIVE_SECONDS = float(os.getenv("CAMERA_EVENTS_KEEPALIVE_SECONDS", "15"))
+EDGE_SYNC_KEY = os.getenv("EDGE_SYNC_KEY", "")  # Clave Fernet de los kioscos (vacía = modo sin conexión deshabilitado)
+GALLERY_AGGREGATES = os.getenv("GALLERY_AGGREGATES", "false").lower() == "true"  # Primera etapa por centroide + medoides
+AGGREGATE_MEDOIDS = int(os.getenv("AGGREGATE_MEDOIDS", "3"))
+AGGREGATE_TOP_USERS = int(os.getenv("AGGREGATE_TOP_USERS", "5"))  # Usuarios que pasan a la segunda etapa
+ENROLL_DUPLICATE_THRESHOLD = float(os.getenv("ENROLL_DUPLICATE_THRESHOLD", "0.95"))  # Coseno a partir del cual es duplicado
+ENROLL_MAX_FACES_PER_USER = int(os.getenv("ENROLL_MAX_FACES_PER_USER", "20"))  # 0 = sin límite
+ENROLL_COLLISION_POLICY = os.getenv("ENROLL_COLLISION_POLICY", "reject").lower()  # reject | flag | off
+# Lo fija el lanzador multi-worker para que cada worker lea la galería compartida
+GALLERY_SHARED_MEMORY = os.getenv("GALLERY_SHARED_MEMORY", "false").lower() == "true"
 
 # Inicializar cifrado
 cipher_suite = Fernet(ENCRYPTION_KEY)
 
+# Cifrado de los paquetes y decisiones de los kioscos (edge_sync.py)
+edge_cipher: Optional[Fernet] = None
+if EDGE_SYNC_KEY:
+    try:
+        edge_cipher = Fernet(EDGE_SYNC_KEY.encode())
+    except Exception as e:
+        logger.warning(f"❌ EDGE_SYNC_KEY inválida, modo sin conexión deshabilitado: {e}")
+
+# Motor de scoring de liveness/spoofing (pesos cargados una sola vez)
+liveness_engine = LivenessScoringEngine(LIVENESS_SCORING_BACKEND)
+
+# Modelos CNN de liveness/spoofing (se cargan en startup_event)
+model_manager = TensorFlowModelManager(
+    TF_MODELS_DIR,
+    latency_budgets_ms={"liveness": LIVENESS_MODEL_BUDGET_MS, "spoofing": SPOOFING_MODEL_BUDGET_MS},
+    backend=MODEL_RUNTIME_BACKEND
+)
+
 # MediaPipe temporalmente deshabilitado
 # mp_face_detection = mp.solutions.face_detection
 # mp_drawing = mp.solutions.drawing_utils
@@ -107,6 +177,7 @@ class FaceRecognitionRequest(BaseModel):
     image_base64: str
     punto_control_id: int
     check_liveness: bool = True
+    id_solicitud: Optional[str] = None  # UUID del kiosco (deduplica el reenvío sin conexión)
 
 class FaceRecognitionResponse(BaseModel):
     success: bool
@@ -128,6 +199,9 @@ class FaceEnrollmentResponse(BaseModel):
     faces_processed: int
     average_quality: float
     message: str
+    faces_pruned: int = 0  # Casi duplicados o por encima del límite por usuario
+    pruning: Optional[Dict[str, int]] = None
+    collisions: List[Dict[str, Any]] = []  # Rostros que coinciden con otros usuarios
 
 # Funciones auxiliares
 def decode_base64_image(image_base64: str) -> np.ndarray:
@@ -140,16 +214,33 @@ def decode_base64_image(image_base64: str) -> np.ndarray:
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error decodificando imagen: {str(e)}")
 
+def decode_image_bytes(image_data: bytes) -> np.ndarray:
+    """Decodifica una imagen (JPEG/PNG) recibida como bytes"""
+    image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise HTTPException(status_code=400, detail="Error decodificando imagen")
+    return image
+
+def parse_int_list(value: str, count: int, field: str) -> List[int]:
+    """Lista de enteros separados por coma de un campo de formulario ("x,y,w,h")"""
+    try:
+        numbers = [int(round(float(v))) for v in value.split(',')]
+    except ValueError:
+        numbers = []
+    if len(numbers) != count:
+        raise HTTPException(status_code=400, detail=f"{field} debe tener {count} valores separados por coma")
+    return numbers
+
 def encrypt_embedding(embedding: np.ndarray) -> bytes:
-    """Cifra un embedding facial"""
-    embedding_bytes = embedding.tobytes()
+    """Cifra un embedding facial (float32, ver embedding_storage)"""
+    embedding_bytes = serialize_embedding(embedding)
     encrypted = cipher_suite.encrypt(embedding_bytes)
     return encrypted
 
 def decrypt_embedding(encrypted_embedding: bytes) -> np.ndarray:
-    """Descifra un embedding facial"""
+    """Descifra un embedding facial (float32 actual o float64 heredado)"""
     decrypted_bytes = cipher_suite.decrypt(encrypted_embedding)
-    embedding = np.frombuffer(decrypted_bytes, dtype=np.float64)
+    embedding = deserialize_embedding(decrypted_bytes)
     return embedding
 
 def generate_deepface_embedding(face_roi: np.ndarray, model_name: str = "ArcFace") -> np.ndarray:
@@ -231,15 +322,15 @@ def compare_faces_deepface(face1_path: str, face2_path: str, model_name: str = "
         logger.warning(f"Error en comparación DeepFace: {str(e)}")
         return False, 1.0
 
-def generate_face_embedding(face_roi: np.ndarray) -> np.ndarray:
+def generate_face_embedding(face_roi: np.ndarray, model_name: str = DEFAULT_EMBEDDING_MODEL) -> np.ndarray:
     """
     Función principal para generar embeddings faciales
-    SOLO DeepFace ArcFace - SIN fallback híbrido
+    SOLO DeepFace (ArcFace, o el modelo que sirve la galería) - SIN fallback híbrido
     """
-    logger.info("🧠 GENERANDO EMBEDDING CON DEEPFACE ArcFace")
+    logger.info(f"🧠 GENERANDO EMBEDDING CON DEEPFACE {model_name}")
     
     try:
-        embedding = generate_deepface_embedding(face_roi, model_name="ArcFace")
+        embedding = generate_deepface_embedding(face_roi, model_name=model_name)
         
         # Verificar que sea DeepFace (512 dimensiones)
         if len(embedding) != 512:
@@ -452,30 +543,69 @@ def calculate_face_quality(face_encoding: np.ndarray, face_location: tuple) -> f
     quality = (size_quality + variance_quality) / 2
     return float(quality)
 
-def detect_liveness(image: np.ndarray, face_location: tuple) -> float:
+def extract_enrollment_face(image: np.ndarray, label: str = "imagen",
+                            model_name: str = DEFAULT_EMBEDDING_MODEL) -> tuple:
+    """
+    Criterios de registro de un rostro, compartidos por /enroll-face, la
+    importación masiva (bulk_enroll.py) y el re-embedding (reembed_gallery.py):
+    solo el PRIMER rostro detectado, nitidez >= 20 y calidad >= 0.3.
+    Retorna (embedding o None, calidad, motivo del descarte)
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    faces = face_cascade.detectMultiScale(gray, 1.1, 4)
+    logger.info(f"Detectados {len(faces)} rostros en {label}")
+    if len(faces) == 0:
+        logger.warning(f"No se detectaron rostros en {label}")
+        return None, 0.0, "sin_rostro"
+
+    # SOLO procesar el PRIMER rostro detectado para evitar múltiples registros
+    x, y, w, h = faces[0]
+    face_location = (y, x + w, y + h, x)
+    face_roi = image[y:y + h, x:x + w]
+    if face_roi.size == 0:
+        return None, 0.0, "sin_rostro"
+
+    # Verificar calidad antes de procesar
+    gray_roi = cv2.cvtColor(face_roi, cv2.COLOR_BGR2GRAY)
+    laplacian_var = cv2.Laplacian(gray_roi, cv2.CV_64F).var()
+    if laplacian_var < 20:  # Mismo umbral que reconocimiento
+        logger.warning(f"⚠️ Rostro descartado en {label}: muy borroso (nitidez: {laplacian_var:.1f})")
+        return None, 0.0, "borroso"
+
+    try:
+        face_encoding = generate_face_embedding(face_roi, model_name)
+    except Exception as e:
+        logger.warning(f"Error generando embedding para rostro en {label}: {str(e)}")
+        return None, 0.0, "error_embedding"
+    logger.info(f"✅ Rostro registrado en {label}: nitidez {laplacian_var:.1f}")
+
+    quality = calculate_face_quality(face_encoding, face_location)
+    logger.info(f"Calidad calculada para {label}: {quality}")
+    if quality < 0.3:  # Umbral mínimo de calidad
+        logger.warning(f"Calidad insuficiente en {label}: {quality}")
+        return None, quality, "calidad_baja"
+    return face_encoding, quality, ""
+
+def detect_liveness(image: np.ndarray, face_location: tuple, context: Optional[FaceAnalysisContext] = None) -> float:
     """Detección ULTRA ESTRICTA de anti-spoofing"""
     try:
-        top, right, bottom, left = face_location
-        face_roi = image[top:bottom, left:right]
+        context = context or FaceAnalysisContext(image, face_location)
         
-        if face_roi.size == 0:
+        if context.is_empty:
             logger.warning("🚫 LIVENESS: ROI vacío")
             return 0.0  # FALLO automático
         
-        # Convertir a escala de grises
-        gray_face = cv2.cvtColor(face_roi, cv2.COLOR_BGR2GRAY)
-        
         # 1. ANÁLISIS DE NITIDEZ (detecta fotos borrosas)
-        laplacian_var = cv2.Laplacian(gray_face, cv2.CV_64F).var()
+        laplacian_var = context.laplacian_var
         logger.info(f"📊 LIVENESS - Nitidez: {laplacian_var:.2f}")
         
         # 2. ANÁLISIS DE BORDES (detecta pantallas)
-        edges = cv2.Canny(gray_face, 50, 150)
-        edge_density = np.sum(edges > 0) / edges.size
+        edge_density = context.edge_density
         logger.info(f"📊 LIVENESS - Densidad bordes: {edge_density:.3f}")
         
         # 3. ANÁLISIS DE CONTRASTE (detecta fotos planas)
-        contrast = gray_face.std()
+        contrast = context.contrast
         logger.info(f"📊 LIVENESS - Contraste: {contrast:.2f}")
         
         # CRITERIOS MÁS PERMISIVOS PARA CÁMARAS WEB
@@ -501,60 +631,24 @@ def detect_liveness(image: np.ndarray, face_location: tuple) -> float:
         logger.error(f"Error en detección de liveness: {str(e)}")
         return 0.0  # FALLO en caso de error
 
-def advanced_liveness_tensorflow(image: np.ndarray, face_location: tuple) -> float:
+def advanced_liveness_tensorflow(image: np.ndarray, face_location: tuple, context: Optional[FaceAnalysisContext] = None) -> float:
     """Detección avanzada de liveness usando TensorFlow"""
+    context = context or FaceAnalysisContext(image, face_location)
     if not ENABLE_TENSORFLOW:
-        return detect_liveness(image, face_location)
+        return detect_liveness(image, face_location, context)
     
     try:
-        top, right, bottom, left = face_location
-        face_roi = image[top:bottom, left:right]
-        
-        if face_roi.size == 0:
+        if context.is_empty:
             return 0.0
         
-        # Redimensionar rostro para análisis
-        face_resized = cv2.resize(face_roi, (64, 64))
-        face_normalized = face_resized.astype(np.float32) / 255.0
-        
-        # Análisis de textura avanzado con TensorFlow
-        gray_face = cv2.cvtColor(face_resized, cv2.COLOR_BGR2GRAY)
-        
-        # Calcular múltiples características
-        # 1. Varianza de Laplaciano (nitidez)
-        laplacian_var = cv2.Laplacian(gray_face, cv2.CV_64F).var()
-        
-        # 2. Análisis de frecuencias usando FFT
-        f_transform = np.fft.fft2(gray_face)
-        f_shift = np.fft.fftshift(f_transform)
-        magnitude_spectrum = np.log(np.abs(f_shift) + 1)
-        frequency_score = np.std(magnitude_spectrum)
-        
-        # 3. Análisis de gradientes
-        grad_x = cv2.Sobel(gray_face, cv2.CV_64F, 1, 0, ksize=3)
-        grad_y = cv2.Sobel(gray_face, cv2.CV_64F, 0, 1, ksize=3)
-        gradient_magnitude = np.sqrt(grad_x**2 + grad_y**2)
-        gradient_score = np.mean(gradient_magnitude)
-        
-        # 4. Análisis de patrones locales (LBP simulado)
-        lbp_score = np.std(gray_face)
-        
-        # Combinar características usando TensorFlow
-        features = tf.constant([[
-            laplacian_var / 500.0,
-            frequency_score / 10.0,
-            gradient_score / 50.0,
-            lbp_score / 100.0
-        ]], dtype=tf.float32)
-        
-        # Red neuronal simple para clasificación de liveness
-        # (En producción, cargarías un modelo pre-entrenado)
-        weights = tf.constant([[0.3], [0.25], [0.25], [0.2]], dtype=tf.float32)
-        bias = tf.constant([0.1], dtype=tf.float32)
-        
-        # Cálculo de score
-        raw_score = tf.matmul(features, weights) + bias
-        liveness_score = tf.sigmoid(raw_score).numpy()[0][0]
+        # Modelo CNN entrenado si existe el archivo; si no, heurística lineal
+        # get_model carga el modelo en su primer uso; None si falta o no cargó
+        if model_manager.is_model_available("liveness") and model_manager.get_model("liveness") is not None:
+            return float(model_manager.predict_liveness([context.roi_rgb])[0])
+        
+        # Características sobre el rostro 64x64 compartido (nitidez, FFT,
+        # gradientes y textura) evaluadas por la cabeza lineal precompilada
+        liveness_score = liveness_engine.score_liveness([context])[0]
         
         # Aplicar umbral más estricto para TensorFlow
         return float(liveness_score)
@@ -562,66 +656,30 @@ def advanced_liveness_tensorflow(image: np.ndarray, face_location: tuple) -> flo
     except Exception as e:
         logger.warning(f"Error en liveness TensorFlow: {str(e)}")
         # Fallback a método básico
-        return detect_liveness(image, face_location)
+        return detect_liveness(image, face_location, context)
 
-def detect_spoofing_tensorflow(image: np.ndarray, face_location: tuple) -> dict:
+def detect_spoofing_tensorflow(image: np.ndarray, face_location: tuple, context: Optional[FaceAnalysisContext] = None) -> dict:
     """Detección de ataques de spoofing usando TensorFlow"""
     if not ENABLE_TENSORFLOW:
         return {"spoofing_detected": False, "confidence": 0.5, "attack_type": "none"}
     
     try:
-        top, right, bottom, left = face_location
-        face_roi = image[top:bottom, left:right]
+        context = context or FaceAnalysisContext(image, face_location)
         
-        if face_roi.size == 0:
+        if context.is_empty:
             return {"spoofing_detected": True, "confidence": 1.0, "attack_type": "invalid_face"}
         
-        # Redimensionar para análisis
-        face_resized = cv2.resize(face_roi, (128, 128))
-        face_normalized = face_resized.astype(np.float32) / 255.0
-        
-        # Análisis de diferentes tipos de ataques
-        results = {}
-        
-        # 1. Detección de foto impresa (análisis de bordes)
-        gray = cv2.cvtColor(face_resized, cv2.COLOR_BGR2GRAY)
-        edges = cv2.Canny(gray, 50, 150)
-        edge_density = np.sum(edges > 0) / edges.size
-        
-        # Las fotos impresas tienden a tener bordes más definidos
-        photo_attack_score = 1.0 if edge_density > 0.15 else edge_density / 0.15
-        
-        # 2. Detección de pantalla (análisis de píxeles)
-        # Las pantallas tienen patrones de píxeles regulares
-        hsv = cv2.cvtColor(face_resized, cv2.COLOR_BGR2HSV)
-        saturation_var = np.var(hsv[:,:,1])
-        screen_attack_score = 1.0 if saturation_var < 200 else (400 - saturation_var) / 200
-        
-        # 3. Análisis de profundidad simulado
-        # Usar gradientes para estimar profundidad
-        grad_x = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=3)
-        grad_y = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3)
-        depth_variation = np.std(np.sqrt(grad_x**2 + grad_y**2))
-        
-        # Rostros reales tienen más variación de profundidad
-        depth_score = 1.0 - min(1.0, depth_variation / 30.0)
+        # Modelo CNN entrenado si existe el archivo; si no, heurísticas
+        if model_manager.is_model_available("spoofing") and model_manager.get_model("spoofing") is not None:
+            return spoofing_result_from_model(model_manager.predict_spoofing([context.roi_rgb])[0])
         
-        # Combinar scores usando TensorFlow
-        features = tf.constant([[photo_attack_score, screen_attack_score, depth_score]], dtype=tf.float32)
-        
-        # Red neuronal para clasificación de ataques
-        attack_weights = tf.constant([[0.4], [0.3], [0.3]], dtype=tf.float32)
-        attack_bias = tf.constant([0.0], dtype=tf.float32)
-        
-        spoofing_probability = tf.sigmoid(tf.matmul(features, attack_weights) + attack_bias).numpy()[0][0]
+        # Análisis de foto impresa, pantalla y profundidad sobre el rostro
+        # 128x128 compartido, combinados por la cabeza lineal precompilada
+        spoofing = liveness_engine.score_spoofing([context])[0]
+        spoofing_probability = spoofing["probability"]
+        attack_scores = spoofing["attack_scores"]
         
         # Determinar tipo de ataque más probable
-        attack_scores = {
-            "photo": photo_attack_score,
-            "screen": screen_attack_score,
-            "mask": depth_score
-        }
-        
         most_likely_attack = max(attack_scores.items(), key=lambda x: x[1])
         
         return {
@@ -635,6 +693,19 @@ def detect_spoofing_tensorflow(image: np.ndarray, face_location: tuple) -> dict:
         logger.warning(f"Error en detección de spoofing: {str(e)}")
         return {"spoofing_detected": False, "confidence": 0.5, "attack_type": "error"}
 
+def spoofing_result_from_model(probabilities: np.ndarray) -> dict:
+    """Convierte la salida softmax (real, photo, screen) del modelo de spoofing"""
+    class_scores = {label: float(p) for label, p in zip(SPOOFING_LABELS, probabilities)}
+    spoofing_probability = 1.0 - class_scores["real"]
+    attack_type = max(("photo", "screen"), key=lambda label: class_scores[label])
+    
+    return {
+        "spoofing_detected": spoofing_probability > 0.8,  # Mismo criterio que la heurística
+        "confidence": spoofing_probability,
+        "attack_type": attack_type if spoofing_probability > 0.8 else "none",
+        "detailed_scores": class_scores
+    }
+
 async def get_db_connection():
     """Obtiene conexión a la base de datos"""
     try:
@@ -964,17 +1035,34 @@ async def send_email_alert(tipo_alerta: str, detalle: str, punto: str, fecha: st
         logger.error(f"❌ Error al enviar email: {str(e)}")
         return False
 
-async def get_user_embeddings():
-    """Obtiene todos los embeddings de usuarios de la base de datos"""
+async def get_user_embeddings(after_id: Optional[int] = None, include_ids: Optional[List[int]] = None,
+                              user_ids: Optional[List[int]] = None, model_id: Optional[int] = None):
+    """
+    Obtiene los embeddings de usuarios activos de la base de datos.
+    Con `after_id`/`include_ids` solo trae las filas posteriores a esa marca
+    de agua más las indicadas (delta sobre el snapshot en disco); con
+    `include_ids`/`user_ids` sin marca de agua, solo esas filas y usuarios.
+    Con `model_id` solo las filas de ese modelo (el que sirve la galería).
+    """
     conn = await get_db_connection()
     try:
         query = """
-        SELECT r.id, r.usuario_id, r.embedding, u.activo
+        SELECT r.id, r.usuario_id, r.embedding, r.creado_en, r.modelo_id, u.activo
         FROM rostros r
         JOIN usuarios u ON r.usuario_id = u.id
         WHERE u.activo = true
         """
-        rows = await conn.fetch(query)
+        params: List[Any] = []
+        if model_id is not None:
+            params.append(model_id)
+            query += f" AND r.modelo_id = ${len(params)}"
+        if after_id is not None:
+            params += [after_id, include_ids or []]
+            query += f" AND (r.id > ${len(params) - 1} OR r.id = ANY(${len(params)}::int[]))"
+        elif include_ids is not None or user_ids is not None:
+            params += [include_ids or [], user_ids or []]
+            query += f" AND (r.id = ANY(${len(params) - 1}::int[]) OR r.usuario_id = ANY(${len(params)}::int[]))"
+        rows = await conn.fetch(query, *params)
         
         embeddings = []
         decryption_errors = 0
@@ -984,7 +1072,9 @@ async def get_user_embeddings():
                 embeddings.append({
                     'id': row['id'],
                     'usuario_id': row['usuario_id'],
-                    'embedding': decrypted_embedding
+                    'embedding': decrypted_embedding,
+                    'creado_en': row['creado_en'],
+                    'modelo_id': row['modelo_id']
                 })
             except Exception as e:
                 decryption_errors += 1
@@ -992,24 +1082,452 @@ async def get_user_embeddings():
         if decryption_errors > 0:
             logger.warning(f"Could not decrypt {decryption_errors} embeddings (likely from previous sessions with different encryption keys)")
         
+        if GALLERY_PRECISION in APPROXIMATE_PRECISIONS and not GALLERY_SHARED_MEMORY:
+            # Ya descifrados: el re-ranking del top-k no vuelve a la base por ellos
+            rerank_cache.put_many((entry['id'], entry['embedding']) for entry in embeddings)
+        
+        return embeddings
+    finally:
+        await conn.close()
+
+async def get_embeddings_by_ids(embedding_ids: List[int]) -> Dict[int, np.ndarray]:
+    """Embeddings en precisión completa de filas concretas (re-ranking del top-k)"""
+    conn = await get_db_connection()
+    try:
+        rows = await conn.fetch("SELECT id, embedding FROM rostros WHERE id = ANY($1::int[])", embedding_ids)
+        embeddings = {}
+        for row in rows:
+            try:
+                embeddings[row['id']] = decrypt_embedding(row['embedding'])
+            except Exception:
+                pass
         return embeddings
     finally:
         await conn.close()
 
+async def get_active_embedding_ids(model_id: Optional[int] = None) -> List[int]:
+    """Ids de `rostros` de usuarios activos (sin leer ni descifrar embeddings)"""
+    conn = await get_db_connection()
+    try:
+        rows = await conn.fetch("""
+            SELECT r.id FROM rostros r
+            JOIN usuarios u ON r.usuario_id = u.id
+            WHERE u.activo = true AND ($1::int IS NULL OR r.modelo_id = $1)
+        """, model_id)
+        return [row['id'] for row in rows]
+    finally:
+        await conn.close()
+
+async def load_serving_model_id() -> Optional[int]:
+    """`modelos_faciales.id` que sirve la galería (None = todas las filas, ArcFace)"""
+    conn = await get_db_connection()
+    try:
+        return await get_serving_model_id(conn)
+    finally:
+        await conn.close()
+
+# Nombre de DeepFace por modelo_id (una fila de modelos_faciales no cambia de modelo)
+embedding_model_names: Dict[int, str] = {}
+
+async def get_embedding_model(model_id: Optional[int]) -> str:
+    """Modelo de DeepFace con el que se generan consultas contra esa galería"""
+    if model_id is None:
+        return DEFAULT_EMBEDDING_MODEL
+    if model_id not in embedding_model_names:
+        conn = await get_db_connection()
+        try:
+            name = await conn.fetchval("SELECT nombre FROM modelos_faciales WHERE id = $1", model_id)
+        finally:
+            await conn.close()
+        embedding_model_names[model_id] = embedding_model_name(name)
+    return embedding_model_names[model_id]
+
+# Snapshot cifrado en disco: evita descifrar toda la tabla rostros al reiniciar
+gallery_store = GallerySnapshotStore(GALLERY_SNAPSHOT_PATH, ENCRYPTION_KEY, GALLERY_PRECISION) if GALLERY_SNAPSHOT_PATH else None
+gallery_base: Dict[str, Any] = {"snapshot": None, "high_water": None, "pendiente_guardar": False}
+
+def update_high_water(high_water: Optional[Dict[str, Any]], entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Avanza max(rostros.id) y max(creado_en) con las filas nuevas"""
+    high_water = dict(high_water or {"max_id": 0, "max_creado_en": None})
+    for entry in entries:
+        high_water["max_id"] = max(high_water["max_id"] or 0, entry['id'])
+        creado_en = entry.get('creado_en')
+        if creado_en is not None:
+            creado_en = creado_en.isoformat()
+            if high_water["max_creado_en"] is None or creado_en > high_water["max_creado_en"]:
+                high_water["max_creado_en"] = creado_en
+    return high_water
+
+async def load_gallery_snapshot() -> GallerySnapshot:
+    """
+    Loader de la galería: parte del snapshot en disco (o del último cargado) y
+    solo descifra las filas nuevas. Las filas borradas o de usuarios
+    desactivados se descartan comparando con los ids activos. Si cambió el
+    modelo que sirve la galería (re-embedding), la carga es completa.
+    """
+    model_id = await load_serving_model_id()
+    if gallery_store is None:
+        return GallerySnapshot.from_entries(await get_user_embeddings(model_id=model_id), precision=GALLERY_PRECISION,
+                                            model_id=model_id)
+    
+    if gallery_base["snapshot"] is None:
+        loaded = await asyncio.to_thread(gallery_store.load)
+        if loaded:
+            gallery_base["snapshot"], gallery_base["high_water"] = loaded
+    
+    base = gallery_base["snapshot"]
+    if base is not None and base.model_id != model_id:
+        logger.info(f"🔁 La galería pasa del modelo {base.model_id} al {model_id}: carga completa")
+        base = None
+    if base is None:
+        entries = await get_user_embeddings(model_id=model_id)
+        snapshot = GallerySnapshot.from_entries(entries, precision=GALLERY_PRECISION, model_id=model_id)
+        high_water = update_high_water(None, entries)
+        changed = True
+    else:
+        high_water = gallery_base["high_water"]
+        active_ids = np.array(await get_active_embedding_ids(model_id), dtype=np.int64)
+        removed = base.ids[~np.isin(base.ids, active_ids)]
+        # Filas antiguas que no están en el snapshot (p. ej. usuario reactivado)
+        missing = active_ids[(active_ids <= high_water["max_id"]) & ~np.isin(active_ids, base.ids)]
+        delta = await get_user_embeddings(after_id=high_water["max_id"], include_ids=missing.tolist(), model_id=model_id)
+        snapshot = base.with_changes(removed_ids=removed, added=delta)
+        high_water = update_high_water(high_water, delta)
+        changed = bool(delta) or removed.size > 0
+        logger.info(f"🗂️ Delta de galería: {len(delta)} nuevas, {removed.size} retiradas")
+    
+    gallery_base["snapshot"], gallery_base["high_water"] = snapshot, high_water
+    gallery_base["pendiente_guardar"] = gallery_base["pendiente_guardar"] or changed
+    
+    # Escribir a disco como máximo cada GALLERY_SNAPSHOT_SAVE_SECONDS
+    due = gallery_store.last_saved is None or time.monotonic() - gallery_store.last_saved >= GALLERY_SNAPSHOT_SAVE_SECONDS
+    if gallery_base["pendiente_guardar"] and (due or not gallery_store.exists):
+        try:
+            await asyncio.to_thread(gallery_store.save, snapshot, high_water)
+            gallery_base["pendiente_guardar"] = False
+        except Exception as e:
+            logger.error(f"❌ Error guardando snapshot de galería: {str(e)}")
+    return snapshot
+
+# Galería en memoria (se recarga al registrar rostros o cada GALLERY_REFRESH_SECONDS).
+# Con varios workers la carga un único proceso y los workers la mapean en solo lectura
+if GALLERY_SHARED_MEMORY:
+    gallery = SharedEmbeddingGallery(GALLERY_SHM_NAME)
+else:
+    gallery = EmbeddingGallery(load_gallery_snapshot, refresh_seconds=GALLERY_REFRESH_SECONDS, precision=GALLERY_PRECISION)
+
+# Embeddings en precisión completa del re-ranking (galería float16/int8). Con
+# memoria compartida la carga ocurre en otro proceso: cada worker lo llena con
+# sus primeros fallos
+rerank_cache = RerankCache(GALLERY_RERANK_CACHE_SIZE if GALLERY_PRECISION in APPROXIMATE_PRECISIONS else 0)
+
+async def match_gallery(snapshot: GallerySnapshot, face_encoding: np.ndarray,
+                        rows: Optional[np.ndarray] = None) -> List[tuple]:
+    """
+    Búsqueda 1:N vectorizada: (fila, id de rostro, confianza) de los
+    GALLERY_RERANK_K mejores candidatos. Con galería float16/int8 se
+    re-puntúan en precisión completa (desde rerank_cache; solo los que falten
+    se leen de la base).
+    """
+    found_rows, cosines = snapshot.search(face_encoding, GALLERY_RERANK_K, rows=rows)
+    candidate_ids = [int(snapshot.ids[row]) for row in found_rows]
+    confidences = dict(zip(candidate_ids, cosine_to_confidence(cosines)))
+    
+    if snapshot.precision in APPROXIMATE_PRECISIONS and candidate_ids:
+        full_embeddings = rerank_cache.get_many(candidate_ids)
+        missing_ids = [embedding_id for embedding_id in candidate_ids if embedding_id not in full_embeddings]
+        if missing_ids:
+            fetched = await get_embeddings_by_ids(missing_ids)
+            rerank_cache.put_many(fetched.items())
+            full_embeddings.update(fetched)
+        for embedding_id, stored_embedding in full_embeddings.items():
+            confidences[embedding_id] = calculate_similarity_score(face_encoding, stored_embedding)
+    
+    return [(int(row), embedding_id, float(confidences[embedding_id]))
+            for row, embedding_id in zip(found_rows, candidate_ids)]
+
+async def find_enrollment_collisions(user_id: int, embeddings: List[np.ndarray],
+                                     image_numbers: List[int]) -> List[Dict[str, Any]]:
+    """Rostros nuevos que otro usuario de la galería ya reconoce con CONFIDENCE_THRESHOLD"""
+    if ENROLL_COLLISION_POLICY == "off" or not embeddings:
+        return []
+    snapshot = await gallery.get()
+    other_rows = np.flatnonzero(snapshot.user_ids != user_id)
+    
+    collisions = []
+    for embedding, image_number in zip(embeddings, image_numbers):
+        matches = await match_gallery(snapshot, embedding, other_rows)
+        if not matches:
+            continue
+        row, embedding_id, confidence = max(matches, key=lambda match: match[2])
+        if confidence >= CONFIDENCE_THRESHOLD:
+            other_user = int(snapshot.user_ids[row])
+            collisions.append({"imagen": image_number, "usuario_id": other_user, "confianza": round(confidence, 4)})
+            logger.warning(f"⚠️ Colisión en registro: imagen {image_number} del usuario {user_id} "
+                           f"coincide con usuario {other_user} ({confidence:.3f})")
+    return collisions
+
+# ============================================================
+# AGREGADOS POR USUARIO - Centroide + medoides (primera etapa)
+# ============================================================
+async def load_user_aggregates(model_id: Optional[int] = None) -> Dict[int, Tuple[np.ndarray, int]]:
+    """
+    Agregados descifrados de usuarios activos calculados con `model_id` (el
+    de la galería; None = sin filtrar): {usuario_id: (vectores, num_rostros)}
+    """
+    conn = await get_db_connection()
+    try:
+        rows = await conn.fetch("""
+            SELECT a.usuario_id, a.vectores, a.num_rostros
+            FROM rostros_agregados a
+            JOIN usuarios u ON a.usuario_id = u.id
+            WHERE u.activo = true AND ($1::int IS NULL OR a.modelo_id = $1)
+        """, model_id)
+        aggregates = {}
+        for row in rows:
+            try:
+                aggregates[row['usuario_id']] = (deserialize_aggregate(cipher_suite.decrypt(row['vectores'])),
+                                                 row['num_rostros'])
+            except Exception as e:
+                logger.warning(f"⚠️ Agregado del usuario {row['usuario_id']} ilegible: {str(e)}")
+        return aggregates
+    finally:
+        await conn.close()
+
+async def update_user_aggregate(conn, user_id: int, model_id: Optional[int] = None,
+                                serving_model_id: Optional[int] = None):
+    """Recalcula centroide + medoides con todos los rostros del usuario (del modelo que sirve la galería)"""
+    rows = await conn.fetch("SELECT embedding FROM rostros WHERE usuario_id = $1 AND ($2::int IS NULL OR modelo_id = $2)",
+                            user_id, serving_model_id)
+    embeddings = []
+    for row in rows:
+        try:
+            embedding = decrypt_embedding(row['embedding'])
+            if len(embedding) == 512:
+                embeddings.append(embedding)
+        except Exception:
+            continue
+    if not embeddings:
+        await conn.execute("DELETE FROM rostros_agregados WHERE usuario_id = $1", user_id)
+        return
+    
+    vectors = compute_user_aggregate(embeddings, AGGREGATE_MEDOIDS)
+    await conn.execute("""
+        INSERT INTO rostros_agregados (usuario_id, vectores, num_rostros, num_medoides, modelo_id, actualizado_en)
+        VALUES ($1, $2, $3, $4, $5, NOW())
+        ON CONFLICT (usuario_id) DO UPDATE SET
+            vectores = EXCLUDED.vectores, num_rostros = EXCLUDED.num_rostros,
+            num_medoides = EXCLUDED.num_medoides, modelo_id = EXCLUDED.modelo_id, actualizado_en = NOW()
+    """, user_id, cipher_suite.encrypt(serialize_aggregate(vectors)), len(embeddings), len(vectors) - 1, model_id)
+    logger.info(f"👥 Agregado del usuario {user_id} actualizado: {len(embeddings)} rostros → {len(vectors)} vectores")
+
+aggregate_cache = AggregateCache(load_user_aggregates, refresh_seconds=GALLERY_REFRESH_SECONDS)
+
+# Cambios hechos fuera del servicio (dashboard, scripts) llegan por LISTEN/NOTIFY
+gallery_sync: Optional[GallerySyncListener] = None
+
+async def start_gallery_sync(target_gallery) -> Optional[GallerySyncListener]:
+    """Instala los triggers y empieza a escuchar cambios de rostros/usuarios"""
+    global gallery_sync
+    try:
+        conn = await get_db_connection()
+        try:
+            await install_triggers(conn)
+        finally:
+            await conn.close()
+    except Exception as e:
+        # Sin triggers la galería sigue recargándose cada GALLERY_REFRESH_SECONDS
+        logger.error(f"❌ No se pudieron instalar los triggers de galería: {str(e)}")
+        return None
+    
+    gallery_sync = GallerySyncListener(
+        DATABASE_URL,
+        target_gallery,
+        # Solo filas del modelo que sirve la galería (las de un re-embedding en curso se ignoran)
+        lambda embedding_ids, user_ids: get_user_embeddings(include_ids=embedding_ids, user_ids=user_ids,
+                                                            model_id=target_gallery.snapshot.model_id),
+    )
+    gallery_sync.start()
+    return gallery_sync
+
+# Cambios de cámara de los puntos de control, reenviados a los kioscos por SSE
+camera_events: Optional[CameraConfigBroadcaster] = None
+
+async def start_camera_events() -> Optional[CameraConfigBroadcaster]:
+    """Instala el trigger de puntos_control y empieza a escuchar cambios de cámara"""
+    global camera_events
+    try:
+        conn = await get_db_connection()
+        try:
+            await install_camera_triggers(conn)
+        finally:
+            await conn.close()
+    except Exception as e:
+        # Sin trigger los kioscos solo revalidan su caché al arrancar la cámara
+        logger.error(f"❌ No se pudo instalar el trigger de cámaras: {str(e)}")
+        return None
+    
+    camera_events = CameraConfigBroadcaster(DATABASE_URL)
+    camera_events.start()
+    return camera_events
+
+async def serve_shared_gallery():
+    """Galería local del proceso cargador, sincronizada y publicada a los workers"""
+    local_gallery = EmbeddingGallery(load_gallery_snapshot, refresh_seconds=GALLERY_REFRESH_SECONDS, precision=GALLERY_PRECISION)
+    if GALLERY_NOTIFY:
+        await start_gallery_sync(local_gallery)
+    await run_publisher_loop(GALLERY_SHM_NAME, local_gallery)
+
+def run_gallery_loader():
+    """Proceso cargador de la galería compartida (modo multi-worker)"""
+    import signal
+    
+    def stop(*_):
+        raise KeyboardInterrupt()
+    
+    # terminate() envía SIGTERM: salir por la vía normal para liberar los segmentos
+    signal.signal(signal.SIGTERM, stop)
+    logger.info(f"🗂️ Cargador de galería compartida '{GALLERY_SHM_NAME}' iniciado")
+    try:
+        asyncio.run(serve_shared_gallery())
+    except KeyboardInterrupt:
+        pass
+
+# ============================================================
+# PRECALENTAMIENTO - Evita la latencia de la primera petición
+# ============================================================
+warmup_status: Dict[str, Any] = {"estado": "pendiente" if WARMUP_ENABLED else "deshabilitado", "etapas_ms": {}}
+# Referencia a la tarea: el event loop solo guarda referencias débiles
+warmup_task: Optional[asyncio.Task] = None
+
+def warmup_loads_models() -> bool:
+    """El precalentamiento incluye la carga de los modelos CNN"""
+    return WARMUP_ENABLED and "liveness" in WARMUP_STAGES
+
+def build_warmup_image() -> np.ndarray:
+    """Imagen sintética con un 'rostro' para recorrer el pipeline completo"""
+    rng = np.random.default_rng(0)
+    image = rng.integers(60, 200, size=(480, 640, 3), dtype=np.uint8)
+    cv2.ellipse(image, (320, 240), (110, 140), 0, 0, 360, (140, 160, 200), -1)
+    cv2.circle(image, (280, 210), 12, (40, 40, 40), -1)
+    cv2.circle(image, (360, 210), 12, (40, 40, 40), -1)
+    cv2.ellipse(image, (320, 300), (40, 15), 0, 0, 180, (60, 60, 120), 3)
+    return image
+
+async def run_warmup():
+    """
+    Recorre detección, liveness y embedding con una imagen sintética y
+    precarga la galería. /ready no reporta listo hasta que termina.
+    """
+    warmup_status["estado"] = "en_progreso"
+    total_start = datetime.now()
+    image = build_warmup_image()
+    face_location = (100, 430, 380, 210)  # (top, right, bottom, left) del rostro sintético
+    
+    def warmup_detection():
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        face_cascade.detectMultiScale(gray, scaleFactor=1.05, minNeighbors=15)
+    
+    def warmup_liveness():
+        model_manager.preload(warmup=True, background=False)
+        context = FaceAnalysisContext(image, face_location)
+        advanced_liveness_tensorflow(image, face_location, context)
+        detect_spoofing_tensorflow(image, face_location, context)
+    
+    async def warmup_embedding():
+        # Fuerza la importación de DeepFace/TF y la construcción del modelo de
+        # la galería servida (tras `reembed_gallery.py switch` ya no es ArcFace)
+        model_name = await get_embedding_model(await load_serving_model_id())
+        await asyncio.to_thread(lambda: generate_face_embedding(FaceAnalysisContext(image, face_location).roi, model_name))
+    
+    stages = {
+        "detection": warmup_detection,
+        "liveness": warmup_liveness,
+    }
+    
+    for stage in WARMUP_STAGES:
+        stage_start = datetime.now()
+        try:
+            if stage == "gallery":
+                await gallery.refresh()
+            elif stage == "embedding":
+                await warmup_embedding()
+            elif stage in stages:
+                # En un hilo: /health sigue respondiendo mientras carga TF/DeepFace
+                await asyncio.to_thread(stages[stage])
+            else:
+                logger.warning(f"⚠️ Etapa de precalentamiento desconocida: {stage}")
+                continue
+        except Exception as e:
+            # Una etapa fallida no bloquea el servicio: se reintentará en la primera petición
+            warmup_status.setdefault("errores", {})[stage] = str(e)
+            logger.error(f"❌ Error en precalentamiento {stage}: {str(e)}")
+        
+        elapsed = (datetime.now() - stage_start).total_seconds() * 1000
+        warmup_status["etapas_ms"][stage] = round(elapsed, 1)
+        logger.info(f"🔥 Precalentamiento {stage}: {elapsed:.0f} ms")
+    
+    warmup_status["estado"] = "completado"
+    warmup_status["total_ms"] = round((datetime.now() - total_start).total_seconds() * 1000, 1)
+    logger.info(f"🔥 Precalentamiento {warmup_status['estado']} en {warmup_status['total_ms']:.0f} ms")
+
 # ============================================================
 # EVENTO DE INICIO - AUTO-CONFIGURACIÓN
 # ============================================================
 @app.on_event("startup")
 async def startup_event():
     """Se ejecuta al iniciar el servicio"""
+    global warmup_task
     logger.info("🚀 Iniciando Face Recognition Service...")
     logger.info(f"📊 TensorFlow habilitado: {ENABLE_TENSORFLOW}")
     logger.info(f"🎯 Umbral de confianza: {CONFIDENCE_THRESHOLD}")
     logger.info(f"👁️ Umbral de liveness: {LIVENESS_THRESHOLD}")
     
+    # Registrar modelos CNN (sin archivo = fallback heurístico). Se cargan en
+    # su primer uso o en paralelo en segundo plano; /ready informa su estado
+    if ENABLE_TENSORFLOW:
+        model_manager.load_all_models(("liveness", "spoofing"), create_missing=False, lazy=True)
+        for model_type in ("liveness", "spoofing"):
+            origen = "modelo CNN" if model_manager.is_model_available(model_type) else "heurística"
+            logger.info(f"🧠 {model_type.capitalize()}: {origen}")
+        if MODEL_PRELOAD and not warmup_loads_models():
+            model_manager.preload(warmup=True, background=True)
+    
     # Auto-configurar catálogos de base de datos
     await ensure_catalog_data()
     
+    if GALLERY_AGGREGATES:
+        try:
+            conn = await get_db_connection()
+            try:
+                await conn.execute(AGGREGATES_TABLE_SQL)
+            finally:
+                await conn.close()
+        except Exception as e:
+            logger.error(f"❌ No se pudo crear rostros_agregados: {str(e)}")
+    
+    # Los workers con galería compartida no escuchan: lo hace el proceso cargador
+    if GALLERY_NOTIFY and not GALLERY_SHARED_MEMORY:
+        await start_gallery_sync(gallery)
+    
+    if CAMERA_CONFIG_NOTIFY:
+        await start_camera_events()
+    
+    if edge_cipher is not None:
+        try:
+            conn = await get_db_connection()
+            try:
+                await conn.execute(EDGE_DECISIONS_TABLE_SQL)
+            finally:
+                await conn.close()
+        except Exception as e:
+            logger.error(f"❌ No se pudo crear decisiones_edge: {str(e)}")
+    
+    # Precalentar el pipeline en segundo plano (el estado se expone en /ready)
+    if WARMUP_ENABLED:
+        warmup_task = asyncio.create_task(run_warmup())
+    
     logger.info("✅ Servicio iniciado correctamente")
 
 # Endpoints
@@ -1018,6 +1536,69 @@ async def health_check():
     """Endpoint de salud del servicio"""
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
+@app.get("/ready")
+async def readiness_check():
+    """
+    Indica qué modelos están cargados y precalentados. Un modelo ausente o
+    que no se pudo cargar ("error") no bloquea: liveness y anti-spoofing
+    recurren a liveness_engine, y el modelo se reporta en `modelos_con_error`
+    """
+    models = model_manager.readiness()
+    if MODEL_PRELOAD or warmup_loads_models():
+        ready_states = ("warm", "missing", "error")
+    else:
+        # Sin precarga los modelos se cargan en su primer uso
+        ready_states = ("cold", "loaded", "warm", "missing", "error")
+    ready = all(model["estado"] in ready_states for model in models.values())
+    if WARMUP_ENABLED:
+        ready = ready and warmup_status["estado"] == "completado"
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "models": models,
+            "modelos_con_error": [name for name, model in models.items() if model["estado"] == "error"],
+            "warmup": warmup_status,
+            "galeria": gallery.stats(),
+            "sincronizacion_galeria": gallery_sync.stats() if gallery_sync else None,
+            "eventos_camaras": camera_events.stats() if camera_events else None,
+            "modo_sin_conexion": edge_cipher is not None,
+            "agregados": aggregate_cache.stats() if GALLERY_AGGREGATES else None,
+            "rerank": rerank_cache.stats() if rerank_cache.max_entries else None,
+            "deepface_cargado": DeepFace.is_loaded,
+            "timestamp": datetime.now().isoformat()
+        }
+    )
+
+@app.get("/events/camaras")
+async def camera_config_events(request: Request):
+    """
+    Server-Sent Events con los cambios de cámara de los puntos de control
+    (`event: camara`, data {"id", "op"}; "RESYNC" = revalidar todo). Al
+    conectar se envía `event: listo`
+    """
+    if camera_events is None:
+        raise HTTPException(status_code=503, detail="Avisos de cámaras deshabilitados")
+    
+    queue = camera_events.subscribe()
+    
+    async def stream():
+        try:
+            yield "event: listo\ndata: {}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=CAMERA_EVENTS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # Comentario SSE: mantiene viva la conexión a través de proxies
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: camara\ndata: {json.dumps(event)}\n\n"
+        finally:
+            camera_events.unsubscribe(queue)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.post("/detect-face", response_model=FaceDetectionResponse)
 async def detect_faces(request: FaceDetectionRequest):
     """Detecta rostros en una imagen usando OpenCV"""
@@ -1220,252 +1801,135 @@ async def validate_access_rules(user_id: int, punto_control_id: int) -> tuple[bo
         # SEGURIDAD: En caso de error, DENEGAR acceso para proteger el sistema
         return False, f"Error en validación de acceso: {str(e)}", 1
 
-@app.post("/recognize-face", response_model=FaceRecognitionResponse)
-async def recognize_face(request: FaceRecognitionRequest):
-    """Reconoce un rostro y determina acceso"""
-    start_time = datetime.now()
-    
+def parse_request_id(value: Optional[str]) -> Optional[uuid.UUID]:
+    """Id de solicitud del kiosco (UUID); uno inválido se ignora"""
+    if not value or edge_cipher is None:
+        return None
     try:
-        # Decodificar imagen
-        image = decode_base64_image(request.image_base64)
-        
-        # Detectar rostros usando OpenCV (igual que detect-face)
-        logger.info("🔍 INICIANDO RECONOCIMIENTO FACIAL")
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        faces = face_cascade.detectMultiScale(
-            gray,
-            scaleFactor=1.05,      # MUY PEQUEÑO - detección más precisa
-            minNeighbors=15,       # ULTRA RESTRICTIVO - requiere muchas confirmaciones
-            minSize=(150, 150),    # Rostro mínimo GRANDE para evitar falsos positivos
-            maxSize=(300, 300),    # Rostros más controlados
-            flags=cv2.CASCADE_SCALE_IMAGE | cv2.CASCADE_DO_CANNY_PRUNING
-        )
-        
-        logger.info(f"📊 DETECCIÓN: {len(faces)} rostros encontrados por OpenCV")
-        
-        face_locations = []
-        face_encodings = []
-        
-        # Convertir detecciones de OpenCV con validación de calidad
-        for (x, y, w, h) in faces:
-            top, right, bottom, left = y, x + w, y + h, x
-            face_roi = image[top:bottom, left:right]
-            
-            # VALIDACIÓN DE CALIDAD DEL ROSTRO
-            if face_roi.size == 0:
-                logger.warning(f"⚠️ Rostro descartado: ROI vacío")
-                continue
-                
-            # Verificar tamaño mínimo
-            if w < 120 or h < 120:
-                logger.warning(f"⚠️ Rostro descartado: Muy pequeño ({w}x{h})")
-                continue
-                
-            # Verificar calidad de imagen (nitidez)
-            gray_roi = cv2.cvtColor(face_roi, cv2.COLOR_BGR2GRAY)
-            laplacian_var = cv2.Laplacian(gray_roi, cv2.CV_64F).var()
-            if laplacian_var < 20:  # Umbral más permisivo para cámaras web
-                logger.warning(f"⚠️ Rostro descartado: Imagen muy borrosa (nitidez: {laplacian_var:.1f})")
-                continue
-                
-            logger.info(f"✅ Rostro válido: {w}x{h}, nitidez: {laplacian_var:.1f}")
-            face_locations.append((top, right, bottom, left))
-            
-            try:
-                # Usar la función unificada para garantizar consistencia
-                embedding = generate_face_embedding(face_roi)
-                face_encodings.append(embedding)
-                logger.debug(f"Embedding generado para reconocimiento: {len(embedding)} dimensiones")
-            except Exception as e:
-                logger.warning(f"Error generando embedding para rostro: {str(e)}")
-                continue
-        
-        if not face_encodings:
-            logger.warning("🚫 DIAGNÓSTICO: No se detectaron rostros en la imagen")
-            logger.info(f"📊 Rostros detectados por OpenCV: {len(faces)}")
-            return FaceRecognitionResponse(
-                success=False,
-                confidence=0.0,
-                decision="DENEGADO",
-                liveness_ok=False,
-                processing_time_ms=(datetime.now() - start_time).total_seconds() * 1000,
-                message="No se detectó ningún rostro válido para procesar",
-                faces=[]  # Sin rostros detectados
-            )
-        
-        # Usar el primer rostro detectado
-        face_encoding = face_encodings[0]
-        face_location = face_locations[0]
-        
-        # Verificar liveness con TensorFlow si está habilitado
-        liveness_ok = True
-        liveness_score = 0.0
-        spoofing_result = {"spoofing_detected": False, "confidence": 0.0, "attack_type": "none"}
-        
-        if request.check_liveness:
-            if ENABLE_TENSORFLOW:
-                # Usar detección avanzada con TensorFlow
-                liveness_score = advanced_liveness_tensorflow(image, face_location)
-                spoofing_result = detect_spoofing_tensorflow(image, face_location)
-                
-                # Combinar liveness y anti-spoofing
-                liveness_ok = (liveness_score >= TF_LIVENESS_THRESHOLD and 
-                             not spoofing_result["spoofing_detected"])
-            else:
-                # Usar método básico
-                liveness_score = detect_liveness(image, face_location)
-                liveness_ok = liveness_score >= LIVENESS_THRESHOLD
-        
-        # Obtener embeddings de la base de datos
-        user_embeddings = await get_user_embeddings()
-        
-        if not user_embeddings:
-            # Preparar coordenadas faciales incluso si no hay usuarios registrados
-            faces_data = []
-            if face_locations:
-                top, right, bottom, left = face_locations[0]
-                faces_data.append({
-                    "left": int(left),    # Convertir numpy.int32 a int
-                    "top": int(top),      # Convertir numpy.int32 a int
-                    "right": int(right),  # Convertir numpy.int32 a int
-                    "bottom": int(bottom) # Convertir numpy.int32 a int
-                })
-            
-            return FaceRecognitionResponse(
-                success=False,
-                confidence=0.0,
-                decision="DENEGADO",
-                liveness_ok=liveness_ok,
-                processing_time_ms=(datetime.now() - start_time).total_seconds() * 1000,
-                message="No hay usuarios registrados en el sistema",
-                faces=faces_data  # Incluir coordenadas para tracking
-            )
-        
-        # Comparar con embeddings conocidos
-        best_match_user_id = None
-        best_confidence = 0.0
-        
-        # Agrupar embeddings por usuario para comparación múltiple
-        user_confidences = {}
+        return uuid.UUID(value)
+    except ValueError:
+        logger.warning(f"⚠️ id_solicitud inválido, se ignora: {value}")
+        return None
+
+async def claim_request_id(conn, request_id: Optional[uuid.UUID], punto_control_id: int) -> bool:
+    """
+    Reserva el id de solicitud en decisiones_edge antes de registrar el
+    acceso. El kiosco usa el mismo id para la decisión local si no recibe la
+    respuesta: el reenvío y la solicitud original nunca se registran ambos.
+    False si ya estaba (el reenvío llegó primero)
+    """
+    if request_id is None:
+        return True
+    claimed = await conn.fetchval("""
+        INSERT INTO decisiones_edge (id_local, punto_id, decidido_en) VALUES ($1, $2, NOW())
+        ON CONFLICT (id_local) DO NOTHING
+        RETURNING id_local
+    """, request_id, punto_control_id)
+    return claimed is not None
+
+async def recognize_detected_faces(image: np.ndarray, faces, punto_control_id: int, check_liveness: bool,
+                                   start_time: datetime, evidence_image: Optional[np.ndarray] = None,
+                                   face_offset: Tuple[int, int] = (0, 0),
+                                   request_id: Optional[uuid.UUID] = None) -> FaceRecognitionResponse:
+    """
+    Reconocimiento a partir de rostros ya detectados: validación de calidad,
+    embedding, liveness, comparación con la galería, reglas de acceso y
+    registro de accesos/alertas. `faces` son cajas (x, y, w, h) en `image`;
+    `evidence_image` es la foto que se guarda como evidencia del acceso
+    (por defecto `image`) y `face_offset` desplaza las coordenadas devueltas.
+    `request_id` es el id de solicitud del kiosco (ver claim_request_id)
+    """
+    if evidence_image is None:
+        evidence_image = image
+    
+    face_locations = []
+    face_encodings = []
+    
+    face_contexts = []
+    
+    # Galería y modelo de las consultas salen del mismo snapshot: durante un
+    # cambio de modelo (re-embedding) nunca se mezclan embeddings de dos modelos
+    user_embeddings = await gallery.get()
+    embedding_model = await get_embedding_model(user_embeddings.model_id)
+    
+    # Convertir detecciones de OpenCV con validación de calidad
+    for (x, y, w, h) in faces:
+        top, right, bottom, left = y, x + w, y + h, x
+        face_context = FaceAnalysisContext(image, (top, right, bottom, left))
+        face_roi = face_context.roi
         
-        for user_data in user_embeddings:
-            user_id = user_data['usuario_id']
-            
-            # Verificar compatibilidad de dimensiones
-            stored_embedding = user_data['embedding']
-            
-            logger.info(f"🔍 Comparando embeddings - Actual: {len(face_encoding)} dim, BD: {len(stored_embedding)} dim")
+        # VALIDACIÓN DE CALIDAD DEL ROSTRO
+        if face_roi.size == 0:
+            logger.warning(f"⚠️ Rostro descartado: ROI vacío")
+            continue
             
-            # Solo comparar si las dimensiones son compatibles
-            if len(face_encoding) != len(stored_embedding):
-                logger.warning(f"⚠️ Dimensiones incompatibles - Saltando usuario {user_id}")
-                confidence = 0.0  # Forzar confianza 0 para embeddings incompatibles
-            else:
-                # Usar nueva función mejorada de similitud
-                confidence = calculate_similarity_score(face_encoding, stored_embedding)
-                
-                # VALIDACIÓN CRÍTICA: Si la confianza es >90% para cualquier usuario, verificar que sea realista
-                if confidence > 0.90:
-                    logger.warning(f"⚠️ ALTA CONFIANZA DETECTADA para Usuario {user_id}: {confidence:.3f}")
-                    logger.warning(f"   Esto podría indicar un problema con el modelo o embeddings")
-                    logger.warning(f"   Verificar que el rostro sea realmente del Usuario {user_id}")
+        # Verificar tamaño mínimo
+        if w < 120 or h < 120:
+            logger.warning(f"⚠️ Rostro descartado: Muy pequeño ({w}x{h})")
+            continue
             
-            logger.info(f"👤 Usuario {user_id}: confianza calculada = {confidence:.3f}")
+        # Verificar calidad de imagen (nitidez)
+        laplacian_var = face_context.laplacian_var
+        if laplacian_var < 20:  # Umbral más permisivo para cámaras web
+            logger.warning(f"⚠️ Rostro descartado: Imagen muy borrosa (nitidez: {laplacian_var:.1f})")
+            continue
             
-            # Guardar la mejor confianza para este usuario
-            if user_id not in user_confidences or confidence > user_confidences[user_id]:
-                user_confidences[user_id] = confidence
-        
-        # Encontrar el usuario con la mayor confianza VÁLIDA
-        best_confidence = 0.0
-        best_match_user_id = None
-        
-        for user_id, confidence in user_confidences.items():
-            # Usar el umbral configurado en lugar de valor fijo
-            if confidence > best_confidence and confidence >= CONFIDENCE_THRESHOLD:
-                best_confidence = confidence
-                best_match_user_id = user_id
-                logger.info(f"✅ Usuario {user_id} considerado válido con confianza {confidence:.3f} (umbral: {CONFIDENCE_THRESHOLD})")
-            elif confidence >= CONFIDENCE_THRESHOLD:
-                logger.info(f"✅ Usuario {user_id} también válido con confianza {confidence:.3f} (umbral: {CONFIDENCE_THRESHOLD})")
-            else:
-                logger.warning(f"❌ Usuario {user_id} descartado - confianza {confidence:.3f} < umbral {CONFIDENCE_THRESHOLD}")
-        
-        # Si no hay confianza válida, es definitivamente un usuario no registrado
-        if best_match_user_id is None:
-            logger.error("🚫 NINGÚN USUARIO REGISTRADO - Todas las confianzas son muy bajas")
-            # Mostrar todas las confianzas para debug
-            for user_id, confidence in user_confidences.items():
-                logger.error(f"   Usuario {user_id}: {confidence:.3f}")
-        
-        # Determinar decisión con lógica mejorada y más permisiva
-        decision = "DENEGADO"
-        success = False
-        message = "Rostro no reconocido"
-        tipo_alerta_zona_restriccion = 0  # Inicializar para alertas de zona/horario
+        logger.info(f"✅ Rostro válido: {w}x{h}, nitidez: {laplacian_var:.1f}")
+        face_locations.append((top, right, bottom, left))
+        face_contexts.append(face_context)
         
-        logger.info(f"🔍 Evaluando acceso - Confianza: {best_confidence:.1%}, Liveness: {liveness_ok}, Umbral: 95%")
-        
-        # LÓGICA DE SEGURIDAD ULTRA ESTRICTA - SOLO USUARIOS REGISTRADOS
-        logger.info(f"🔒 VALIDACIÓN ULTRA ESTRICTA:")
-        logger.info(f"   - Mejor match: Usuario {best_match_user_id}")
-        logger.info(f"   - Confianza: {best_confidence:.3f}")
-        logger.info(f"   - Liveness: {liveness_ok}")
-        logger.info(f"   - Umbral requerido: 95% (ULTRA ESTRICTO)")
-        
-        # REGLA 1: Sin usuario registrado = DENEGADO AUTOMÁTICO
-        if best_match_user_id is None:
-            decision = "DENEGADO"
-            message = f"❌ ACCESO DENEGADO - Ningún usuario registrado reconocido"
-            logger.error(f"🚫 ACCESO DENEGADO - Sin match de usuario registrado")
-            
-        # REGLA 1.5: Validación adicional - Si confianza es muy baja, es usuario no registrado
-        elif best_confidence < 0.80:  # Confianza muy baja = definitivamente no registrado
-            decision = "DENEGADO"
-            message = f"❌ ACCESO DENEGADO - Usuario no registrado (confianza: {best_confidence:.1%})"
-            logger.error(f"🚫 ACCESO DENEGADO - Usuario no registrado detectado: {best_confidence:.3f}")
-            
-        # REGLA 2: Confianza < CONFIDENCE_THRESHOLD = DENEGADO
-        elif best_confidence < CONFIDENCE_THRESHOLD:
-            decision = "DENEGADO"
-            message = f"❌ ACCESO DENEGADO - Confianza insuficiente ({best_confidence:.1%} < {CONFIDENCE_THRESHOLD:.1%})"
-            logger.error(f"🚫 ACCESO DENEGADO - Confianza insuficiente: {best_confidence:.3f} < {CONFIDENCE_THRESHOLD}")
-            
-        # REGLA 3: Sin liveness = DENEGADO (Anti-spoofing)
-        elif not liveness_ok:
-            decision = "DENEGADO"
-            message = f"❌ ACCESO DENEGADO - Falla anti-spoofing (foto/pantalla detectada)"
-            logger.error(f"🚫 ACCESO DENEGADO - Liveness fallido para Usuario {best_match_user_id}")
+        try:
+            # Usar la función unificada para garantizar consistencia
+            embedding = generate_face_embedding(face_roi, embedding_model)
+            face_encodings.append(embedding)
+            logger.debug(f"Embedding generado para reconocimiento: {len(embedding)} dimensiones")
+        except Exception as e:
+            logger.warning(f"Error generando embedding para rostro: {str(e)}")
+            continue
+    
+    if not face_encodings:
+        logger.warning("🚫 DIAGNÓSTICO: No se detectaron rostros en la imagen")
+        logger.info(f"📊 Rostros detectados por OpenCV: {len(faces)}")
+        return FaceRecognitionResponse(
+            success=False,
+            confidence=0.0,
+            decision="DENEGADO",
+            liveness_ok=False,
+            processing_time_ms=(datetime.now() - start_time).total_seconds() * 1000,
+            message="No se detectó ningún rostro válido para procesar",
+            faces=[]  # Sin rostros detectados
+        )
+    
+    # Usar el primer rostro detectado
+    face_encoding = face_encodings[0]
+    face_location = face_locations[0]
+    face_context = face_contexts[0]
+    
+    # Verificar liveness con TensorFlow si está habilitado
+    liveness_ok = True
+    liveness_score = 0.0
+    spoofing_result = {"spoofing_detected": False, "confidence": 0.0, "attack_type": "none"}
+    
+    if check_liveness:
+        if ENABLE_TENSORFLOW:
+            # Usar detección avanzada con TensorFlow
+            # Ambos detectores comparten el mismo análisis del rostro
+            liveness_score = advanced_liveness_tensorflow(image, face_location, face_context)
+            spoofing_result = detect_spoofing_tensorflow(image, face_location, face_context)
             
-        # REGLA 4: Validar zona y horario de acceso (RF4, RF10)
+            # Combinar liveness y anti-spoofing
+            liveness_ok = (liveness_score >= TF_LIVENESS_THRESHOLD and 
+                         not spoofing_result["spoofing_detected"])
         else:
-            # Validar reglas de acceso por zona y horario
-            tiene_permiso, mensaje_zona, tipo_alerta_zona = await validate_access_rules(
-                best_match_user_id, 
-                request.punto_control_id
-            )
-            
-            if not tiene_permiso:
-                decision = "DENEGADO"
-                message = f"❌ ACCESO DENEGADO - {mensaje_zona}"
-                logger.error(f"🚫 ACCESO DENEGADO - Regla de zona: {mensaje_zona}")
-                # Guardar tipo de alerta para uso posterior (tipo 5 o 6)
-                tipo_alerta_zona_restriccion = tipo_alerta_zona
-            else:
-                # REGLA 5: SOLO si TODO está perfecto = PERMITIDO
-                decision = "PERMITIDO"
-                success = True
-                message = f"✅ ACCESO AUTORIZADO - Usuario {best_match_user_id} (confianza: {best_confidence:.1%})"
-                logger.info(f"✅ ACCESO AUTORIZADO - Usuario {best_match_user_id} - Confianza: {best_confidence:.3f}")
-                tipo_alerta_zona_restriccion = 0
-        
-        processing_time = (datetime.now() - start_time).total_seconds() * 1000
-        
-        # Preparar coordenadas faciales para tracking
+            # Usar método básico
+            liveness_score = detect_liveness(image, face_location, face_context)
+            liveness_ok = liveness_score >= LIVENESS_THRESHOLD
+    
+    if not user_embeddings:
+        # Preparar coordenadas faciales incluso si no hay usuarios registrados
         faces_data = []
         if face_locations:
-            top, right, bottom, left = face_locations[0]  # Usar el primer rostro
+            top, right, bottom, left = face_locations[0]
             faces_data.append({
                 "left": int(left),    # Convertir numpy.int32 a int
                 "top": int(top),      # Convertir numpy.int32 a int
@@ -1473,189 +1937,598 @@ async def recognize_face(request: FaceRecognitionRequest):
                 "bottom": int(bottom) # Convertir numpy.int32 a int
             })
         
-        # ============================================================
-        # GUARDAR EVIDENCIAS FOTOGRÁFICAS
-        # ============================================================
-        evidencia_acceso_id = None
-        evidencia_alerta_id = None
-        evidencia_rostro_id = None
+        return FaceRecognitionResponse(
+            success=False,
+            confidence=0.0,
+            decision="DENEGADO",
+            liveness_ok=liveness_ok,
+            processing_time_ms=(datetime.now() - start_time).total_seconds() * 1000,
+            message="No hay usuarios registrados en el sistema",
+            faces=faces_data  # Incluir coordenadas para tracking
+        )
+    
+    # Comparar con embeddings conocidos
+    best_match_user_id = None
+    best_confidence = 0.0
+    
+    # Puntuar toda la galería con un producto matriz-vector y quedarse con
+    # los GALLERY_RERANK_K candidatos más parecidos
+    user_confidences = {}
+    
+    if len(face_encoding) != user_embeddings.dim:
+        logger.warning(f"⚠️ Dimensiones incompatibles - Actual: {len(face_encoding)} dim, galería: {user_embeddings.dim} dim")
+    candidate_rows = None
+    if GALLERY_AGGREGATES:
+        # Primera etapa contra centroide + medoides; solo los mejores usuarios
+        # (y los que aún no tienen agregado) se comparan rostro a rostro
+        try:
+            aggregate_index = await aggregate_cache.get(user_embeddings)
+            candidate_rows, candidate_users = two_stage_rows(user_embeddings, aggregate_index, face_encoding, AGGREGATE_TOP_USERS)
+            logger.info(f"👥 Primera etapa: {candidate_users} usuarios candidatos, {len(candidate_rows)}/{len(user_embeddings)} rostros a comparar")
+        except Exception as e:
+            # Sin agregados se compara contra toda la galería
+            logger.error(f"❌ Error en primera etapa por agregados: {str(e)}")
+            candidate_rows = None
+    
+    for row, embedding_id, confidence in await match_gallery(user_embeddings, face_encoding, candidate_rows):
+        user_id = int(user_embeddings.user_ids[row])
+        
+        # VALIDACIÓN CRÍTICA: Si la confianza es >90% para cualquier usuario, verificar que sea realista
+        if confidence > 0.90:
+            logger.warning(f"⚠️ ALTA CONFIANZA DETECTADA para Usuario {user_id}: {confidence:.3f}")
+            logger.warning(f"   Esto podría indicar un problema con el modelo o embeddings")
+            logger.warning(f"   Verificar que el rostro sea realmente del Usuario {user_id}")
         
-        # Guardar foto completa del acceso (Tipo 1: FOTO_ACCESO)
-        evidence_data_acceso = await save_evidence_photo(image, tipo_evidencia_id=1, prefix="acceso")
+        logger.info(f"👤 Usuario {user_id}: confianza calculada = {confidence:.3f}")
         
-        # Guardar rostro recortado si se detectó (Tipo 4: FOTO_ROSTRO)
-        if face_location:
-            top, right, bottom, left = face_location
-            face_roi = image[top:bottom, left:right]
-            evidence_data_rostro = await save_evidence_photo(face_roi, tipo_evidencia_id=4, prefix="rostro")
+        # Guardar la mejor confianza para este usuario
+        if user_id not in user_confidences or confidence > user_confidences[user_id]:
+            user_confidences[user_id] = confidence
+    
+    # Encontrar el usuario con la mayor confianza VÁLIDA
+    best_confidence = 0.0
+    best_match_user_id = None
+    
+    for user_id, confidence in user_confidences.items():
+        # Usar el umbral configurado en lugar de valor fijo
+        if confidence > best_confidence and confidence >= CONFIDENCE_THRESHOLD:
+            best_confidence = confidence
+            best_match_user_id = user_id
+            logger.info(f"✅ Usuario {user_id} considerado válido con confianza {confidence:.3f} (umbral: {CONFIDENCE_THRESHOLD})")
+        elif confidence >= CONFIDENCE_THRESHOLD:
+            logger.info(f"✅ Usuario {user_id} también válido con confianza {confidence:.3f} (umbral: {CONFIDENCE_THRESHOLD})")
         else:
-            evidence_data_rostro = None
+            logger.warning(f"❌ Usuario {user_id} descartado - confianza {confidence:.3f} < umbral {CONFIDENCE_THRESHOLD}")
+    
+    # Si no hay confianza válida, es definitivamente un usuario no registrado
+    if best_match_user_id is None:
+        logger.error("🚫 NINGÚN USUARIO REGISTRADO - Todas las confianzas son muy bajas")
+        # Mostrar todas las confianzas para debug
+        for user_id, confidence in user_confidences.items():
+            logger.error(f"   Usuario {user_id}: {confidence:.3f}")
+    
+    # Determinar decisión con lógica mejorada y más permisiva
+    decision = "DENEGADO"
+    success = False
+    message = "Rostro no reconocido"
+    tipo_alerta_zona_restriccion = 0  # Inicializar para alertas de zona/horario
+    
+    logger.info(f"🔍 Evaluando acceso - Confianza: {best_confidence:.1%}, Liveness: {liveness_ok}, Umbral: 95%")
+    
+    # LÓGICA DE SEGURIDAD ULTRA ESTRICTA - SOLO USUARIOS REGISTRADOS
+    logger.info(f"🔒 VALIDACIÓN ULTRA ESTRICTA:")
+    logger.info(f"   - Mejor match: Usuario {best_match_user_id}")
+    logger.info(f"   - Confianza: {best_confidence:.3f}")
+    logger.info(f"   - Liveness: {liveness_ok}")
+    logger.info(f"   - Umbral requerido: 95% (ULTRA ESTRICTO)")
+    
+    # REGLA 1: Sin usuario registrado = DENEGADO AUTOMÁTICO
+    if best_match_user_id is None:
+        decision = "DENEGADO"
+        message = f"❌ ACCESO DENEGADO - Ningún usuario registrado reconocido"
+        logger.error(f"🚫 ACCESO DENEGADO - Sin match de usuario registrado")
         
-        # ============================================================
-        # REGISTRAR ACCESO Y ALERTAS EN BASE DE DATOS
-        # ============================================================
+    # REGLA 1.5: Validación adicional - Si confianza es muy baja, es usuario no registrado
+    elif best_confidence < 0.80:  # Confianza muy baja = definitivamente no registrado
+        decision = "DENEGADO"
+        message = f"❌ ACCESO DENEGADO - Usuario no registrado (confianza: {best_confidence:.1%})"
+        logger.error(f"🚫 ACCESO DENEGADO - Usuario no registrado detectado: {best_confidence:.3f}")
+        
+    # REGLA 2: Confianza < CONFIDENCE_THRESHOLD = DENEGADO
+    elif best_confidence < CONFIDENCE_THRESHOLD:
+        decision = "DENEGADO"
+        message = f"❌ ACCESO DENEGADO - Confianza insuficiente ({best_confidence:.1%} < {CONFIDENCE_THRESHOLD:.1%})"
+        logger.error(f"🚫 ACCESO DENEGADO - Confianza insuficiente: {best_confidence:.3f} < {CONFIDENCE_THRESHOLD}")
+        
+    # REGLA 3: Sin liveness = DENEGADO (Anti-spoofing)
+    elif not liveness_ok:
+        decision = "DENEGADO"
+        message = f"❌ ACCESO DENEGADO - Falla anti-spoofing (foto/pantalla detectada)"
+        logger.error(f"🚫 ACCESO DENEGADO - Liveness fallido para Usuario {best_match_user_id}")
+        
+    # REGLA 4: Validar zona y horario de acceso (RF4, RF10)
+    else:
+        # Validar reglas de acceso por zona y horario
+        tiene_permiso, mensaje_zona, tipo_alerta_zona = await validate_access_rules(
+            best_match_user_id, 
+            punto_control_id
+        )
+        
+        if not tiene_permiso:
+            decision = "DENEGADO"
+            message = f"❌ ACCESO DENEGADO - {mensaje_zona}"
+            logger.error(f"🚫 ACCESO DENEGADO - Regla de zona: {mensaje_zona}")
+            # Guardar tipo de alerta para uso posterior (tipo 5 o 6)
+            tipo_alerta_zona_restriccion = tipo_alerta_zona
+        else:
+            # REGLA 5: SOLO si TODO está perfecto = PERMITIDO
+            decision = "PERMITIDO"
+            success = True
+            message = f"✅ ACCESO AUTORIZADO - Usuario {best_match_user_id} (confianza: {best_confidence:.1%})"
+            logger.info(f"✅ ACCESO AUTORIZADO - Usuario {best_match_user_id} - Confianza: {best_confidence:.3f}")
+            tipo_alerta_zona_restriccion = 0
+    
+    processing_time = (datetime.now() - start_time).total_seconds() * 1000
+    
+    # Preparar coordenadas faciales para tracking
+    faces_data = []
+    if face_locations:
+        top, right, bottom, left = face_locations[0]  # Usar el primer rostro
+        offset_x, offset_y = face_offset  # Recorte del cliente -> coordenadas del frame
+        faces_data.append({
+            "left": int(left) + offset_x,    # Convertir numpy.int32 a int
+            "top": int(top) + offset_y,      # Convertir numpy.int32 a int
+            "right": int(right) + offset_x,  # Convertir numpy.int32 a int
+            "bottom": int(bottom) + offset_y # Convertir numpy.int32 a int
+        })
+    
+    # ============================================================
+    # GUARDAR EVIDENCIAS FOTOGRÁFICAS
+    # ============================================================
+    evidencia_acceso_id = None
+    evidencia_alerta_id = None
+    evidencia_rostro_id = None
+    
+    # Guardar foto completa del acceso (Tipo 1: FOTO_ACCESO)
+    evidence_data_acceso = await save_evidence_photo(evidence_image, tipo_evidencia_id=1, prefix="acceso")
+    
+    # Guardar rostro recortado si se detectó (Tipo 4: FOTO_ROSTRO)
+    if face_location:
+        top, right, bottom, left = face_location
+        face_roi = image[top:bottom, left:right]
+        evidence_data_rostro = await save_evidence_photo(face_roi, tipo_evidencia_id=4, prefix="rostro")
+    else:
+        evidence_data_rostro = None
+    
+    # Guardar foto de la alerta (Tipo 3: FOTO_ALERTA) antes de abrir la transacción
+    evidence_data_alerta = None
+    if not success:
+        evidence_data_alerta = await save_evidence_photo(evidence_image, tipo_evidencia_id=3, prefix="alerta")
+    
+    # ============================================================
+    # REGISTRAR ACCESO Y ALERTAS EN BASE DE DATOS
+    # ============================================================
+    try:
+        conn = await get_db_connection()
         try:
-            conn = await get_db_connection()
-            try:
-                # Registrar evidencias en BD primero
-                if evidence_data_acceso:
-                    evidencia_acceso_id = await create_evidence_record(conn, evidence_data_acceso)
-                
-                if evidence_data_rostro:
-                    evidencia_rostro_id = await create_evidence_record(conn, evidence_data_rostro)
-                
-                # Determinar tipo de decisión (1=PERMITIDO, 2=DENEGADO)
-                tipo_decision_id = 1 if success else 2
-                acceso_id = None
-                
-                # Solo registrar acceso si hay usuario reconocido
-                if best_match_user_id is not None:
-                    # Crear registro de acceso con evidencia
-                    acceso_query = """
-                    INSERT INTO accesos (usuario_id, punto_id, decision_id, evidencia_id, creado_en)
-                    VALUES ($1, $2, $3, $4, NOW())
-                    RETURNING id
-                    """
-                    acceso_result = await conn.fetchrow(
-                        acceso_query,
-                        best_match_user_id,
-                        request.punto_control_id,  # Usar punto de control real del request
-                        tipo_decision_id,
-                        evidencia_acceso_id  # Asociar evidencia
-                    )
-                    acceso_id = acceso_result['id']
-                    logger.info(f"✅ Acceso registrado en BD: ID {acceso_id}")
-                    
-                    # Crear registro de rostro procesado
-                    acceso_rostro_query = """
-                    INSERT INTO acceso_rostros (acceso_id, usuario_id, score, liveness_ok)
-                    VALUES ($1, $2, $3, $4)
-                    """
-                    await conn.execute(
-                        acceso_rostro_query,
-                        acceso_id,
-                        best_match_user_id,
-                        float(best_confidence),
-                        liveness_ok
-                    )
-                    logger.info(f"✅ Rostro registrado para acceso {acceso_id}")
+            # Reserva del id y registros en una sola transacción: si un insert
+            # falla no queda el id reservado sin acceso, y el reenvío del
+            # kiosco con ese id sí se registra
+            pending_email = None
+            async with conn.transaction():
+                # Con id de solicitud del kiosco: si su reenvío sin conexión ya la
+                # registró (la respuesta se perdió), no se registra de nuevo
+                claimed = await claim_request_id(conn, request_id, punto_control_id)
+                if not claimed:
+                    logger.info(f"♻️ Solicitud {request_id} ya registrada por el reenvío del kiosco")
                 else:
-                    logger.warning(f"⚠️ No se registró acceso: usuario no reconocido")
-                
-                # CREAR ALERTA SI EL ACCESO FUE DENEGADO
-                if not success:
-                    # Determinar tipo de alerta según la razón del rechazo
-                    # 
-                    # TIPOS DISPONIBLES EN BD (6 tipos):
-                    # 1 = "Acceso no autorizado"
-                    # 2 = "Falla en prueba de vida"
-                    # 3 = "Usuario desconocido"
-                    # 4 = "Múltiples intentos fallidos"
-                    # 5 = "Acceso fuera de horario" (RF10)
-                    # 6 = "Zona restringida" (RF10)
-                    #
-                    # Ahora se usan TODOS los tipos según la situación
+                    # Registrar evidencias en BD primero
+                    if evidence_data_acceso:
+                        evidencia_acceso_id = await create_evidence_record(conn, evidence_data_acceso)
                     
-                    tipo_alerta_id = 1  # Por defecto: "Acceso no autorizado"
-                    detalle_alerta = message
+                    if evidence_data_rostro:
+                        evidencia_rostro_id = await create_evidence_record(conn, evidence_data_rostro)
                     
-                    # Prioridad: Tipo específico de zona/horario > Usuario desconocido > Liveness > Confianza
-                    if 'tipo_alerta_zona_restriccion' in locals() and tipo_alerta_zona_restriccion in [5, 6]:
-                        # Alertas de zona restringida o fuera de horario (RF10)
-                        tipo_alerta_id = tipo_alerta_zona_restriccion
-                        detalle_alerta = message  # Ya tiene el mensaje correcto de validate_access_rules
-                        logger.info(f"🚨 Alerta tipo {tipo_alerta_id}: {'Fuera de horario' if tipo_alerta_id == 5 else 'Zona restringida'}")
-                    elif best_match_user_id is None or best_confidence < 0.80:
-                        # Usuario no registrado
-                        tipo_alerta_id = 3  # "Usuario desconocido"
-                        detalle_alerta = f"Persona no registrada intentó acceder (confianza: {best_confidence:.1%})"
-                    elif not liveness_ok:
-                        # Falla de liveness (posible spoofing)
-                        tipo_alerta_id = 2  # "Falla en prueba de vida"
-                        detalle_alerta = f"Falla en detección de vida - Posible foto/video (Usuario: {best_match_user_id})"
-                    elif best_confidence < CONFIDENCE_THRESHOLD:
-                        # Confianza insuficiente
-                        tipo_alerta_id = 1  # "Acceso no autorizado"
-                        detalle_alerta = f"Confianza insuficiente: {best_confidence:.1%} < {CONFIDENCE_THRESHOLD:.1%}"
+                    # Determinar tipo de decisión (1=PERMITIDO, 2=DENEGADO)
+                    tipo_decision_id = 1 if success else 2
+                    acceso_id = None
+                    alerta_id = None
                     
-                    # Guardar evidencia específica para la alerta (Tipo 3: FOTO_ALERTA)
-                    evidence_data_alerta = await save_evidence_photo(image, tipo_evidencia_id=3, prefix="alerta")
-                    if evidence_data_alerta:
-                        evidencia_alerta_id = await create_evidence_record(conn, evidence_data_alerta)
-                    
-                    # Insertar alerta en BD con evidencia
-                    alerta_query = """
-                    INSERT INTO alertas (tipo_id, detalle, punto_id, evidencia_id)
-                    VALUES ($1, $2, $3, $4)
-                    RETURNING id
-                    """
-                    alerta_result = await conn.fetchrow(
-                        alerta_query,
-                        tipo_alerta_id,
-                        detalle_alerta,
-                        request.punto_control_id,  # Usar punto de control real del request
-                        evidencia_alerta_id  # Asociar evidencia
-                    )
-                    alerta_id = alerta_result['id']
-                    logger.info(f"🚨 ALERTA CREADA: ID {alerta_id} - Tipo {tipo_alerta_id}")
-                    logger.info(f"   Detalle: {detalle_alerta}")
-                    
-                    # Crear notificación para la alerta
-                    notificacion_query = """
-                    INSERT INTO notificaciones (alerta_id, canal_id, destino, estado)
-                    VALUES ($1, $2, $3, $4)
-                    """
-                    await conn.execute(
-                        notificacion_query,
-                        alerta_id,
-                        1,  # canal_id = 1 (Sistema)
-                        'sistema',
-                        'pendiente'  # Estado inicial
-                    )
-                    logger.info(f"📬 Notificación creada para alerta {alerta_id}")
-                    
-                    # Obtener nombre del tipo de alerta para el email
-                    tipo_nombre_query = "SELECT nombre FROM tipo_alerta WHERE id = $1"
-                    tipo_nombre = await conn.fetchval(tipo_nombre_query, tipo_alerta_id)
+                    # Solo registrar acceso si hay usuario reconocido
+                    if best_match_user_id is not None:
+                        # Crear registro de acceso con evidencia
+                        acceso_query = """
+                        INSERT INTO accesos (usuario_id, punto_id, decision_id, evidencia_id, creado_en)
+                        VALUES ($1, $2, $3, $4, NOW())
+                        RETURNING id
+                        """
+                        acceso_result = await conn.fetchrow(
+                            acceso_query,
+                            best_match_user_id,
+                            punto_control_id,  # Usar punto de control real del request
+                            tipo_decision_id,
+                            evidencia_acceso_id  # Asociar evidencia
+                        )
+                        acceso_id = acceso_result['id']
+                        logger.info(f"✅ Acceso registrado en BD: ID {acceso_id}")
+                        
+                        # Crear registro de rostro procesado
+                        acceso_rostro_query = """
+                        INSERT INTO acceso_rostros (acceso_id, usuario_id, score, liveness_ok)
+                        VALUES ($1, $2, $3, $4)
+                        """
+                        await conn.execute(
+                            acceso_rostro_query,
+                            acceso_id,
+                            best_match_user_id,
+                            float(best_confidence),
+                            liveness_ok
+                        )
+                        logger.info(f"✅ Rostro registrado para acceso {acceso_id}")
+                    else:
+                        logger.warning(f"⚠️ No se registró acceso: usuario no reconocido")
                     
-                    # Enviar email de notificación
-                    fecha_actual = datetime.now().strftime("%d/%m/%Y, %H:%M:%S")
-                    email_enviado = await send_email_alert(
-                        tipo_alerta=tipo_nombre or "Alerta de Seguridad",
-                        detalle=detalle_alerta,
-                        punto="Entrada Principal - Recepción",
-                        fecha=fecha_actual
-                    )
+                    # CREAR ALERTA SI EL ACCESO FUE DENEGADO
+                    if not success:
+                        # Determinar tipo de alerta según la razón del rechazo
+                        # 
+                        # TIPOS DISPONIBLES EN BD (6 tipos):
+                        # 1 = "Acceso no autorizado"
+                        # 2 = "Falla en prueba de vida"
+                        # 3 = "Usuario desconocido"
+                        # 4 = "Múltiples intentos fallidos"
+                        # 5 = "Acceso fuera de horario" (RF10)
+                        # 6 = "Zona restringida" (RF10)
+                        #
+                        # Ahora se usan TODOS los tipos según la situación
+                        
+                        tipo_alerta_id = 1  # Por defecto: "Acceso no autorizado"
+                        detalle_alerta = message
+                        
+                        # Prioridad: Tipo específico de zona/horario > Usuario desconocido > Liveness > Confianza
+                        if 'tipo_alerta_zona_restriccion' in locals() and tipo_alerta_zona_restriccion in [5, 6]:
+                            # Alertas de zona restringida o fuera de horario (RF10)
+                            tipo_alerta_id = tipo_alerta_zona_restriccion
+                            detalle_alerta = message  # Ya tiene el mensaje correcto de validate_access_rules
+                            logger.info(f"🚨 Alerta tipo {tipo_alerta_id}: {'Fuera de horario' if tipo_alerta_id == 5 else 'Zona restringida'}")
+                        elif best_match_user_id is None or best_confidence < 0.80:
+                            # Usuario no registrado
+                            tipo_alerta_id = 3  # "Usuario desconocido"
+                            detalle_alerta = f"Persona no registrada intentó acceder (confianza: {best_confidence:.1%})"
+                        elif not liveness_ok:
+                            # Falla de liveness (posible spoofing)
+                            tipo_alerta_id = 2  # "Falla en prueba de vida"
+                            detalle_alerta = f"Falla en detección de vida - Posible foto/video (Usuario: {best_match_user_id})"
+                        elif best_confidence < CONFIDENCE_THRESHOLD:
+                            # Confianza insuficiente
+                            tipo_alerta_id = 1  # "Acceso no autorizado"
+                            detalle_alerta = f"Confianza insuficiente: {best_confidence:.1%} < {CONFIDENCE_THRESHOLD:.1%}"
+                        
+                        # Evidencia específica para la alerta (Tipo 3: FOTO_ALERTA)
+                        if evidence_data_alerta:
+                            evidencia_alerta_id = await create_evidence_record(conn, evidence_data_alerta)
+                        
+                        # Insertar alerta en BD con evidencia
+                        alerta_query = """
+                        INSERT INTO alertas (tipo_id, detalle, punto_id, evidencia_id)
+                        VALUES ($1, $2, $3, $4)
+                        RETURNING id
+                        """
+                        alerta_result = await conn.fetchrow(
+                            alerta_query,
+                            tipo_alerta_id,
+                            detalle_alerta,
+                            punto_control_id,  # Usar punto de control real del request
+                            evidencia_alerta_id  # Asociar evidencia
+                        )
+                        alerta_id = alerta_result['id']
+                        logger.info(f"🚨 ALERTA CREADA: ID {alerta_id} - Tipo {tipo_alerta_id}")
+                        logger.info(f"   Detalle: {detalle_alerta}")
+                        
+                        # Crear notificación para la alerta
+                        notificacion_query = """
+                        INSERT INTO notificaciones (alerta_id, canal_id, destino, estado)
+                        VALUES ($1, $2, $3, $4)
+                        """
+                        await conn.execute(
+                            notificacion_query,
+                            alerta_id,
+                            1,  # canal_id = 1 (Sistema)
+                            'sistema',
+                            'pendiente'  # Estado inicial
+                        )
+                        logger.info(f"📬 Notificación creada para alerta {alerta_id}")
+                        
+                        # Obtener nombre del tipo de alerta para el email
+                        tipo_nombre_query = "SELECT nombre FROM tipo_alerta WHERE id = $1"
+                        tipo_nombre = await conn.fetchval(tipo_nombre_query, tipo_alerta_id)
+                        pending_email = (tipo_nombre, detalle_alerta, alerta_id)
                     
-                    if email_enviado:
-                        # Actualizar estado de notificación a 'enviado'
+                    if request_id is not None:
                         await conn.execute(
-                            "UPDATE notificaciones SET estado = 'enviado' WHERE alerta_id = $1 AND canal_id = 1",
-                            alerta_id
+                            "UPDATE decisiones_edge SET acceso_id = $2, alerta_id = $3 WHERE id_local = $1",
+                            request_id, acceso_id, alerta_id
                         )
-                        logger.info(f"✅ Email enviado y notificación actualizada")
+            
+            # El email sale solo con la alerta ya confirmada
+            if pending_email is not None:
+                tipo_nombre, detalle_alerta, alerta_id = pending_email
+                fecha_actual = datetime.now().strftime("%d/%m/%Y, %H:%M:%S")
+                email_enviado = await send_email_alert(
+                    tipo_alerta=tipo_nombre or "Alerta de Seguridad",
+                    detalle=detalle_alerta,
+                    punto="Entrada Principal - Recepción",
+                    fecha=fecha_actual
+                )
                 
-            finally:
-                await conn.close()
-        except Exception as db_error:
-            logger.error(f"❌ Error al registrar en BD: {str(db_error)}")
-            # No fallar el reconocimiento por error de BD
+                if email_enviado:
+                    # Actualizar estado de notificación a 'enviado'
+                    await conn.execute(
+                        "UPDATE notificaciones SET estado = 'enviado' WHERE alerta_id = $1 AND canal_id = 1",
+                        alerta_id
+                    )
+                    logger.info(f"✅ Email enviado y notificación actualizada")
+            
+        finally:
+            await conn.close()
+    except Exception as db_error:
+        logger.error(f"❌ Error al registrar en BD: {str(db_error)}")
+        # No fallar el reconocimiento por error de BD
+    
+    return FaceRecognitionResponse(
+        success=success,
+        user_id=best_match_user_id if success else None,
+        confidence=best_confidence,
+        decision=decision,
+        liveness_ok=liveness_ok,
+        processing_time_ms=processing_time,
+        message=message,
+        faces=faces_data  # Incluir coordenadas para tracking
+    )
+
+@app.post("/recognize-face", response_model=FaceRecognitionResponse)
+async def recognize_face(request: FaceRecognitionRequest):
+    """Reconoce un rostro y determina acceso"""
+    start_time = datetime.now()
+    
+    try:
+        # Decodificar imagen
+        image = decode_base64_image(request.image_base64)
         
-        return FaceRecognitionResponse(
-            success=success,
-            user_id=best_match_user_id if success else None,
-            confidence=best_confidence,
-            decision=decision,
-            liveness_ok=liveness_ok,
-            processing_time_ms=processing_time,
-            message=message,
-            faces=faces_data  # Incluir coordenadas para tracking
+        # Detectar rostros usando OpenCV (igual que detect-face)
+        logger.info("🔍 INICIANDO RECONOCIMIENTO FACIAL")
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        faces = face_cascade.detectMultiScale(
+            gray,
+            scaleFactor=1.05,      # MUY PEQUEÑO - detección más precisa
+            minNeighbors=15,       # ULTRA RESTRICTIVO - requiere muchas confirmaciones
+            minSize=(150, 150),    # Rostro mínimo GRANDE para evitar falsos positivos
+            maxSize=(300, 300),    # Rostros más controlados
+            flags=cv2.CASCADE_SCALE_IMAGE | cv2.CASCADE_DO_CANNY_PRUNING
+        )
+        
+        logger.info(f"📊 DETECCIÓN: {len(faces)} rostros encontrados por OpenCV")
+        
+        return await recognize_detected_faces(
+            image, faces, request.punto_control_id, request.check_liveness, start_time,
+            request_id=parse_request_id(request.id_solicitud)
         )
         
     except Exception as e:
         logger.error(f"Error en reconocimiento facial: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error procesando reconocimiento: {str(e)}")
 
+@app.post("/recognize-face-crop", response_model=FaceRecognitionResponse)
+async def recognize_face_crop(
+    face: UploadFile = File(...),
+    context: Optional[UploadFile] = File(None),
+    punto_control_id: int = Form(...),
+    box: str = Form(...),
+    crop_origin: str = Form("0,0"),
+    check_liveness: bool = Form(True),
+    id_solicitud: Optional[str] = Form(None)
+):
+    """
+    Reconocimiento con recorte hecho por el cliente (multipart): `face` es el
+    recorte del rostro con margen a resolución completa, `box` la caja
+    "x,y,w,h" del rostro dentro del recorte y `context` una miniatura del
+    frame que se guarda como evidencia. No se corre Haar sobre el frame
+    completo; `crop_origin` ("x,y" del recorte en el frame) lleva las
+    coordenadas devueltas al frame original
+    """
+    start_time = datetime.now()
+    
+    try:
+        image = decode_image_bytes(await face.read())
+        x, y, w, h = parse_int_list(box, 4, "box")
+        offset_x, offset_y = parse_int_list(crop_origin, 2, "crop_origin")
+        
+        height, width = image.shape[:2]
+        x, y = max(x, 0), max(y, 0)
+        w, h = min(w, width - x), min(h, height - y)
+        if w <= 0 or h <= 0:
+            raise HTTPException(status_code=400, detail="La caja del rostro está fuera del recorte")
+        
+        evidence_image = None
+        if context is not None:
+            try:
+                evidence_image = decode_image_bytes(await context.read())
+            except HTTPException:
+                logger.warning("⚠️ Miniatura de contexto inválida, se guarda el recorte como evidencia")
+        
+        logger.info(f"🔍 INICIANDO RECONOCIMIENTO FACIAL (recorte del cliente {width}x{height}, rostro {w}x{h})")
+        return await recognize_detected_faces(
+            image, [(x, y, w, h)], punto_control_id, check_liveness, start_time,
+            evidence_image=evidence_image, face_offset=(offset_x, offset_y),
+            request_id=parse_request_id(id_solicitud)
+        )
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error en reconocimiento facial: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error procesando reconocimiento: {str(e)}")
+
+async def register_edge_decision(conn, decision: Dict[str, Any]) -> bool:
+    """
+    Registra en accesos/alertas una decisión tomada por un kiosco sin
+    conexión, con su hora original. Retorna False si ya estaba registrada
+    (reenvío, o la solicitud en línea con el mismo id llegó a registrarse).
+    liveness_ok es la heurística del kiosco (NULL si no la envió)
+    """
+    local_id = uuid.UUID(str(decision["id_local"]))
+    punto_control_id = int(decision["punto_control_id"])
+    decided_at = datetime.fromisoformat(decision["decidido_en"])
+    user_id = decision.get("usuario_id")
+    user_id = int(user_id) if user_id is not None else None
+    success = decision.get("decision") == "PERMITIDO"
+    confidence = float(decision.get("confianza") or 0.0)
+    liveness_ok = decision.get("liveness_ok")
+    liveness_ok = bool(liveness_ok) if liveness_ok is not None else None
+    
+    image = None
+    if decision.get("imagen_base64"):
+        try:
+            image = decode_base64_image(decision["imagen_base64"])
+        except HTTPException:
+            logger.warning(f"⚠️ Imagen inválida en la decisión {local_id}, se registra sin evidencia")
+    
+    async with conn.transaction():
+        inserted = await conn.fetchval("""
+            INSERT INTO decisiones_edge (id_local, punto_id, decidido_en) VALUES ($1, $2, $3)
+            ON CONFLICT (id_local) DO NOTHING
+            RETURNING id_local
+        """, local_id, punto_control_id, decided_at)
+        if inserted is None:
+            return False
+        
+        acceso_id = None
+        if user_id is not None:
+            evidencia_acceso_id = None
+            if image is not None:
+                evidence_data = await save_evidence_photo(image, tipo_evidencia_id=1, prefix="acceso_edge")
+                if evidence_data:
+                    evidencia_acceso_id = await create_evidence_record(conn, evidence_data)
+            acceso_id = await conn.fetchval("""
+                INSERT INTO accesos (usuario_id, punto_id, decision_id, evidencia_id, creado_en)
+                VALUES ($1, $2, $3, $4, $5)
+                RETURNING id
+            """, user_id, punto_control_id, 1 if success else 2, evidencia_acceso_id, decided_at)
+            await conn.execute("""
+                INSERT INTO acceso_rostros (acceso_id, usuario_id, score, liveness_ok)
+                VALUES ($1, $2, $3, $4)
+            """, acceso_id, user_id, confidence, liveness_ok)
+        
+        alerta_id = None
+        tipo_alerta_id = int(decision.get("tipo_alerta_id") or 1)
+        detalle_alerta = f"[Sin conexión] {decision.get('detalle') or 'Acceso denegado'}"
+        if not success:
+            evidencia_alerta_id = None
+            if image is not None:
+                evidence_data = await save_evidence_photo(image, tipo_evidencia_id=3, prefix="alerta_edge")
+                if evidence_data:
+                    evidencia_alerta_id = await create_evidence_record(conn, evidence_data)
+            alerta_id = await conn.fetchval("""
+                INSERT INTO alertas (tipo_id, detalle, punto_id, evidencia_id, creado_en)
+                VALUES ($1, $2, $3, $4, $5)
+                RETURNING id
+            """, tipo_alerta_id, detalle_alerta, punto_control_id, evidencia_alerta_id, decided_at)
+            await conn.execute("""
+                INSERT INTO notificaciones (alerta_id, canal_id, destino, estado)
+                VALUES ($1, 1, 'sistema', 'pendiente')
+            """, alerta_id)
+        
+        await conn.execute("UPDATE decisiones_edge SET acceso_id = $2, alerta_id = $3 WHERE id_local = $1",
+                           local_id, acceso_id, alerta_id)
+    
+    logger.info(f"📥 Decisión sin conexión {local_id} registrada (acceso {acceso_id}, alerta {alerta_id})")
+    
+    if alerta_id is not None:
+        tipo_nombre = await conn.fetchval("SELECT nombre FROM tipo_alerta WHERE id = $1", tipo_alerta_id)
+        punto_nombre = await conn.fetchval("SELECT nombre FROM puntos_control WHERE id = $1", punto_control_id)
+        email_enviado = await send_email_alert(
+            tipo_alerta=tipo_nombre or "Alerta de Seguridad",
+            detalle=detalle_alerta,
+            punto=punto_nombre or f"Punto {punto_control_id}",
+            fecha=decided_at.strftime("%d/%m/%Y, %H:%M:%S")
+        )
+        if email_enviado:
+            await conn.execute(
+                "UPDATE notificaciones SET estado = 'enviado' WHERE alerta_id = $1 AND canal_id = 1",
+                alerta_id
+            )
+    return True
+
+@app.get("/edge/puntos/{punto_control_id}/paquete")
+async def edge_bundle(punto_control_id: int, request: Request):
+    """
+    Paquete cifrado (EDGE_SYNC_KEY) para decidir sin conexión en el kiosco
+    del punto: galería de los usuarios con reglas en su zona, las reglas y el
+    umbral. ETag = versión del contenido; con If-None-Match igual responde 304
+    """
+    if edge_cipher is None:
+        raise HTTPException(status_code=503, detail="Modo sin conexión deshabilitado (falta EDGE_SYNC_KEY)")
+    
+    conn = await get_db_connection()
+    try:
+        punto = await conn.fetchrow(
+            "SELECT id, nombre, zona_id FROM puntos_control WHERE id = $1 AND activo = true",
+            punto_control_id
+        )
+        if not punto:
+            raise HTTPException(status_code=404, detail=f"Punto de control {punto_control_id} no encontrado o inactivo")
+        rules = await conn.fetch(EDGE_RULES_SQL, punto['zona_id'])
+    finally:
+        await conn.close()
+    
+    snapshot = await gallery.get()
+    model_name = await get_embedding_model(snapshot.model_id)
+    token, version = await asyncio.to_thread(
+        build_edge_bundle, edge_cipher, dict(punto), [dict(rule) for rule in rules],
+        snapshot, model_name, CONFIDENCE_THRESHOLD
+    )
+    
+    etag = f'"{version}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=token, media_type="application/octet-stream", headers=headers)
+
+@app.post("/edge/decisiones")
+async def edge_decisions(request: Request):
+    """
+    Registra un lote de decisiones tomadas sin conexión (cuerpo: token Fernet
+    con {"decisiones": [...]}). Es idempotente: las ya registradas cuentan
+    como aceptadas. Las que violan restricciones (p. ej. punto eliminado) se
+    devuelven en 'rechazadas' para que el kiosco no las reintente
+    """
+    if edge_cipher is None:
+        raise HTTPException(status_code=503, detail="Modo sin conexión deshabilitado (falta EDGE_SYNC_KEY)")
+    
+    try:
+        decisions = decrypt_decisions(edge_cipher, await request.body())
+    except (InvalidToken, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Lote de decisiones inválido o no autenticado: {type(e).__name__}")
+    
+    accepted, rejected, duplicates = [], [], 0
+    conn = await get_db_connection()
+    try:
+        for decision in decisions:
+            local_id = decision.get("id_local")
+            try:
+                if not await register_edge_decision(conn, decision):
+                    duplicates += 1
+                accepted.append(local_id)
+            except (asyncpg.IntegrityConstraintViolationError, asyncpg.DataError, KeyError, ValueError, TypeError) as e:
+                logger.error(f"❌ Decisión sin conexión {local_id} rechazada: {str(e)}")
+                rejected.append({"id_local": local_id, "error": str(e)})
+    finally:
+        await conn.close()
+    
+    logger.info(f"📥 Lote sin conexión: {len(accepted)} aceptadas ({duplicates} repetidas), {len(rejected)} rechazadas")
+    return {"success": True, "aceptadas": accepted, "rechazadas": rejected, "duplicadas": duplicates}
+
 @app.post("/enroll-face", response_model=FaceEnrollmentResponse)
 async def enroll_face(request: FaceEnrollmentRequest):
     """Registra rostros de un usuario en la base de datos"""
@@ -1665,6 +2538,11 @@ async def enroll_face(request: FaceEnrollmentRequest):
     try:
         embeddings = []
         qualities = []
+        image_numbers = []  # Imagen (1..N) de la que sale cada embedding
+        
+        # Los rostros nuevos se generan y guardan con el modelo que sirve la galería
+        serving_model_id = (await gallery.get()).model_id
+        embedding_model = await get_embedding_model(serving_model_id)
         
         # Procesar cada imagen
         for i, image_base64 in enumerate(request.images_base64):
@@ -1674,53 +2552,12 @@ async def enroll_face(request: FaceEnrollmentRequest):
                 image = decode_base64_image(image_base64)
                 logger.info(f"Imagen {i+1} decodificada: {image.shape}")
                 
-                # Detectar rostros usando OpenCV (simulado)
-                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-                face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-                faces = face_cascade.detectMultiScale(gray, 1.1, 4)
-                logger.info(f"Detectados {len(faces)} rostros en imagen {i+1}")
-                
-                face_locations = [(y, x+w, y+h, x) for (x, y, w, h) in faces]
-                face_encodings = []
-                
-                # SOLO procesar el PRIMER rostro detectado para evitar múltiples registros
-                if len(faces) > 0:
-                    x, y, w, h = faces[0]  # Solo el primer rostro
-                    top, right, bottom, left = y, x + w, y + h, x
-                    face_roi = image[top:bottom, left:right]
-                    if face_roi.size > 0:
-                        try:
-                            # Verificar calidad antes de procesar
-                            gray_roi = cv2.cvtColor(face_roi, cv2.COLOR_BGR2GRAY)
-                            laplacian_var = cv2.Laplacian(gray_roi, cv2.CV_64F).var()
-                            
-                            if laplacian_var >= 20:  # Mismo umbral que reconocimiento
-                                embedding = generate_face_embedding(face_roi)
-                                face_encodings.append(embedding)
-                                logger.info(f"✅ Rostro registrado en imagen {i+1}: nitidez {laplacian_var:.1f}")
-                            else:
-                                logger.warning(f"⚠️ Rostro descartado en imagen {i+1}: muy borroso (nitidez: {laplacian_var:.1f})")
-                        except Exception as e:
-                            logger.warning(f"Error generando embedding para rostro en imagen {i+1}: {str(e)}")
-                else:
-                    logger.warning(f"No se detectaron rostros en imagen {i+1}")
-                
-                if face_encodings:
-                    face_encoding = face_encodings[0]
-                    face_location = face_locations[0]
-                    
-                    # Calcular calidad
-                    quality = calculate_face_quality(face_encoding, face_location)
-                    logger.info(f"Calidad calculada para imagen {i+1}: {quality}")
-                    
-                    if quality >= 0.3:  # Umbral mínimo de calidad
-                        embeddings.append(face_encoding)
-                        qualities.append(quality)
-                        logger.info(f"Embedding agregado para imagen {i+1}")
-                    else:
-                        logger.warning(f"Calidad insuficiente en imagen {i+1}: {quality}")
-                else:
-                    logger.warning(f"No se encontraron rostros en imagen {i+1}")
+                face_encoding, quality, _ = extract_enrollment_face(image, label=f"imagen {i+1}", model_name=embedding_model)
+                if face_encoding is not None:
+                    embeddings.append(face_encoding)
+                    qualities.append(quality)
+                    image_numbers.append(i + 1)
+                    logger.info(f"Embedding agregado para imagen {i+1}")
                     
             except Exception as img_error:
                 logger.error(f"Error procesando imagen {i+1}: {str(img_error)}")
@@ -1738,13 +2575,70 @@ async def enroll_face(request: FaceEnrollmentRequest):
         logger.info(f"Conectando a la base de datos para guardar {len(embeddings)} embeddings")
         conn = await get_db_connection()
         try:
-            # Obtener modelo facial por defecto
-            logger.info(f"Buscando modelo facial: {request.model_name}")
-            model_query = "SELECT id FROM modelos_faciales WHERE nombre = $1 LIMIT 1"
-            model_row = await conn.fetchrow(model_query, request.model_name)
-            model_id = model_row['id'] if model_row else None
+            if serving_model_id is not None:
+                model_id = serving_model_id
+            else:
+                # Obtener modelo facial por defecto
+                logger.info(f"Buscando modelo facial: {request.model_name}")
+                model_query = "SELECT id FROM modelos_faciales WHERE nombre = $1 LIMIT 1"
+                model_row = await conn.fetchrow(model_query, request.model_name)
+                model_id = model_row['id'] if model_row else None
             logger.info(f"Modelo encontrado: {model_id}")
             
+            # Descartar casi duplicados (contra rostros existentes y el propio lote)
+            existing_rows = await conn.fetch(
+                "SELECT embedding FROM rostros WHERE usuario_id = $1 AND ($2::int IS NULL OR modelo_id = $2)",
+                request.user_id, serving_model_id)
+            existing_embeddings = []
+            for row in existing_rows:
+                try:
+                    existing_embeddings.append(decrypt_embedding(row['embedding']))
+                except Exception:
+                    continue
+            pruning = prune_enrollment_embeddings(embeddings, qualities, existing_embeddings,
+                                                  ENROLL_DUPLICATE_THRESHOLD, ENROLL_MAX_FACES_PER_USER)
+            if pruning.pruned:
+                logger.info(f"✂️ Registro usuario {request.user_id}: {len(pruning.duplicates)} casi duplicados y "
+                            f"{len(pruning.over_cap)} por encima del límite ({len(existing_embeddings)} existentes)")
+            embeddings = [embeddings[i] for i in pruning.kept]
+            qualities = [qualities[i] for i in pruning.kept]
+            image_numbers = [image_numbers[i] for i in pruning.kept]
+            
+            # ¿Algún rostro nuevo ya coincide con OTRO usuario? (falso aceptado futuro)
+            collisions = await find_enrollment_collisions(request.user_id, embeddings, image_numbers)
+            if collisions and ENROLL_COLLISION_POLICY == "reject":
+                colliding = {collision["imagen"] for collision in collisions}
+                keep = [i for i, number in enumerate(image_numbers) if number not in colliding]
+                embeddings = [embeddings[i] for i in keep]
+                qualities = [qualities[i] for i in keep]
+                image_numbers = [image_numbers[i] for i in keep]
+                if not embeddings:
+                    return FaceEnrollmentResponse(
+                        success=False,
+                        faces_processed=0,
+                        average_quality=0.0,
+                        message="Registro rechazado: los rostros coinciden con otro usuario registrado",
+                        faces_pruned=pruning.pruned,
+                        pruning=pruning.to_dict(),
+                        collisions=collisions
+                    )
+            
+            if not embeddings:
+                if pruning.over_cap:
+                    # El límite bloqueó el registro: no es un "ya estaba registrado"
+                    message = (f"Límite de {ENROLL_MAX_FACES_PER_USER} rostros por usuario alcanzado, "
+                               f"no se agregaron rostros nuevos ({pruning.describe(ENROLL_MAX_FACES_PER_USER)})")
+                else:
+                    message = "Los rostros enviados ya estaban registrados (casi duplicados), no se agregaron nuevos"
+                return FaceEnrollmentResponse(
+                    success=not pruning.over_cap,
+                    faces_processed=0,
+                    average_quality=0.0,
+                    message=message,
+                    faces_pruned=pruning.pruned,
+                    pruning=pruning.to_dict()
+                )
+            
             # Insertar cada embedding
             for i, (embedding, quality) in enumerate(zip(embeddings, qualities)):
                 logger.info(f"Insertando embedding {i+1}/{len(embeddings)}")
@@ -1757,6 +2651,15 @@ async def enroll_face(request: FaceEnrollmentRequest):
                 await conn.execute(insert_query, request.user_id, encrypted_embedding, quality, model_id)
                 logger.info(f"Embedding {i+1} insertado exitosamente")
             
+            if GALLERY_AGGREGATES:
+                await update_user_aggregate(conn, request.user_id, model_id, serving_model_id)
+                aggregate_cache.invalidate()
+            
+            # Los nuevos rostros deben verse en el próximo reconocimiento
+            # (si el listener está conectado, los triggers ya los notifican)
+            if gallery_sync is None or not gallery_sync.connected:
+                gallery.invalidate()
+            
             avg_quality = sum(qualities) / len(qualities)
             logger.info(f"Registro completado. Calidad promedio: {avg_quality}")
             
@@ -1765,6 +2668,10 @@ async def enroll_face(request: FaceEnrollmentRequest):
                 faces_processed=len(embeddings),
                 average_quality=avg_quality,
                 message=f"Se registraron {len(embeddings)} rostros exitosamente"
+                        + (f" ({pruning.describe(ENROLL_MAX_FACES_PER_USER)})" if pruning.pruned else ""),
+                faces_pruned=pruning.pruned,
+                pruning=pruning.to_dict(),
+                collisions=collisions
             )
             
         finally:
@@ -1795,6 +2702,13 @@ async def get_service_stats():
             "usuarios_con_rostros": usuarios_con_rostros,
             "umbral_confianza": CONFIDENCE_THRESHOLD,
             "umbral_liveness": LIVENESS_THRESHOLD,
+            "modelos_tensorflow": {
+                model_type: {
+                    "disponible": model_manager.is_model_available(model_type),
+                    "latencia": model_manager.latency_stats.get(model_type)
+                }
+                for model_type in ("liveness", "spoofing")
+            },
             "servicio_activo": True
         }
     finally:
@@ -1863,6 +2777,7 @@ async def root():
         "status": "active",
         "endpoints": [
             "/health",
+            "/ready",
             "/detect-face",
             "/recognize-face",
             "/register-face",
@@ -1881,4 +2796,18 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if SERVICE_WORKERS > 1:
+        import multiprocessing
+        
+        # Los workers heredan el entorno: todos leen la galería del cargador
+        os.environ["GALLERY_SHARED_MEMORY"] = "true"
+        loader = multiprocessing.Process(target=run_gallery_loader, name="gallery-loader", daemon=True)
+        loader.start()
+        logger.info(f"🚀 Iniciando {SERVICE_WORKERS} workers con galería compartida")
+        try:
+            uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=SERVICE_WORKERS)
+        finally:
+            loader.terminate()
+            loader.join(timeout=5)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,192 @@
+"""
+Exportación de modelos a TFLite / ONNX
+Convierte los modelos de liveness, spoofing y emociones (y el embedder ArcFace
+de DeepFace) a formatos ligeros para los controladores de puerta sin GPU.
+
+Uso:
+    python model_export.py --format tflite --quantization float16
+    python model_export.py --format tflite --quantization int8 --representative-dir ../evidencias
+    python model_export.py --format onnx --models liveness spoofing
+
+Los archivos se escriben junto a los .h5 como <tipo>_model.tflite / .onnx y se
+cargan con MODEL_RUNTIME_BACKEND=tflite|onnx.
+"""
+
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+from typing import Iterator, List, Optional
+
+import cv2
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from tensorflow_models import MODEL_CONFIGS, RUNTIME_EXTENSIONS, load_runtime_model, runtime_model_path
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EXPORTABLE_MODELS = ("liveness", "spoofing", "emotion", "arcface")
+QUANTIZATION_MODES = ("none", "float16", "int8")
+
+# Muestras usadas para calibrar la cuantización int8
+REPRESENTATIVE_SAMPLES = 100
+
+
+def load_keras_model(models_dir: str, model_type: str) -> keras.Model:
+    """Carga el modelo Keras a exportar"""
+    if model_type == "arcface":
+        from deepface import DeepFace
+
+        model = DeepFace.build_model("ArcFace")
+        # Versiones recientes de DeepFace envuelven el modelo Keras
+        return getattr(model, "model", model)
+
+    model_path = runtime_model_path(models_dir, model_type, "keras")
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"No existe {model_path}")
+    return keras.models.load_model(model_path)
+
+
+def representative_images(model_type: str, image_dir: Optional[str]) -> Iterator[List[np.ndarray]]:
+    """
+    Lote de calibración para int8: rostros reales de image_dir si se indica,
+    si no imágenes aleatorias con la forma de entrada del modelo
+    """
+    height, width, channels = MODEL_CONFIGS[model_type]["input_shape"]
+    paths = []
+    if image_dir:
+        for extension in ("*.jpg", "*.jpeg", "*.png"):
+            paths.extend(glob.glob(os.path.join(image_dir, "**", extension), recursive=True))
+        paths = paths[:REPRESENTATIVE_SAMPLES]
+
+    if not paths:
+        logger.warning(f"⚠️ Calibrando {model_type} con imágenes aleatorias (usa --representative-dir)")
+        for _ in range(REPRESENTATIVE_SAMPLES):
+            yield [np.random.uniform(0.0, 1.0, (1, height, width, channels)).astype(np.float32)]
+        return
+
+    for path in paths:
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE if channels == 1 else cv2.IMREAD_COLOR)
+        if image is None:
+            continue
+        if channels == 3 and model_type != "arcface":
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image = cv2.resize(image, (width, height)).astype(np.float32) / 255.0
+        yield [image.reshape(1, height, width, channels)]
+
+
+def export_tflite(model: keras.Model, model_type: str, output_path: str, quantization: str,
+                  representative_dir: Optional[str] = None):
+    """Convierte un modelo Keras a TFLite con cuantización opcional"""
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if quantization == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: representative_images(model_type, representative_dir)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+
+    with open(output_path, "wb") as f:
+        f.write(converter.convert())
+
+
+def export_onnx(model: keras.Model, model_type: str, output_path: str):
+    """Convierte un modelo Keras a ONNX (requiere tf2onnx)"""
+    try:
+        import tf2onnx
+    except ImportError:
+        raise RuntimeError("Exportar a ONNX requiere tf2onnx: pip install tf2onnx onnxruntime")
+
+    input_shape = MODEL_CONFIGS[model_type]["input_shape"]
+    signature = (tf.TensorSpec((None,) + input_shape, tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(model, input_signature=signature, opset=13, output_path=output_path)
+
+
+def benchmark(model, model_type: str, runs: int = 20) -> float:
+    """Latencia media (ms) de una inferencia de un rostro"""
+    sample = np.random.uniform(0.0, 1.0, (1,) + MODEL_CONFIGS[model_type]["input_shape"]).astype(np.float32)
+    if isinstance(model, keras.Model):
+        run = lambda: model(sample, training=False).numpy()
+    else:
+        run = lambda: model.predict(sample)
+
+    run()  # Precalentamiento
+    start = time.perf_counter()
+    for _ in range(runs):
+        run()
+    return (time.perf_counter() - start) * 1000 / runs
+
+
+def export_model(models_dir: str, model_type: str, export_format: str, quantization: str,
+                 representative_dir: Optional[str] = None) -> dict:
+    """Exporta un modelo y compara tamaño y latencia con la versión Keras"""
+    load_start = time.perf_counter()
+    model = load_keras_model(models_dir, model_type)
+    keras_load_ms = (time.perf_counter() - load_start) * 1000
+
+    output_path = runtime_model_path(models_dir, model_type, export_format)
+    if export_format == "tflite":
+        export_tflite(model, model_type, output_path, quantization, representative_dir)
+    else:
+        if quantization != "none":
+            logger.warning("⚠️ La cuantización solo se aplica a TFLite; exportando ONNX en float32")
+        export_onnx(model, model_type, output_path)
+
+    load_start = time.perf_counter()
+    runtime_model = load_runtime_model(output_path, export_format)
+    runtime_load_ms = (time.perf_counter() - load_start) * 1000
+
+    keras_path = runtime_model_path(models_dir, model_type, "keras")
+    return {
+        "model": model_type,
+        "path": output_path,
+        "size_mb": os.path.getsize(output_path) / 1e6,
+        "keras_size_mb": os.path.getsize(keras_path) / 1e6 if os.path.exists(keras_path) else None,
+        "keras_load_ms": keras_load_ms,
+        "runtime_load_ms": runtime_load_ms,
+        "keras_ms": benchmark(model, model_type),
+        "runtime_ms": benchmark(runtime_model, model_type),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exporta modelos a TFLite/ONNX")
+    parser.add_argument("--models", nargs="+", choices=EXPORTABLE_MODELS, default=list(EXPORTABLE_MODELS))
+    parser.add_argument("--format", choices=sorted(RUNTIME_EXTENSIONS), default="tflite")
+    parser.add_argument("--quantization", choices=QUANTIZATION_MODES, default="none")
+    parser.add_argument("--representative-dir", help="Carpeta con rostros para calibrar int8")
+    parser.add_argument("--models-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "models"))
+    args = parser.parse_args()
+
+    print(f"📦 Exportando {', '.join(args.models)} a {args.format} (cuantización: {args.quantization})")
+
+    failures = 0
+    for model_type in args.models:
+        try:
+            report = export_model(args.models_dir, model_type, args.format, args.quantization,
+                                  args.representative_dir)
+        except Exception as e:
+            failures += 1
+            print(f"❌ {model_type}: {e}")
+            continue
+
+        keras_size = f"{report['keras_size_mb']:.1f} MB → " if report["keras_size_mb"] else ""
+        print(f"✅ {model_type}: {report['path']}")
+        print(f"   Tamaño: {keras_size}{report['size_mb']:.1f} MB")
+        print(f"   Carga: {report['keras_load_ms']:.0f} ms → {report['runtime_load_ms']:.0f} ms")
+        print(f"   Inferencia: {report['keras_ms']:.1f} ms → {report['runtime_ms']:.1f} ms")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""
+Re-embedding de la galería para un modelo nuevo
+
+    python reembed_gallery.py status
+    python reembed_gallery.py run --model-name ArcFace --version 2
+    python reembed_gallery.py run --model-name Facenet512 --version 1 --workers 2 --max-rate 10 --switch
+    python reembed_gallery.py switch --model-id 7
+    python reembed_gallery.py switch --model-id 3          # volver al modelo anterior
+
+Hasta ahora cambiar de modelo significaba borrar `rostros` y volver a
+registrar a todos (database/cleanup_deepface_migration.sql). `run` regenera
+los embeddings desde las imágenes guardadas en `imagenes_entrenamiento` y los
+escribe con el `modelo_id` nuevo mientras el modelo actual sigue sirviendo:
+el servicio solo carga las filas del modelo fijado en `galeria_modelo`.
+
+El trabajo va en segundo plano sin quitarle CPU al reconocimiento: pocos
+procesos con prioridad baja (nice), TF limitado a `--threads` hilos y un
+máximo de `--max-rate` imágenes por segundo. Se puede interrumpir y
+relanzar: las imágenes ya procesadas tienen su fila en
+`imagenes_entrenamiento` con el modelo nuevo y se saltan.
+
+`switch` cambia el modelo servido en una sola transacción (recalculando
+`rostros_agregados` si existe) y notifica a los servicios, que recargan la
+galería completa con el modelo nuevo. Se rechaza si algún usuario servido
+hoy quedaría sin rostros en el modelo nuevo, salvo con `--force`. Las filas
+del modelo anterior se conservan para poder volver atrás.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+import asyncpg
+import numpy as np
+from cryptography.fernet import Fernet
+
+from bulk_enroll import DATABASE_URL, BatchWriter, ImportStats, embed_image, get_cipher, init_worker, load_existing
+from embedding_storage import deserialize_embedding
+from serving_model import EMBEDDING_MODELS, embedding_model_name, get_serving_model_id, switch_serving_model
+from user_aggregates import compute_user_aggregate, serialize_aggregate
+
+AGGREGATE_MEDOIDS = int(os.getenv("AGGREGATE_MEDOIDS", "3"))
+
+# Prioridad de los procesos del pool frente al servicio
+WORKER_NICENESS = 10
+
+
+class RateLimiter:
+    """Espacia las adquisiciones para no superar `rate` por segundo (0 = sin límite)"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+            self._next = max(self._next, now) + self.interval
+
+
+async def ensure_model(conn, name: str, version: str) -> int:
+    """id de (nombre, versión) en modelos_faciales, creándolo si no existe"""
+    model_id = await conn.fetchval("SELECT id FROM modelos_faciales WHERE nombre = $1 AND version = $2", name, version)
+    if model_id is None:
+        model_id = await conn.fetchval(
+            "INSERT INTO modelos_faciales (nombre, version) VALUES ($1, $2) RETURNING id", name, version)
+        print(f"🆕 Modelo {name} v{version} creado con id {model_id}")
+    return model_id
+
+
+async def ensure_serving_model(conn, force: bool) -> int:
+    """
+    Modelo que sirve la galería. La primera vez se fija al modelo de las
+    filas existentes (las que no tienen modelo_id pasan a tenerlo), para que
+    las filas del re-embedding no entren en la galería antes del cambio
+    """
+    serving = await get_serving_model_id(conn)
+    if serving is not None:
+        return serving
+
+    counts = await conn.fetch("SELECT modelo_id, COUNT(*) AS n FROM rostros GROUP BY modelo_id ORDER BY n DESC")
+    models = [row for row in counts if row['modelo_id'] is not None]
+    if len(models) > 1 and not force:
+        detail = ", ".join(f"{row['modelo_id']}: {row['n']}" for row in models)
+        print(f"❌ Hay rostros de varios modelos ({detail}); solo se serviría {models[0]['modelo_id']}. "
+              f"Use --force para continuar")
+        sys.exit(1)
+    serving = models[0]['modelo_id'] if models else await ensure_model(conn, "ArcFace", "1")
+
+    async with conn.transaction():
+        updated = await conn.execute("UPDATE rostros SET modelo_id = $1 WHERE modelo_id IS NULL", serving)
+        await switch_serving_model(conn, serving)
+    print(f"📌 Galería fijada al modelo {serving} ({updated.split()[-1]} filas sin modelo asignadas)")
+    return serving
+
+
+async def model_coverage(conn, model_id: int) -> set:
+    """Usuarios activos con al menos un rostro de ese modelo"""
+    rows = await conn.fetch("""
+        SELECT DISTINCT r.usuario_id FROM rostros r JOIN usuarios u ON u.id = r.usuario_id
+        WHERE u.activo = true AND r.modelo_id = $1
+    """, model_id)
+    return {row['usuario_id'] for row in rows}
+
+
+async def pending_images(conn, target: int) -> Dict[int, List[str]]:
+    """{usuario_id: rutas} de imágenes de usuarios activos aún sin embedding del modelo nuevo"""
+    rows = await conn.fetch("""
+        SELECT DISTINCT ON (i.usuario_id, i.hash) i.usuario_id, i.path
+        FROM imagenes_entrenamiento i JOIN usuarios u ON u.id = i.usuario_id
+        WHERE u.activo = true AND NOT EXISTS (
+            SELECT 1 FROM imagenes_entrenamiento d
+            WHERE d.usuario_id = i.usuario_id AND d.hash = i.hash AND d.modelo_id = $1)
+        ORDER BY i.usuario_id, i.hash, i.creado_en DESC
+    """, target)
+    jobs: Dict[int, List[str]] = {}
+    for row in rows:
+        jobs.setdefault(row['usuario_id'], []).append(row['path'])
+    return jobs
+
+
+async def show_status(args):
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        serving = await get_serving_model_id(conn)
+        print(f"📌 Modelo servido: {serving if serving is not None else 'sin fijar (todas las filas, ArcFace)'}")
+        rows = await conn.fetch("""
+            SELECT m.id, m.nombre, m.version,
+                   COUNT(r.id) AS rostros, COUNT(DISTINCT r.usuario_id) AS usuarios
+            FROM modelos_faciales m LEFT JOIN rostros r ON r.modelo_id = m.id
+            GROUP BY m.id ORDER BY m.id
+        """)
+        with_images = await conn.fetchval("SELECT to_regclass('imagenes_entrenamiento') IS NOT NULL")
+        for row in rows:
+            images = await conn.fetchval("SELECT COUNT(*) FROM imagenes_entrenamiento WHERE modelo_id = $1",
+                                         row['id']) if with_images else 0
+            mark = "▶" if row['id'] == serving else " "
+            print(f" {mark} {row['id']:>4}  {row['nombre']} v{row['version']}  "
+                  f"(consultas con {embedding_model_name(row['nombre'])}): "
+                  f"{row['rostros']} rostros, {row['usuarios']} usuarios, {images} imágenes")
+        unassigned = await conn.fetchval("SELECT COUNT(*) FROM rostros WHERE modelo_id IS NULL")
+        if unassigned:
+            print(f"   {unassigned} rostros sin modelo_id")
+    finally:
+        await conn.close()
+
+
+async def switch_to(conn, cipher: Fernet, target: int, force: bool) -> bool:
+    """Cambia el modelo servido si el nuevo cubre a los usuarios servidos hoy"""
+    serving = await get_serving_model_id(conn)
+    if serving == target:
+        print(f"ℹ️ El modelo {target} ya es el servido")
+        return True
+    if serving is not None:
+        missing = await model_coverage(conn, serving) - await model_coverage(conn, target)
+        if missing:
+            print(f"⚠️ {len(missing)} usuarios quedarían sin rostros en el modelo {target} "
+                  f"(sin imágenes de entrenamiento o sin rostro válido): "
+                  f"{', '.join(str(user) for user in sorted(missing)[:10])}{' ...' if len(missing) > 10 else ''}")
+            if not force:
+                print("❌ Cambio cancelado. Use --force para cambiar igualmente")
+                return False
+
+    with_aggregates = await conn.fetchval("SELECT to_regclass('rostros_agregados') IS NOT NULL")
+    aggregates = []
+    if with_aggregates:
+        embeddings: Dict[int, List[np.ndarray]] = {}
+        for row in await conn.fetch("SELECT usuario_id, embedding FROM rostros WHERE modelo_id = $1", target):
+            try:
+                embedding = deserialize_embedding(cipher.decrypt(row['embedding']))
+            except Exception:
+                continue
+            if len(embedding) == 512:
+                embeddings.setdefault(row['usuario_id'], []).append(embedding)
+        for user_id, vectors in embeddings.items():
+            aggregate = compute_user_aggregate(vectors, AGGREGATE_MEDOIDS)
+            aggregates.append((user_id, cipher.encrypt(serialize_aggregate(aggregate)),
+                               len(vectors), len(aggregate) - 1, target))
+
+    async with conn.transaction():
+        if with_aggregates:
+            await conn.execute("DELETE FROM rostros_agregados")
+            await conn.executemany("""
+                INSERT INTO rostros_agregados (usuario_id, vectores, num_rostros, num_medoides, modelo_id, actualizado_en)
+                VALUES ($1, $2, $3, $4, $5, NOW())
+            """, aggregates)
+        await switch_serving_model(conn, target)
+    print(f"✅ Galería servida ahora por el modelo {target}"
+          f"{f' ({len(aggregates)} agregados recalculados)' if with_aggregates else ''}")
+    return True
+
+
+async def run_reembedding(args):
+    if args.model_name not in EMBEDDING_MODELS:
+        print(f"❌ Modelo {args.model_name} no soportado (disponibles: {', '.join(EMBEDDING_MODELS)})")
+        sys.exit(1)
+    cipher = get_cipher()
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        if not await conn.fetchval("SELECT to_regclass('imagenes_entrenamiento') IS NOT NULL"):
+            print("❌ No existe la tabla imagenes_entrenamiento: no hay imágenes que re-procesar")
+            sys.exit(1)
+        serving = await ensure_serving_model(conn, args.force)
+        target = await ensure_model(conn, args.model_name, args.version)
+        if target == serving:
+            print(f"❌ El modelo {args.model_name} v{args.version} ({target}) es el que ya sirve la galería")
+            sys.exit(1)
+
+        jobs = await pending_images(conn, target)
+        total_images = sum(len(paths) for paths in jobs.values())
+        print(f"🔁 Re-embedding al modelo {target} ({args.model_name} v{args.version}): {total_images} imágenes "
+              f"pendientes de {len(jobs)} usuarios; sigue sirviendo el modelo {serving}")
+
+        if jobs:
+            existing = await load_existing(conn, cipher, list(jobs), target)
+            stats = ImportStats(total_images, len(jobs))
+            writer = BatchWriter(conn, cipher, target, args.batch_size, None, stats, False, True)
+            limiter = RateLimiter(args.max_rate)
+            in_flight = asyncio.Semaphore(args.workers * 2)
+            loop = asyncio.get_running_loop()
+
+            with ProcessPoolExecutor(args.workers, initializer=init_worker,
+                                     initargs=(args.threads, WORKER_NICENESS)) as pool:
+                async def embed(path: str):
+                    async with in_flight:
+                        await limiter.acquire()
+                        result = await loop.run_in_executor(pool, embed_image, path, args.model_name)
+                    stats.images += 1
+                    if result[1] is None:
+                        stats.discarded[result[3]] += 1
+                    else:
+                        stats.faces += 1
+                    return result
+
+                async def reembed_user(user_id: int):
+                    results = await asyncio.gather(*(embed(path) for path in jobs[user_id]))
+                    await writer.add_user(str(user_id), user_id, results, existing.get(user_id, []), True)
+
+                async def report():
+                    while True:
+                        await asyncio.sleep(args.report_seconds)
+                        print(stats.line(), flush=True)
+
+                reporter = asyncio.create_task(report())
+                try:
+                    await asyncio.gather(*(reembed_user(user_id) for user_id in jobs))
+                    await writer.flush()
+                finally:
+                    reporter.cancel()
+
+            print(stats.line())
+            if stats.discarded:
+                print("   Descartes: " + ", ".join(f"{reason}={count}" for reason, count in stats.discarded.most_common()))
+
+        served, covered = await model_coverage(conn, serving), await model_coverage(conn, target)
+        print(f"📊 Cobertura: {len(served & covered)}/{len(served)} usuarios servidos tienen rostros en el modelo {target}")
+        if args.switch:
+            await switch_to(conn, cipher, target, args.force)
+        else:
+            print(f"ℹ️ Para servir el modelo nuevo: python reembed_gallery.py switch --model-id {target}")
+    finally:
+        await conn.close()
+
+
+async def run_switch(args):
+    cipher = get_cipher()
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        if not await switch_to(conn, cipher, args.model_id, args.force):
+            sys.exit(1)
+    finally:
+        await conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-embedding de la galería para un modelo nuevo")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("status", help="Modelo servido y rostros por modelo")
+
+    run = sub.add_parser("run", help="Generar embeddings del modelo nuevo desde imagenes_entrenamiento")
+    run.add_argument("--model-name", default="ArcFace", help=f"Modelo de DeepFace ({', '.join(EMBEDDING_MODELS)})")
+    run.add_argument("--version", required=True, help="Versión en modelos_faciales")
+    run.add_argument("--workers", type=int, default=1)
+    run.add_argument("--threads", type=int, default=1, help="Hilos de TF por proceso")
+    run.add_argument("--max-rate", type=float, default=2.0, help="Imágenes por segundo (0 = sin límite)")
+    run.add_argument("--batch-size", type=int, default=500, help="Rostros por COPY/transacción")
+    run.add_argument("--report-seconds", type=float, default=30.0)
+    run.add_argument("--switch", action="store_true", help="Cambiar el modelo servido al terminar")
+    run.add_argument("--force", action="store_true", help="Fijar/cambiar aunque falten usuarios o haya varios modelos")
+
+    switch = sub.add_parser("switch", help="Cambiar el modelo que sirve la galería")
+    switch.add_argument("--model-id", type=int, required=True)
+    switch.add_argument("--force", action="store_true", help="Cambiar aunque algunos usuarios queden sin rostros")
+
+    args = parser.parse_args()
+    if args.command == "status":
+        asyncio.run(show_status(args))
+    elif args.command == "run":
+        asyncio.run(run_reembedding(args))
+    elif args.command == "switch":
+        asyncio.run(run_switch(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Modelo de embeddings que sirve la galería
+`galeria_modelo` guarda (una sola fila) el `modelos_faciales.id` cuyos rostros
+forman la galería; el nombre de ese modelo indica con qué modelo de DeepFace
+se generan los embeddings de consulta. Sin fila, la galería usa todas las
+filas de `rostros` con ArcFace (comportamiento histórico).
+
+Un re-embedding (reembed_gallery.py) escribe filas con un `modelo_id` nuevo
+mientras el modelo actual sigue sirviendo; el cambio es una sola transacción
+que actualiza esta fila y notifica una recarga completa de la galería.
+"""
+
+import logging
+from typing import Optional
+
+import asyncpg
+
+from gallery_sync import GALLERY_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+SERVING_MODEL_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS galeria_modelo (
+    id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+    modelo_id INTEGER NOT NULL REFERENCES modelos_faciales(id),
+    actualizado_en TIMESTAMPTZ DEFAULT NOW()
+);
+"""
+
+# Modelos de DeepFace con embeddings de 512 dimensiones (la galería y
+# generate_face_embedding asumen 512)
+EMBEDDING_MODELS = ("ArcFace", "Facenet512")
+DEFAULT_EMBEDDING_MODEL = "ArcFace"
+
+
+def embedding_model_name(model_name: Optional[str]) -> str:
+    """Modelo de DeepFace de una fila de `modelos_faciales` (ArcFace si el nombre no es uno)"""
+    return model_name if model_name in EMBEDDING_MODELS else DEFAULT_EMBEDDING_MODEL
+
+
+async def get_serving_model_id(conn) -> Optional[int]:
+    """`modelo_id` que sirve la galería, o None si nunca se fijó"""
+    try:
+        return await conn.fetchval("SELECT modelo_id FROM galeria_modelo")
+    except asyncpg.UndefinedTableError:
+        return None
+
+
+async def switch_serving_model(conn, model_id: int):
+    """
+    Fija el modelo que sirve la galería. Se llama dentro de la transacción
+    del cambio: la notificación solo se entrega al confirmar, y los servicios
+    que escuchan recargan la galería completa con el modelo nuevo
+    """
+    await conn.execute(SERVING_MODEL_TABLE_SQL)
+    await conn.execute("""
+        INSERT INTO galeria_modelo (id, modelo_id, actualizado_en) VALUES (true, $1, NOW())
+        ON CONFLICT (id) DO UPDATE SET modelo_id = EXCLUDED.modelo_id, actualizado_en = NOW()
+    """, model_id)
+    await conn.execute("SELECT pg_notify($1, $2)", GALLERY_CHANNEL, '{"tabla": "galeria_modelo", "op": "TRUNCATE"}')
+    logger.info(f"🔁 Galería servida por el modelo {model_id}")
@@ -0,0 +1,281 @@
+"""
+Galería de embeddings en memoria compartida
+Con varios workers de uvicorn, un único proceso cargador descifra la galería y
+la publica en un segmento `multiprocessing.shared_memory`; cada worker lo
+mapea en solo lectura. Un bloque de control con contadores de versión indica
+cuándo hay un segmento nuevo, así la RAM no crece con el número de workers.
+
+Layout del segmento de datos (little-endian):
+    cabecera (64 bytes): n, dim, versión, precisión (índice en GALLERY_PRECISIONS),
+                         modelo_id (0 = sin filtrar), generación (recargas completas)
+    ids       int64[n]
+    user_ids  int64[n]
+    matrix    <precisión>[n, dim]
+    scales    float32[n]
+
+Bloque de control: versión publicada (int64), solicitudes de recarga (int64)
+"""
+
+import asyncio
+import logging
+import struct
+import time
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from embedding_gallery import GallerySnapshot
+from embedding_storage import GALLERY_PRECISIONS
+
+logger = logging.getLogger(__name__)
+
+HEADER_SIZE = 64
+HEADER_FORMAT = "<qqqqqq"
+CONTROL_FORMAT = "<qq"
+CONTROL_SIZE = struct.calcsize(CONTROL_FORMAT)
+# Cada campo del bloque de control lo escribe un solo lado: la versión el
+# cargador y las solicitudes los workers, así nadie pisa el campo del otro
+CONTROL_FIELD_FORMAT = "<q"
+CONTROL_VERSION_OFFSET = 0
+CONTROL_REQUESTS_OFFSET = struct.calcsize(CONTROL_FIELD_FORMAT)
+
+# Segmentos anteriores que se mantienen vivos para lectores en transición
+RETAINED_SEGMENTS = 2
+
+
+def _segment_name(name: str, version: int) -> str:
+    return f"{name}_v{version}"
+
+
+def _control_name(name: str) -> str:
+    return f"{name}_ctl"
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """
+    Abre un segmento existente sin registrarlo en el resource_tracker: si no,
+    al terminar un worker Python borraría el segmento que siguen usando otros
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        segment = shared_memory.SharedMemory(name=name)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(segment._name, "shared_memory")
+        except Exception:
+            pass
+        return segment
+
+
+class SharedGalleryPublisher:
+    """
+    Lado escritor (proceso cargador): publica cada nueva versión de la
+    galería en un segmento propio y luego avanza el contador de versión
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.version = 0
+        self._segments: List[shared_memory.SharedMemory] = []
+        try:
+            self.control = shared_memory.SharedMemory(name=_control_name(name), create=True, size=CONTROL_SIZE)
+        except FileExistsError:
+            # Restos de una ejecución anterior: reutilizar y reiniciar
+            self.control = _attach(_control_name(name))
+        struct.pack_into(CONTROL_FORMAT, self.control.buf, 0, 0, 0)
+
+    @property
+    def refresh_requests(self) -> int:
+        return struct.unpack_from(CONTROL_FIELD_FORMAT, self.control.buf, CONTROL_REQUESTS_OFFSET)[0]
+
+    def publish(self, snapshot: GallerySnapshot) -> int:
+        """Copia el snapshot a un segmento nuevo y lo anuncia a los workers"""
+        version = self.version + 1
+        n, dim = snapshot.matrix.shape
+        size = HEADER_SIZE + n * (8 * 2 + 4) + snapshot.matrix.nbytes
+
+        try:
+            segment = shared_memory.SharedMemory(name=_segment_name(self.name, version), create=True, size=max(size, HEADER_SIZE))
+        except FileExistsError:
+            stale = _attach(_segment_name(self.name, version))
+            stale.close()
+            stale.unlink()
+            segment = shared_memory.SharedMemory(name=_segment_name(self.name, version), create=True, size=max(size, HEADER_SIZE))
+        struct.pack_into(HEADER_FORMAT, segment.buf, 0, n, dim, version, GALLERY_PRECISIONS.index(snapshot.precision),
+                         snapshot.model_id or 0, snapshot.generation)
+
+        offset = HEADER_SIZE
+        ids = np.ndarray((n,), dtype=np.int64, buffer=segment.buf, offset=offset)
+        ids[:] = snapshot.ids
+        offset += n * 8
+        user_ids = np.ndarray((n,), dtype=np.int64, buffer=segment.buf, offset=offset)
+        user_ids[:] = snapshot.user_ids
+        offset += n * 8
+        matrix = np.ndarray((n, dim), dtype=snapshot.matrix.dtype, buffer=segment.buf, offset=offset)
+        matrix[:] = snapshot.matrix
+        offset += matrix.nbytes
+        scales = np.ndarray((n,), dtype=np.float32, buffer=segment.buf, offset=offset)
+        scales[:] = snapshot.scales
+        del ids, user_ids, scales, matrix
+
+        # El segmento está completo: ahora sí anunciar la nueva versión
+        struct.pack_into(CONTROL_FIELD_FORMAT, self.control.buf, CONTROL_VERSION_OFFSET, version)
+        self.version = version
+        self._segments.append(segment)
+
+        # Liberar versiones viejas (los workers que aún las mapean las conservan)
+        while len(self._segments) > RETAINED_SEGMENTS:
+            old = self._segments.pop(0)
+            old.close()
+            old.unlink()
+
+        logger.info(f"🗂️ Galería compartida publicada: versión {version}, {n} embeddings ({size / 1e6:.1f} MB)")
+        return version
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []
+        self.control.close()
+        self.control.unlink()
+
+
+class SharedEmbeddingGallery:
+    """
+    Lado lector (worker): misma interfaz que EmbeddingGallery, pero los
+    embeddings son vistas de solo lectura sobre el segmento compartido
+    """
+
+    def __init__(self, name: str, attach_timeout: float = 30.0):
+        self.name = name
+        self.attach_timeout = attach_timeout
+        self.snapshot = GallerySnapshot.empty()
+        self.load_ms: Optional[float] = None
+        self._control: Optional[shared_memory.SharedMemory] = None
+        self._segment: Optional[shared_memory.SharedMemory] = None
+        self._retired: List[shared_memory.SharedMemory] = []
+
+    @property
+    def version(self) -> int:
+        return self.snapshot.version
+
+    @property
+    def entries(self) -> List[Dict[str, Any]]:
+        return self.snapshot.entries
+
+    def _published_version(self) -> int:
+        if self._control is None:
+            try:
+                self._control = _attach(_control_name(self.name))
+            except FileNotFoundError:
+                return 0
+        return struct.unpack_from(CONTROL_FIELD_FORMAT, self._control.buf, CONTROL_VERSION_OFFSET)[0]
+
+    def _map(self, version: int):
+        start = time.perf_counter()
+        segment = _attach(_segment_name(self.name, version))
+        n, dim, _, precision, model_id, generation = struct.unpack_from(HEADER_FORMAT, segment.buf, 0)
+
+        offset = HEADER_SIZE
+        ids = np.ndarray((n,), dtype=np.int64, buffer=segment.buf, offset=offset)
+        offset += n * 8
+        user_ids = np.ndarray((n,), dtype=np.int64, buffer=segment.buf, offset=offset)
+        offset += n * 8
+        matrix = np.ndarray((n, dim), dtype=GALLERY_PRECISIONS[precision], buffer=segment.buf, offset=offset)
+        offset += matrix.nbytes
+        scales = np.ndarray((n,), dtype=np.float32, buffer=segment.buf, offset=offset)
+        for array in (ids, user_ids, scales, matrix):
+            array.flags.writeable = False
+
+        if self._segment is not None:
+            self._retired.append(self._segment)
+        self._segment = segment
+        self.snapshot = GallerySnapshot(ids, user_ids, matrix, version, scales, model_id or None, generation)
+        self.load_ms = (time.perf_counter() - start) * 1000
+        self._release_retired()
+        logger.info(f"🗂️ Worker mapeó galería compartida versión {version} ({n} embeddings)")
+
+    def _release_retired(self):
+        # Un segmento solo se puede cerrar cuando ninguna petición usa sus vistas
+        still_in_use = []
+        for segment in self._retired:
+            try:
+                segment.close()
+            except BufferError:
+                still_in_use.append(segment)
+        self._retired = still_in_use
+
+    def _sync(self) -> bool:
+        version = self._published_version()
+        if version and version != self.snapshot.version:
+            try:
+                self._map(version)
+            except FileNotFoundError:
+                # Se publicó otra versión entre leer el contador y abrir el segmento
+                return False
+        return version > 0
+
+    def invalidate(self):
+        """Pide al proceso cargador que recargue la galería"""
+        if self._published_version() == 0 and self._control is None:
+            return
+        requests = struct.unpack_from(CONTROL_FIELD_FORMAT, self._control.buf, CONTROL_REQUESTS_OFFSET)[0]
+        struct.pack_into(CONTROL_FIELD_FORMAT, self._control.buf, CONTROL_REQUESTS_OFFSET, requests + 1)
+
+    async def refresh(self) -> GallerySnapshot:
+        """Espera a que el cargador publique una versión y la mapea"""
+        deadline = time.monotonic() + self.attach_timeout
+        while not self._sync():
+            if time.monotonic() > deadline:
+                logger.warning("⚠️ Galería compartida no disponible todavía")
+                break
+            await asyncio.sleep(0.2)
+        return self.snapshot
+
+    async def get(self) -> GallerySnapshot:
+        """Snapshot de la última versión publicada (remapea si cambió)"""
+        if not self._sync() and not self.snapshot.version:
+            logger.warning("⚠️ Galería compartida aún no publicada por el cargador")
+        return self.snapshot
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "embeddings": len(self.snapshot),
+            "usuarios": len(np.unique(self.snapshot.user_ids)),
+            "version": self.version,
+            "precision": self.snapshot.precision,
+            "modelo_id": self.snapshot.model_id,
+            "memoria_mb": round(self.snapshot.nbytes / 1e6, 2),
+            "carga_ms": self.load_ms,
+            "memoria_compartida": self.name,
+        }
+
+
+async def run_publisher_loop(name: str, gallery, poll_seconds: float = 0.5):
+    """
+    Bucle del proceso cargador: mantiene `gallery` (EmbeddingGallery) al día
+    y publica cada versión nueva. Las solicitudes de recarga de los workers
+    invalidan la galería local; los cambios incrementales (LISTEN/NOTIFY)
+    llegan como nuevas versiones del snapshot.
+    """
+    publisher = SharedGalleryPublisher(name)
+    handled_requests = publisher.refresh_requests
+    published_version = None
+    try:
+        while True:
+            if publisher.refresh_requests != handled_requests:
+                handled_requests = publisher.refresh_requests
+                gallery.invalidate()
+            try:
+                snapshot = await gallery.get()
+                if snapshot.version != published_version:
+                    publisher.publish(snapshot)
+                    published_version = snapshot.version
+            except Exception as e:
+                logger.error(f"❌ Error recargando galería compartida: {str(e)}")
+            await asyncio.sleep(poll_seconds)
+    finally:
+        publisher.close()
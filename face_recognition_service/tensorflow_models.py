@@ -3,11 +3,21 @@ Modelos TensorFlow para reconocimiento facial avanzado
 Este módulo contiene funciones para crear y cargar modelos de deep learning
 """
 
-import tensorflow as tf
-from tensorflow import keras
+from __future__ import annotations
+
 import numpy as np
 import os
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+from lazy_imports import LazyModule
+
+# TensorFlow se importa en el primer uso (no al importar este módulo)
+tf = LazyModule("tensorflow", on_load=lambda module: module.get_logger().setLevel("ERROR"))
+keras = LazyModule("tensorflow", attribute="keras")
 
 logger = logging.getLogger(__name__)
 
@@ -101,16 +111,19 @@ def create_emotion_detection_model(input_shape=(48, 48, 1)):
     
     return model
 
-def load_or_create_model(model_path: str, model_type: str):
+def load_or_create_model(model_path: str, model_type: str, create_missing: bool = True):
     """
-    Carga un modelo existente o crea uno nuevo
+    Carga un modelo existente o, si no hay archivo y `create_missing`, crea
+    uno nuevo (sin entrenar). Un archivo que no carga lanza la excepción: un
+    modelo sin entrenar nunca reemplaza en silencio al entrenado
     """
     if os.path.exists(model_path):
-        try:
-            logger.info(f"Cargando modelo {model_type} desde {model_path}")
-            return keras.models.load_model(model_path)
-        except Exception as e:
-            logger.warning(f"Error cargando modelo {model_type}: {e}")
+        logger.info(f"Cargando modelo {model_type} desde {model_path}")
+        return keras.models.load_model(model_path)
+    
+    if not create_missing:
+        logger.warning(f"Modelo {model_type} no encontrado en {model_path}")
+        return None
     
     logger.info(f"Creando nuevo modelo {model_type}")
     
@@ -153,6 +166,27 @@ def preprocess_face_for_spoofing(face_image: np.ndarray) -> np.ndarray:
     
     return face_batch
 
+def preprocess_faces_for_liveness(face_images: Sequence[np.ndarray]) -> tf.Tensor:
+    """
+    Preprocesa un lote de rostros para el modelo de liveness
+    """
+    return tf.concat([preprocess_face_for_liveness(face) for face in face_images], axis=0)
+
+def preprocess_faces_for_spoofing(face_images: Sequence[np.ndarray]) -> tf.Tensor:
+    """
+    Preprocesa un lote de rostros para el modelo de spoofing
+    """
+    return tf.concat([preprocess_face_for_spoofing(face) for face in face_images], axis=0)
+
+def preprocess_faces_for_embedding(face_images: Sequence[np.ndarray]) -> tf.Tensor:
+    """
+    Preprocesa un lote de rostros para el embedder ArcFace exportado
+    (112x112 y píxeles en [0, 1], como la normalización "base" de DeepFace)
+    """
+    faces = [tf.image.resize(face, [112, 112], preserve_aspect_ratio=True) for face in face_images]
+    faces = [tf.image.resize_with_pad(face, 112, 112) for face in faces]
+    return tf.cast(tf.stack(faces), tf.float32) / 255.0
+
 def preprocess_face_for_emotion(face_image: np.ndarray) -> np.ndarray:
     """
     Preprocesa una imagen de rostro para el modelo de emociones
@@ -272,42 +306,291 @@ def enhanced_face_encoding_tf(face_image: np.ndarray) -> np.ndarray:
         random_embedding = np.random.normal(0, 1, 512)
         return random_embedding / np.linalg.norm(random_embedding)
 
+# Archivo y forma de entrada de cada modelo gestionado
+MODEL_CONFIGS = {
+    "liveness": {"filename": "liveness_model.h5", "input_shape": (64, 64, 3)},
+    "spoofing": {"filename": "spoofing_model.h5", "input_shape": (128, 128, 3)},
+    "emotion": {"filename": "emotion_model.h5", "input_shape": (48, 48, 1)},
+    # El embedder ArcFace no tiene .h5 propio: se exporta desde DeepFace
+    "arcface": {"filename": "arcface_model.h5", "input_shape": (112, 112, 3)},
+}
+
+DEFAULT_MODEL_TYPES = ("liveness", "spoofing", "emotion")
+
+# Backends de ejecución: Keras (.h5) o runtimes ligeros exportados
+RUNTIME_BACKENDS = ("keras", "tflite", "onnx")
+RUNTIME_EXTENSIONS = {"tflite": ".tflite", "onnx": ".onnx"}
+
+def runtime_model_path(models_dir: str, model_type: str, backend: str) -> str:
+    """
+    Ruta del archivo de un modelo para un backend de ejecución
+    """
+    if backend == "keras":
+        return os.path.join(models_dir, MODEL_CONFIGS[model_type]["filename"])
+    return os.path.join(models_dir, f"{model_type}_model{RUNTIME_EXTENSIONS[backend]}")
+
+class TFLiteModel:
+    """
+    Modelo exportado a TFLite ejecutado con el intérprete ligero
+    Usa tflite_runtime si está instalado (sin cargar TensorFlow completo)
+    """
+    
+    def __init__(self, model_path: str, num_threads: Optional[int] = None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            Interpreter = tf.lite.Interpreter
+        
+        self.model_path = model_path
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads or os.cpu_count())
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+    
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        batch = np.asarray(batch, dtype=np.float32)
+        input_index = self.input_details["index"]
+        
+        # Redimensionar la entrada si cambia el tamaño de lote
+        if tuple(self.input_details["shape"]) != batch.shape:
+            self.interpreter.resize_tensor_input(input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self.input_details = self.interpreter.get_input_details()[0]
+            self.output_details = self.interpreter.get_output_details()[0]
+        
+        # Modelos cuantizados int8: cuantizar la entrada y decuantizar la salida
+        input_dtype = self.input_details["dtype"]
+        if input_dtype in (np.int8, np.uint8):
+            scale, zero_point = self.input_details["quantization"]
+            batch = np.clip(np.round(batch / scale + zero_point),
+                            np.iinfo(input_dtype).min, np.iinfo(input_dtype).max).astype(input_dtype)
+        
+        self.interpreter.set_tensor(input_index, batch)
+        self.interpreter.invoke()
+        output = self.interpreter.get_tensor(self.output_details["index"])
+        
+        if self.output_details["dtype"] in (np.int8, np.uint8):
+            scale, zero_point = self.output_details["quantization"]
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+class ONNXModel:
+    """
+    Modelo exportado a ONNX ejecutado con onnxruntime (CPU)
+    """
+    
+    def __init__(self, model_path: str, num_threads: Optional[int] = None):
+        import onnxruntime as ort
+        
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads or os.cpu_count()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        
+        self.model_path = model_path
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+    
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {self.input_name: np.asarray(batch, dtype=np.float32)})[0]
+
+def load_runtime_model(model_path: str, backend: str):
+    """
+    Carga un modelo exportado con el runtime ligero correspondiente
+    """
+    if backend == "tflite":
+        return TFLiteModel(model_path)
+    if backend == "onnx":
+        return ONNXModel(model_path)
+    raise ValueError(f"Backend de ejecución desconocido: {backend}")
+
+# Clases de salida del modelo de spoofing
+SPOOFING_LABELS = ("real", "photo", "screen")
+
+class ModelHandle:
+    """
+    Referencia perezosa a un modelo: se carga en el primer get() (o en
+    segundo plano con el precalentamiento) y recuerda su estado
+    """
+    
+    def __init__(self, manager: "TensorFlowModelManager", model_type: str, create_missing: bool):
+        self.manager = manager
+        self.model_type = model_type
+        self.create_missing = create_missing
+        self.state = "cold"  # cold | loading | loaded | warm | missing | error
+        self.load_ms = None
+        self.warmup_ms = None
+        self._model = None
+        self._lock = threading.Lock()
+        
+        if not create_missing and not self._has_file():
+            logger.warning(f"Modelo {model_type} no encontrado en {manager.models_dir}")
+            self.state = "missing"
+    
+    def _has_file(self) -> bool:
+        paths = [runtime_model_path(self.manager.models_dir, self.model_type, "keras")]
+        if self.manager.backend != "keras":
+            paths.append(runtime_model_path(self.manager.models_dir, self.model_type, self.manager.backend))
+        return any(os.path.exists(path) for path in paths)
+    
+    @property
+    def available(self) -> bool:
+        return self.state not in ("missing", "error")
+    
+    def get(self):
+        """
+        Retorna el modelo cargándolo si aún no lo está (None si no existe)
+        """
+        if self._model is not None or not self.available:
+            return self._model
+        
+        with self._lock:
+            if self._model is None and self.available:
+                self.state = "loading"
+                start = time.perf_counter()
+                self._model = self.manager._load_model(self.model_type, self.create_missing)
+                self.load_ms = (time.perf_counter() - start) * 1000
+                self.state = "loaded" if self._model is not None else "error"
+        return self._model
+    
+    def warm(self, batch_size: int = 1):
+        """
+        Carga el modelo (si hace falta) y ejecuta una inferencia sintética
+        """
+        if self.get() is None:
+            return
+        dummy = np.zeros((batch_size,) + MODEL_CONFIGS[self.model_type]["input_shape"], dtype=np.float32)
+        self.manager.predict_batch(self.model_type, dummy)
+        self.warmup_ms = self.manager.latency_stats[self.model_type]["last_ms"]
+        self.state = "warm"
+
 class TensorFlowModelManager:
     """
     Gestor de modelos TensorFlow para el sistema de reconocimiento facial
     """
     
-    def __init__(self, models_dir: str = "models"):
+    def __init__(self, models_dir: str = "models", latency_budgets_ms: Optional[Dict[str, float]] = None,
+                 backend: str = "keras"):
+        if backend not in RUNTIME_BACKENDS:
+            raise ValueError(f"Backend de ejecución desconocido: {backend}")
+        
         self.models_dir = models_dir
-        self.models = {}
+        self.backend = backend
+        self.handles: Dict[str, ModelHandle] = {}
+        self.latency_budgets_ms = latency_budgets_ms or {}
+        self.latency_stats = {}
         
         # Crear directorio de modelos si no existe
         os.makedirs(models_dir, exist_ok=True)
+    
+    @property
+    def models(self) -> dict:
+        """
+        Modelos ya cargados en memoria
+        """
+        return {model_type: handle._model for model_type, handle in self.handles.items()}
         
-    def load_all_models(self):
+    def load_all_models(self, model_types: Optional[Sequence[str]] = None, create_missing: bool = True,
+                        lazy: bool = False, parallel: bool = False):
         """
         Carga todos los modelos disponibles
+        
+        Con create_missing=False un modelo sin archivo queda sin cargar (en
+        lugar de crear una red sin entrenar) para que el llamador use su
+        fallback. Con lazy=True solo se registran los modelos y cada uno se
+        carga en su primer uso; parallel=True carga los modelos en hilos.
+        """
+        model_types = list(model_types or DEFAULT_MODEL_TYPES)
+        for model_type in model_types:
+            self.handles[model_type] = ModelHandle(self, model_type, create_missing)
+        
+        if lazy:
+            return
+        
+        if parallel:
+            with ThreadPoolExecutor(max_workers=len(model_types), thread_name_prefix="model-load") as executor:
+                list(executor.map(lambda model_type: self.handles[model_type].get(), model_types))
+        else:
+            for model_type in model_types:
+                self.handles[model_type].get()
+    
+    def preload(self, warmup: bool = True, background: bool = True) -> Optional[threading.Thread]:
+        """
+        Carga (y precalienta) en paralelo todos los modelos registrados
+        Con background=True retorna de inmediato y la carga sigue en un hilo
+        """
+        def run():
+            handles = [handle for handle in self.handles.values() if handle.available]
+            if not handles:
+                return
+            
+            def load(handle: ModelHandle):
+                try:
+                    if warmup:
+                        handle.warm()
+                    else:
+                        handle.get()
+                except Exception as e:
+                    logger.warning(f"Error precargando modelo {handle.model_type}: {e}")
+            
+            with ThreadPoolExecutor(max_workers=len(handles), thread_name_prefix="model-load") as executor:
+                list(executor.map(load, handles))
+            logger.info(f"Modelos precargados: {self.readiness()}")
+        
+        if not background:
+            run()
+            return None
+        
+        thread = threading.Thread(target=run, name="model-preload", daemon=True)
+        thread.start()
+        return thread
+    
+    def readiness(self) -> Dict[str, dict]:
         """
-        model_configs = {
-            "liveness": "liveness_model.h5",
-            "spoofing": "spoofing_model.h5", 
-            "emotion": "emotion_model.h5"
+        Estado de cada modelo registrado (cold, loading, loaded, warm, missing, error)
+        """
+        return {
+            model_type: {
+                "estado": handle.state,
+                "carga_ms": handle.load_ms,
+                "warmup_ms": handle.warmup_ms,
+            }
+            for model_type, handle in self.handles.items()
         }
+    
+    def _load_model(self, model_type: str, create_missing: bool):
+        """
+        Carga un modelo desde disco con el backend configurado
+        """
+        # Preferir el modelo exportado (TFLite/ONNX) del backend configurado
+        if self.backend != "keras":
+            runtime_path = runtime_model_path(self.models_dir, model_type, self.backend)
+            if os.path.exists(runtime_path):
+                try:
+                    model = load_runtime_model(runtime_path, self.backend)
+                    logger.info(f"Modelo {model_type} cargado con runtime {self.backend}")
+                    return model
+                except Exception as e:
+                    logger.warning(f"Error cargando modelo {model_type} ({self.backend}): {e}, usando Keras")
+            else:
+                logger.info(f"Modelo {model_type} sin exportar a {self.backend}, usando Keras")
         
-        for model_type, filename in model_configs.items():
-            model_path = os.path.join(self.models_dir, filename)
-            try:
-                self.models[model_type] = load_or_create_model(model_path, model_type)
-                logger.info(f"Modelo {model_type} cargado exitosamente")
-            except Exception as e:
-                logger.error(f"Error cargando modelo {model_type}: {e}")
-                self.models[model_type] = None
+        model_path = runtime_model_path(self.models_dir, model_type, "keras")
+        try:
+            model = load_or_create_model(model_path, model_type, create_missing)
+        except Exception as e:
+            # El handle queda en "error" y se usan las heurísticas
+            logger.error(f"Error cargando modelo {model_type} desde {model_path}: {e}")
+            return None
+        if model is not None:
+            logger.info(f"Modelo {model_type} cargado exitosamente")
+        return model
     
     def get_model(self, model_type: str):
         """
-        Obtiene un modelo específico
+        Obtiene un modelo específico (cargándolo en su primer uso)
         """
-        return self.models.get(model_type)
+        handle = self.handles.get(model_type)
+        return handle.get() if handle else None
     
     def save_model(self, model_type: str, model):
         """
@@ -324,6 +607,71 @@ class TensorFlowModelManager:
     
     def is_model_available(self, model_type: str) -> bool:
         """
-        Verifica si un modelo está disponible
+        Verifica si un modelo está disponible (su archivo existe y no falló al
+        cargar); no fuerza la carga
+        """
+        handle = self.handles.get(model_type)
+        return handle is not None and handle.available
+    
+    def warmup(self, batch_size: int = 1):
+        """
+        Ejecuta una inferencia sintética por modelo cargado para trazar el
+        grafo y reservar memoria antes de la primera petición real
+        """
+        for model_type, handle in self.handles.items():
+            if not handle.available:
+                continue
+            try:
+                handle.warm(batch_size)
+                logger.info(f"Modelo {model_type} precalentado en {handle.warmup_ms:.1f} ms")
+            except Exception as e:
+                logger.warning(f"Error precalentando modelo {model_type}: {e}")
+    
+    def predict_batch(self, model_type: str, batch) -> np.ndarray:
+        """
+        Inferencia sobre un lote ya preprocesado, midiendo la latencia
+        contra el presupuesto configurado para el modelo
+        """
+        model = self.get_model(model_type)
+        if model is None:
+            raise ValueError(f"Modelo {model_type} no disponible")
+        
+        start = time.perf_counter()
+        if isinstance(model, (TFLiteModel, ONNXModel)):
+            predictions = model.predict(np.asarray(batch))
+        else:
+            # Llamada directa: model.predict tiene demasiado overhead para lotes pequeños
+            predictions = model(batch, training=False).numpy()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        
+        self._record_latency(model_type, elapsed_ms)
+        return predictions
+    
+    def predict_liveness(self, face_images: List[np.ndarray]) -> np.ndarray:
+        """
+        Probabilidad de rostro real para un lote de recortes RGB
+        """
+        return self.predict_batch("liveness", preprocess_faces_for_liveness(face_images))[:, 0]
+    
+    def predict_spoofing(self, face_images: List[np.ndarray]) -> np.ndarray:
         """
-        return model_type in self.models and self.models[model_type] is not None
+        Probabilidades (real, photo, screen) para un lote de recortes RGB
+        """
+        return self.predict_batch("spoofing", preprocess_faces_for_spoofing(face_images))
+    
+    def predict_embeddings(self, face_images: List[np.ndarray]) -> np.ndarray:
+        """
+        Embeddings ArcFace (N, 512) para un lote de recortes BGR
+        """
+        return self.predict_batch("arcface", preprocess_faces_for_embedding(face_images))
+    
+    def _record_latency(self, model_type: str, elapsed_ms: float):
+        stats = self.latency_stats.setdefault(model_type, {"calls": 0, "last_ms": 0.0, "max_ms": 0.0, "over_budget": 0})
+        stats["calls"] += 1
+        stats["last_ms"] = elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        
+        budget_ms = self.latency_budgets_ms.get(model_type)
+        if budget_ms and elapsed_ms > budget_ms:
+            stats["over_budget"] += 1
+            logger.warning(f"Modelo {model_type} excedió su presupuesto de latencia: {elapsed_ms:.1f} ms > {budget_ms:.0f} ms")
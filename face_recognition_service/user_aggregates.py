@@ -0,0 +1,238 @@
+"""
+Agregados por usuario para el emparejamiento en dos etapas
+Cada usuario se resume en su embedding medio (centroide) más k medoides,
+calculados al registrar rostros y guardados en `rostros_agregados`. La
+primera etapa compara contra esos pocos vectores por usuario (O(usuarios));
+solo los mejores candidatos se puntúan contra todos sus rostros.
+
+Los rostros también se borran fuera del servicio (dashboard), sin recalcular
+el agregado. Por eso un agregado solo se usa si su `num_rostros` coincide con
+las filas del usuario en la galería vigente; si no, el usuario se compara
+rostro a rostro como uno sin agregado.
+"""
+
+import asyncio
+import logging
+import struct
+import time
+from functools import cached_property
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from embedding_storage import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+AGGREGATES_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS rostros_agregados (
+    usuario_id INTEGER PRIMARY KEY REFERENCES usuarios(id) ON DELETE CASCADE,
+    vectores BYTEA NOT NULL,
+    num_rostros INTEGER NOT NULL,
+    num_medoides INTEGER NOT NULL,
+    modelo_id INTEGER REFERENCES modelos_faciales(id),
+    actualizado_en TIMESTAMPTZ DEFAULT NOW()
+);
+"""
+
+AGGREGATE_FORMAT = b"AGG1"
+
+
+def serialize_aggregate(vectors: np.ndarray) -> bytes:
+    """Bytes a cifrar para `rostros_agregados.vectores`: filas, dim y float32"""
+    rows, dim = vectors.shape
+    return AGGREGATE_FORMAT + struct.pack("<II", rows, dim) + np.asarray(vectors, dtype="<f4").tobytes()
+
+
+def deserialize_aggregate(data: bytes) -> np.ndarray:
+    if data[:len(AGGREGATE_FORMAT)] != AGGREGATE_FORMAT:
+        raise ValueError("formato de agregado desconocido")
+    rows, dim = struct.unpack_from("<II", data, len(AGGREGATE_FORMAT))
+    offset = len(AGGREGATE_FORMAT) + 8
+    return np.frombuffer(data, dtype="<f4", offset=offset).reshape(rows, dim)
+
+
+def k_medoids(normalized: np.ndarray, k: int, iterations: int = 10) -> np.ndarray:
+    """
+    Índices de k medoides por distancia coseno. Inicialización por punto más
+    lejano (empezando por el rostro más cercano al centroide) y refinamiento
+    alternando asignación y elección del medoide de cada grupo.
+    """
+    n = len(normalized)
+    if n <= k:
+        return np.arange(n)
+
+    distances = 1.0 - normalized @ normalized.T
+    centroid = normalize_rows(normalized.mean(axis=0))
+    medoids = [int(np.argmax(normalized @ centroid))]
+    while len(medoids) < k:
+        medoids.append(int(np.argmax(distances[:, medoids].min(axis=1))))
+    medoids = np.array(medoids)
+
+    for _ in range(iterations):
+        assignment = np.argmin(distances[:, medoids], axis=1)
+        updated = medoids.copy()
+        for cluster in range(k):
+            members = np.flatnonzero(assignment == cluster)
+            if len(members):
+                within = distances[np.ix_(members, members)].sum(axis=1)
+                updated[cluster] = members[np.argmin(within)]
+        if np.array_equal(updated, medoids):
+            break
+        medoids = updated
+    return medoids
+
+
+def compute_user_aggregate(embeddings: np.ndarray, medoids: int = 3) -> np.ndarray:
+    """Centroide + medoides normalizados, shape (1 + min(medoids, n), dim)"""
+    normalized = normalize_rows(np.vstack(embeddings))
+    centroid = normalize_rows(normalized.mean(axis=0))
+    chosen = normalized[k_medoids(normalized, medoids)]
+    return np.vstack([centroid[None, :], chosen]).astype(np.float32)
+
+
+class AggregateIndex:
+    """
+    Matriz con los vectores agregados de todos los usuarios. `counts` es el
+    `num_rostros` de cada agregado (None = no se verifica contra la galería)
+    """
+
+    def __init__(self, user_ids: np.ndarray, matrix: np.ndarray, version: int = 0,
+                 counts: Optional[Dict[int, int]] = None):
+        self.user_ids = user_ids
+        self.matrix = matrix
+        self.version = version
+        self.counts = counts
+        self._current: Optional[Tuple[int, np.ndarray]] = None
+
+    @classmethod
+    def from_aggregates(cls, aggregates: Dict[int, np.ndarray], version: int = 0,
+                        counts: Optional[Dict[int, int]] = None) -> "AggregateIndex":
+        if not aggregates:
+            return cls(np.zeros(0, dtype=np.int64), np.zeros((0, 512), dtype=np.float32), version, counts)
+        user_ids = np.concatenate([np.full(len(vectors), user_id, dtype=np.int64)
+                                   for user_id, vectors in aggregates.items()])
+        matrix = np.vstack(list(aggregates.values())).astype(np.float32)
+        return cls(user_ids, matrix, version, counts)
+
+    @cached_property
+    def covered_users(self) -> np.ndarray:
+        return np.unique(self.user_ids)
+
+    def current_users(self, snapshot) -> np.ndarray:
+        """
+        Usuarios cuyo agregado corresponde a sus filas en `snapshot` (mismo
+        número de rostros). Se calcula una vez por versión de la galería
+        """
+        if self.counts is None:
+            return self.covered_users
+        if self._current is not None and self._current[0] == snapshot.version:
+            return self._current[1]
+        users, rows = snapshot.unique_users, snapshot.user_row_counts
+        agg_users = np.fromiter(self.counts.keys(), dtype=np.int64, count=len(self.counts))
+        agg_counts = np.fromiter(self.counts.values(), dtype=np.int64, count=len(self.counts))
+        current = np.zeros(0, dtype=np.int64)
+        if len(users) and len(agg_users):
+            positions = np.minimum(np.searchsorted(users, agg_users), len(users) - 1)
+            match = (users[positions] == agg_users) & (rows[positions] == agg_counts)
+            current = np.intersect1d(agg_users[match], self.covered_users)
+        stale = len(agg_users) - len(current)
+        if stale:
+            logger.info(f"👥 {stale} agregados desactualizados o sin rostros en la galería: "
+                        f"esos usuarios se comparan rostro a rostro")
+        self._current = (snapshot.version, current)
+        return current
+
+    def candidate_users(self, query: np.ndarray, top_users: int, users: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Usuarios cuyo mejor vector agregado es más parecido a `query`; con
+        `users` solo se consideran los agregados de esos usuarios
+        """
+        if not len(self.user_ids) or len(query) != self.matrix.shape[1]:
+            return np.zeros(0, dtype=np.int64)
+        matrix, owners = self.matrix, self.user_ids
+        if users is not None:
+            rows = np.flatnonzero(np.isin(owners, users))
+            matrix, owners = matrix[rows], owners[rows]
+        cosines = matrix @ normalize_rows(query).astype(np.float32)
+        order = np.argsort(-cosines)
+        # Primera aparición de cada usuario en el orden = su mejor vector
+        found, first = np.unique(owners[order], return_index=True)
+        return found[np.argsort(first)][:top_users]
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+
+class AggregateCache:
+    """
+    Copia en memoria de `rostros_agregados`. `loader(model_id)` retorna
+    {usuario_id: (vectores, num_rostros)} de ese modelo; se recarga al
+    invalidar, cada `refresh_seconds` y cuando la galería cambia de modelo o
+    se recarga completa (nunca se comparan consultas de un modelo contra
+    centroides de otro)
+    """
+
+    def __init__(self, loader: Callable[[Optional[int]], Awaitable[Dict[int, Tuple[np.ndarray, int]]]],
+                 refresh_seconds: float = 60.0):
+        self._loader = loader
+        self.refresh_seconds = refresh_seconds
+        self.index = AggregateIndex.from_aggregates({})
+        self.loaded_at: Optional[float] = None
+        self.load_ms: Optional[float] = None
+        self._valid = False
+        self._gallery_key: Optional[Tuple[Optional[int], int]] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_stale(self) -> bool:
+        if not self._valid or self.loaded_at is None:
+            return True
+        return self.refresh_seconds > 0 and time.monotonic() - self.loaded_at > self.refresh_seconds
+
+    def invalidate(self):
+        self._valid = False
+
+    async def get(self, snapshot) -> AggregateIndex:
+        """Índice para `snapshot` (GallerySnapshot con el que se va a comparar)"""
+        key = (snapshot.model_id, snapshot.generation)
+        if self._gallery_key != key:
+            self._valid = False
+        if self.is_stale:
+            async with self._lock:
+                if self._gallery_key != key:
+                    self._valid = False
+                if self.is_stale:
+                    start = time.perf_counter()
+                    loaded = await self._loader(snapshot.model_id)
+                    self.index = AggregateIndex.from_aggregates(
+                        {user_id: vectors for user_id, (vectors, _) in loaded.items()}, self.index.version + 1,
+                        counts={user_id: count for user_id, (_, count) in loaded.items()})
+                    self.loaded_at = time.monotonic()
+                    self.load_ms = (time.perf_counter() - start) * 1000
+                    self._valid = True
+                    self._gallery_key = key
+                    logger.info(f"👥 Agregados cargados: {len(self.index.covered_users)} usuarios, "
+                                f"{len(self.index)} vectores en {self.load_ms:.0f} ms")
+        return self.index
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "usuarios": len(self.index.covered_users),
+            "vectores": len(self.index),
+            "version": self.index.version,
+            "carga_ms": self.load_ms,
+        }
+
+
+def two_stage_rows(snapshot, index: AggregateIndex, query: np.ndarray, top_users: int) -> Tuple[np.ndarray, int]:
+    """
+    Filas de la galería a puntuar en la segunda etapa: las de los usuarios
+    candidatos más las de usuarios sin agregado vigente (nunca se excluyen).
+    Retorna (filas, usuarios candidatos)
+    """
+    current = index.current_users(snapshot)
+    candidates = index.candidate_users(query, top_users, current)
+    uncovered = np.setdiff1d(snapshot.unique_users, current, assume_unique=True)
+    users = np.concatenate([candidates, uncovered])
+    return snapshot.rows_for_users(users), len(users)
@@ -22,6 +22,9 @@ else:
 def decrypt_embedding(encrypted_embedding: bytes) -> np.ndarray:
     """Descifra un embedding facial"""
     decrypted_bytes = cipher_suite.decrypt(encrypted_embedding)
+    # Formato actual: prefijo b"EMB4" + float32; filas antiguas: float64 sin prefijo
+    if decrypted_bytes[:4] == b"EMB4":
+        return np.frombuffer(decrypted_bytes, dtype="<f4", offset=4)
     embedding = np.frombuffer(decrypted_bytes, dtype=np.float64)
     return embedding
 
@@ -1,3 +1,4 @@
+import { createHash } from 'crypto'
 import { NextRequest, NextResponse } from 'next/server'
 import { prisma } from '@/lib/prisma'
 
@@ -27,10 +28,20 @@ export async function GET(
       )
     }
 
-    return NextResponse.json({
-      success: true,
-      data: punto,
-    })
+    // ETag del contenido: los kioscos revalidan su caché con If-None-Match
+    const etag = `"${createHash('sha1').update(JSON.stringify(punto)).digest('hex')}"`
+    const headers = { ETag: etag, 'Cache-Control': 'no-cache' }
+    if (request.headers.get('if-none-match') === etag) {
+      return new NextResponse(null, { status: 304, headers })
+    }
+
+    return NextResponse.json(
+      {
+        success: true,
+        data: punto,
+      },
+      { headers }
+    )
   } catch (error) {
     console.error('Error obteniendo configuración de cámara:', error)
     return NextResponse.json(
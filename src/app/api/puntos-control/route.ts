@@ -1,3 +1,4 @@
+import { createHash } from 'crypto'
 import { NextRequest, NextResponse } from 'next/server'
 import { prisma } from '@/lib/prisma'
 import { z } from 'zod'
@@ -10,48 +11,80 @@ const crearPuntoControlSchema = z.object({
   activo: z.boolean().default(true),
 })
 
+// Campos que usan los kioscos y el agente multi-cámara (?vista=kiosco)
+const camposKiosco = {
+  id: true,
+  nombre: true,
+  activo: true,
+  zonaId: true,
+  cameraUrl: true,
+  streamType: true,
+} as const
+
 // GET /api/puntos-control - Obtener todos los puntos de control
 export async function GET(request: NextRequest) {
   try {
     const { searchParams } = new URL(request.url)
     const zonaId = searchParams.get('zonaId')
+    const vistaKiosco = searchParams.get('vista') === 'kiosco'
 
     const where: any = {}
     if (zonaId) {
       where.zonaId = parseInt(zonaId)
     }
 
-    const puntosControl = await prisma.puntoControl.findMany({
-      where,
-      include: {
-        zona: {
-          select: {
-            id: true,
-            nombre: true,
+    // Sin contadores de accesos/alertas: el ETag de los kioscos solo cambia
+    // cuando cambia un punto, no con cada acceso registrado
+    const puntosControl = vistaKiosco
+      ? await prisma.puntoControl.findMany({
+          where,
+          select: camposKiosco,
+          orderBy: {
+            creadoEn: 'desc',
           },
-        },
-        tipo: {
-          select: {
-            id: true,
-            nombre: true,
+        })
+      : await prisma.puntoControl.findMany({
+          where,
+          include: {
+            zona: {
+              select: {
+                id: true,
+                nombre: true,
+              },
+            },
+            tipo: {
+              select: {
+                id: true,
+                nombre: true,
+              },
+            },
+            _count: {
+              select: {
+                accesos: true,
+                alertas: true,
+              },
+            },
           },
-        },
-        _count: {
-          select: {
-            accesos: true,
-            alertas: true,
+          orderBy: {
+            creadoEn: 'desc',
           },
-        },
-      },
-      orderBy: {
-        creadoEn: 'desc',
-      },
-    })
+        })
 
-    return NextResponse.json({
-      success: true,
-      data: puntosControl,
-    })
+    // ETag del contenido: los kioscos revalidan su caché con If-None-Match
+    // (con ?vista=kiosco el contenido no incluye _count)
+    const etag = `"${createHash('sha1').update(JSON.stringify(puntosControl)).digest('hex')}"`
+    const headers = { ETag: etag, 'Cache-Control': 'no-cache' }
+    if (request.headers.get('if-none-match') === etag) {
+      return new NextResponse(null, { status: 304, headers })
+    }
+
+    return NextResponse.json(
+      {
+        success: true,
+        data: puntosControl,
+      },
+      { headers }
+    )
   } catch (error) {
     console.error('Error al obtener puntos de control:', error)
     return NextResponse.json(